@@ -0,0 +1,53 @@
+"""
+Compares two benchmarks.run result files case by case.
+
+    python -m benchmarks.compare before.json after.json --threshold 0.15
+
+Prints the median latency, query count and peak memory of each case in
+both runs and exits with status 1 when a case got slower than
+``--threshold`` (a fraction of the old median) or issues more queries.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {result['name']: result for result in report['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.15, help="tolerated slowdown, e.g. 0.15 for 15%%")
+    args = parser.parse_args()
+
+    before, old = load(args.before)
+    after, new = load(args.after)
+    if before['shape'] != after['shape']:
+        print("warning: the runs used different inventory shapes", file=sys.stderr)
+    print(f"{(before['commit'] or '?')[:10]} -> {(after['commit'] or '?')[:10]}")
+    print(f"{'case':<28}{'median ms':>20}{'change':>9}{'queries':>12}{'peak KiB':>16}")
+    regressions = []
+    for name, result in new.items():
+        base = old.get(name)
+        if base is None:
+            print(f"{name:<28}{'':>11}{result['median_ms']:>9.2f}{'new':>9}")
+            continue
+        change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0.0
+        flag = ''
+        if change > args.threshold or result['queries'] > base['queries']:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f"{name:<28}{base['median_ms']:>11.2f}{result['median_ms']:>9.2f}{change:>+9.0%}"
+              f"{base['queries']:>6}{result['queries']:>6}{base['peak_kb']:>8.0f}{result['peak_kb']:>8.0f}{flag}")
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Load benchmark of the read endpoints under ASGI (uvicorn) and WSGI.
+
+Starts each server against the configured database, then keeps
+``--concurrency`` clients requesting the item, path, notes, history, list
+and search endpoints for ``--duration`` seconds, and prints the throughput
+and latency of each server side by side.
+
+    pip install uvicorn
+    python benchmarks/load.py --concurrency 64 --duration 20
+
+Both commands are templates receiving ``{port}``; pass ``--wsgi`` to
+compare against another WSGI server, e.g.
+``"gunicorn myproject.wsgi --threads 8 -b 127.0.0.1:{port}"``. Populate the
+database first: the item ids are discovered through GET /api/items.
+"""
+import argparse
+import json
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'asgi': "uvicorn myproject.asgi:application --no-access-log --port {port}",
+    'wsgi': "python manage.py runserver --noreload 127.0.0.1:{port}",
+}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not listen on port {port} within {timeout}s")
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return response.read()
+
+
+def discover_paths(base, sample):
+    """Builds the request mix from up to ``sample`` item ids"""
+    items = json.loads(get(f"{base}/api/items?fields=id,name&limit={sample}"))
+    if not items:
+        raise RuntimeError("The database has no items; populate it first")
+    paths = ["/api/items?fields=id,name&limit=50", f"/api/items/search?q={items[0]['name'].split()[0]}"]
+    for item in items:
+        paths += [f"/api/items/{item['id']}", f"/api/items/{item['id']}/path",
+                  f"/api/items/{item['id']}/notes", f"/api/items/{item['id']}/history"]
+    return paths
+
+
+def run_load(base, paths, concurrency, duration):
+    """Returns (latencies in seconds, error count) for ``duration`` seconds of load"""
+    stop = time.monotonic() + duration
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def client(offset):
+        nonlocal errors
+        mine = []
+        failed = 0
+        i = offset
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                get(base + paths[i % len(paths)])
+                mine.append(time.perf_counter() - started)
+            except (urllib.error.URLError, OSError):
+                failed += 1
+            i += 1
+        with lock:
+            latencies.extend(mine)
+            errors += failed
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def bench(name, command, port, args):
+    process = subprocess.Popen(shlex.split(command.format(port=port)), cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        base = f"http://127.0.0.1:{port}"
+        paths = discover_paths(base, args.sample)
+        run_load(base, paths, args.concurrency, min(2, args.duration))  # warm up caches and connections
+        latencies, errors = run_load(base, paths, args.concurrency, args.duration)
+    finally:
+        process.terminate()
+        process.wait(10)
+    return {
+        'server': name,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / args.duration,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else float('nan'),
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--asgi', default=SERVERS['asgi'], help="ASGI server command template")
+    parser.add_argument('--wsgi', default=SERVERS['wsgi'], help="WSGI server command template")
+    parser.add_argument('--only', choices=sorted(SERVERS), help="benchmark a single server")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of measured load per server")
+    parser.add_argument('--sample', type=int, default=20, help="items whose endpoints are requested")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    commands = {'asgi': args.asgi, 'wsgi': args.wsgi}
+    names = [args.only] if args.only else ['wsgi', 'asgi']
+    results = [bench(name, commands[name], args.port + i, args) for i, name in enumerate(names)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print(f"{args.concurrency} concurrent clients, {args.duration:g}s per server")
+    print(f"{'server':<8}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['server']:<8}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
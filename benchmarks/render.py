@@ -0,0 +1,132 @@
+"""
+CPU cost of serializing the inventory tree, stage by stage.
+
+    python -m benchmarks.render --depth 5 --fan-out 5 --emails 3
+
+Builds the full forest (GET /items) and the skeleton (GET /items/skeleton)
+once from a synthetic inventory, then measures the process CPU time of
+each way of turning them into a response body:
+
+* ``schema+json``: response schema validation then the standard library
+  encoder, as NinjaAPI does by default;
+* ``schema+orjson`` and ``schema+msgpack``: the same validation, then the
+  encoders of ``itemsapi.renderers``;
+* ``raw+orjson`` and ``raw+msgpack``: the ORM rows encoded without
+  validation, as GET /items/skeleton does.
+
+The savings are reported against ``schema+json`` of the same payload.
+"""
+import argparse
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+from benchmarks.run import setup_django
+
+
+def cpu_ms(function, iterations):
+    """Median process CPU time of ``function()`` in milliseconds, and its last result"""
+    timings = []
+    for _ in range(iterations):
+        started = time.process_time()
+        result = function()
+        timings.append(time.process_time() - started)
+    return statistics.median(timings) * 1000, result
+
+
+def strategies(schema):
+    """[(name, validate, encode)] for a payload of List[schema]"""
+    from ninja.renderers import JSONRenderer
+    from pydantic import create_model
+    from itemsapi import renderers
+
+    # NinjaAPI validates view results wrapped the same way
+    model = create_model(f"{schema.__name__}Response", response=(List[schema], ...))
+
+    def validate(data):
+        return model.model_validate({'response': data}).model_dump()['response']
+
+    def stdlib(data):
+        return JSONRenderer().render(None, data, response_status=200).encode()
+
+    def unvalidated(data):
+        return data
+
+    found = [('schema+json', validate, stdlib), ('schema+orjson', validate, renderers.dumps)]
+    if renderers.msgpack:
+        found.append(('schema+msgpack', validate, renderers.packb))
+    found.append(('raw+orjson', unvalidated, renderers.dumps))
+    if renderers.msgpack:
+        found.append(('raw+msgpack', unvalidated, renderers.packb))
+    return found
+
+
+def bench(label, data, schema, iterations):
+    results = []
+    for name, validate, encode in strategies(schema):
+        validate_ms, validated = cpu_ms(lambda: validate(data), iterations)
+        encode_ms, body = cpu_ms(lambda: encode(validated), iterations)
+        results.append({'payload': label, 'strategy': name, 'validate_ms': validate_ms, 'encode_ms': encode_ms,
+                        'cpu_ms': validate_ms + encode_ms, 'bytes': len(body)})
+    baseline = results[0]['cpu_ms']
+    for result in results:
+        result['saved'] = 1 - result['cpu_ms'] / baseline if baseline else 0.0
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--roots', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--notes', type=int, default=1, help="notes per item")
+    parser.add_argument('--emails', type=int, default=1, help="emails per item")
+    parser.add_argument('--codes', type=int, default=1, help="codes per item")
+    parser.add_argument('--email-size', type=int, default=2000, help="bytes per email body")
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    setup_django()
+    from asgiref.sync import async_to_sync
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+    from benchmarks import trees
+    from itemsapi import tree
+    from itemsapi.schemas import ItemOut, ItemSkeleton
+
+    shape = trees.Shape(roots=args.roots, depth=args.depth, fan_out=args.fan_out, notes=args.notes,
+                        emails=args.emails, codes=args.codes, email_size=args.email_size)
+    media = tempfile.mkdtemp()
+    setup_test_environment()
+    database = connection.creation.create_test_db(verbosity=0)
+    try:
+        with override_settings(MEDIA_ROOT=media, ITEMSAPI_THUMBNAIL_WORKERS=0):
+            trees.generate(shape, progress=lambda msg: print(f"generating: {msg}", file=sys.stderr))
+            forest = tree.trim(tree.build_forest(), tree.FULL)
+            skeleton = async_to_sync(tree.abuild_skeleton)()
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(media, ignore_errors=True)
+
+    results = bench('forest', forest, ItemOut, args.iterations)
+    results += bench('skeleton', skeleton, ItemSkeleton, args.iterations)
+    if args.json:
+        json.dump({'shape': shape._asdict(), 'items': shape.total_items(), 'results': results}, sys.stdout, indent=2)
+        print()
+        return
+    print(f"{shape.total_items()} items, median of {args.iterations} runs")
+    print(f"{'payload':<10}{'strategy':<16}{'validate ms':>12}{'encode ms':>11}{'CPU ms':>10}{'saved':>8}{'KiB':>10}")
+    for r in results:
+        print(f"{r['payload']:<10}{r['strategy']:<16}{r['validate_ms']:>12.1f}{r['encode_ms']:>11.1f}"
+              f"{r['cpu_ms']:>10.1f}{r['saved']:>+8.0%}{r['bytes'] / 1024:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Benchmarks every API route, plus Item.get_all_attachments,
+Item.get_inventory_tree and Item.validate_move, against a synthetic
+inventory.
+
+    python -m benchmarks.run --depth 5 --fan-out 5 --emails 3 --output before.json
+    python -m benchmarks.compare before.json after.json
+
+The inventory is generated (benchmarks.trees) in a throwaway test database
+of the configured engine. Each case is timed (wall clock and process CPU
+time) over ``--iterations`` runs after ``--warmup`` runs, then run once
+more to count its queries and measure its peak Python memory (tracemalloc
+slows code down, so that run is not timed). Every run happens in a transaction rolled back afterwards,
+so write routes always see the same data, and the response cache is
+flushed first unless ``--warm-cache`` is given.
+
+Results are written as JSON with the commit, environment and shape, so
+runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Case:
+    """One benchmarked call: an HTTP request through the test client, or a plain function"""
+
+    def __init__(self, name, method=None, path=None, body=None, call=None, multipart=False, setup=None, headers=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.call = call
+        self.multipart = multipart
+        self.headers = headers or {}
+        # Untimed preparation returning extra context, run in the same transaction
+        self.setup = setup
+
+    def run(self, client, ctx):
+        """Runs the case once and returns the HTTP status (None for functions)"""
+        if self.call:
+            self.call(ctx)
+            return None
+        kwargs = {'headers': self.headers} if self.headers else {}
+        if self.body is not None:
+            body = self.body(ctx)
+            kwargs.update({'data': body} if self.multipart else
+                          {'data': json.dumps(body), 'content_type': 'application/json'})
+        response = getattr(client, self.method.lower())(self.path.format(**ctx), **kwargs)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response.status_code
+
+
+def _upload(ctx):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    return {'file': SimpleUploadedFile("datasheet.pdf", b"%PDF-1.4 bench " * 4096, "application/pdf")}
+
+
+def _email(ctx, n=0):
+    return {'item_id': ctx['leaf'], 'subject': f"Order {n}", 'body': "Your order shipped. " * 50,
+            'from_address': "shop@example.com", 'received_at': "2025-01-01T10:00:00Z",
+            'qr_code': ctx['leaf_qr'], 'message_id': f"<bench-{n}@example.com>"}
+
+
+def _subtree(prefix, depth, fan_out):
+    return [{'name': f"{prefix}.{i}", 'children': _subtree(f"{prefix}.{i}", depth - 1, fan_out) if depth > 1 else []}
+            for i in range(fan_out)]
+
+
+def _pending_jobs(ctx):
+    from itemsapi import jobs
+    from itemsapi.models import Item
+    Item.objects.filter(listing_json__isnull=True).update(listing_json={}, listing_worker=jobs.PENDING)
+    return {}
+
+
+def _claimed_job(ctx):
+    from itemsapi import jobs
+    _pending_jobs(ctx)
+    return {'job': jobs.claim('bench')[0]}
+
+
+def _now(ctx):
+    from urllib.parse import quote
+    from django.utils import timezone
+    return {'now': quote(timezone.now().isoformat())}
+
+
+def _trashed(ctx):
+    from itemsapi import deletion
+    from itemsapi.models import Item
+    deletion.trash_subtree(Item.objects.get(pk=ctx['mid']))
+    return {}
+
+
+def _all_attachments(ctx):
+    from itemsapi.models import Item
+    for queryset in Item.objects.get(pk=ctx['root']).get_all_attachments().values():
+        list(queryset)
+
+
+def _validate_move(ctx):
+    from django.core.exceptions import ValidationError
+    from itemsapi.models import Item
+    items = Item.objects.in_bulk([ctx['root'], ctx['leaf']])
+    try:
+        items[ctx['root']].validate_move(items[ctx['leaf']])
+    except ValidationError:
+        pass
+
+
+def _inventory_tree(ctx):
+    from itemsapi.models import Item
+    tree = Item.objects.get(pk=ctx['root']).get_inventory_tree()
+    list(tree['children'])
+    for queryset in tree['attachments'].values():
+        list(queryset)
+
+
+CASES = [
+    Case('list_items', 'GET', "/api/items"),
+    Case('list_items[page]', 'GET', "/api/items?limit=50"),
+    Case('list_items[skeleton]', 'GET', "/api/items?fields=name&expand=children"),
+    Case('list_items[msgpack]', 'GET', "/api/items", headers={'Accept': "application/msgpack"}),
+    Case('get_skeleton', 'GET', "/api/items/skeleton"),
+    Case('export_items', 'GET', "/api/items/export"),
+    Case('export_items[json]', 'GET', "/api/items/export?format=json"),
+    Case('search_items', 'GET', "/api/items/search?q={q}"),
+    Case('bulk_create_items', 'POST', "/api/items/bulk",
+         body=lambda ctx: {'parent_id': ctx['mid'], 'items': _subtree("Imported", 3, 4)}),
+    Case('move_items', 'PUT', "/api/items/move-batch",
+         body=lambda ctx: {'moves': [{'item_id': ctx['mid'], 'new_parent_id': ctx['other_root']},
+                                     {'item_id': ctx['leaf'], 'new_parent_id': ctx['root']}]}),
+    Case('get_item', 'GET', "/api/items/{root}"),
+    Case('get_item[leaf]', 'GET', "/api/items/{leaf}"),
+    Case('get_item[msgpack]', 'GET', "/api/items/{root}", headers={'Accept': "application/msgpack"}),
+    Case('get_component_path', 'GET', "/api/items/{leaf}/path"),
+    Case('get_similar_components', 'GET', "/api/items/{mid}/siblings"),
+    Case('create_item', 'POST', "/api/items", body=lambda ctx: {'name': "New part", 'parent_id': ctx['mid']}),
+    Case('get_item_history', 'GET', "/api/items/{leaf}/history"),
+    Case('move_item', 'PUT', "/api/items/{mid}/move", body=lambda ctx: {'new_parent_id': ctx['other_root']}),
+    Case('delete_item', 'DELETE', "/api/items/{mid}"),
+    Case('delete_item[trash]', 'DELETE', "/api/items/{mid}?trash=true"),
+    Case('list_trash', 'GET', "/api/trash", setup=_trashed),
+    Case('restore_item', 'POST', "/api/trash/{mid}/restore", setup=_trashed),
+    Case('purge_trashed_item', 'DELETE', "/api/trash/{mid}", setup=_trashed),
+    Case('get_inventory_as_of', 'GET', "/api/items/as-of?at={now}", setup=_now),
+    Case('get_item_as_of', 'GET', "/api/items/{root}/as-of?at={now}", setup=_now),
+    Case('add_note', 'POST', "/api/items/{leaf}/notes", body=lambda ctx: {'content': "Checked", 'author': "bench"}),
+    Case('get_item_notes', 'GET', "/api/items/{leaf}/notes"),
+    Case('get_subtree_attachments', 'GET', "/api/items/{root}/attachments"),
+    Case('get_subtree_attachments[types]', 'GET', "/api/items/{root}/attachments?types=emails&limit=20"),
+    Case('update_listing', 'PUT', "/api/items/{leaf}/listing",
+         body=lambda ctx: {'listing_json': {'title': "Listing", 'price': 10, 'status': "active"}}),
+    Case('list_listings', 'GET', "/api/listings?status=active&sort=price&limit=50"),
+    Case('get_listing_job', 'GET', "/api/listing/job/bench", setup=_pending_jobs),
+    Case('get_listing_jobs', 'GET', "/api/listing/jobs/bench?count=50", setup=_pending_jobs),
+    Case('complete_listing_job', 'POST', "/api/listing/job/{job}/complete?worker_name=bench", setup=_claimed_job),
+    Case('upload_file', 'POST', "/api/items/{leaf}/files", body=_upload, multipart=True),
+    Case('create_email', 'POST', "/api/items/{leaf}/emails", body=_email),
+    Case('bulk_create_emails', 'POST', "/api/emails/bulk",
+         body=lambda ctx: {'route': True, 'emails': [_email(ctx, n) for n in range(200)]}),
+    # Anonymous, so only the staff check is measured
+    Case('get_metrics', 'GET', "/api/metrics"),
+    Case('Item.get_all_attachments', call=_all_attachments),
+    Case('Item.get_inventory_tree', call=_inventory_tree),
+    # Loads the root's tree geometry unless --warm-cache keeps it between runs
+    Case('Item.validate_move', call=_validate_move),
+]
+
+
+def setup_django():
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+    import django
+    django.setup()
+
+
+def uncovered_routes():
+    """Names of router views without a benchmark case"""
+    from itemsapi.routers import router
+    covered = {case.name.split('[')[0] for case in CASES}
+    views = {operation.view_func.__name__
+             for path_view in router.path_operations.values() for operation in path_view.operations}
+    return sorted(views - covered)
+
+
+def context(item_ids):
+    """Ids the cases are run against: a root, a mid-level node, a leaf and another tree's root"""
+    from itemsapi.models import Item
+    root = Item.objects.get(pk=item_ids[0])
+    leaf = Item.objects.filter(tree_id=root.tree_id).order_by('-level', 'lft').first()
+    mid = leaf.parent if leaf.parent_id and leaf.parent.parent_id else leaf
+    other = Item.objects.filter(parent__isnull=True).exclude(tree_id=root.tree_id).order_by('tree_id').first()
+    return {'root': root.pk, 'mid': mid.pk, 'leaf': leaf.pk, 'leaf_qr': leaf.qr_code,
+            'other_root': (other or root).pk, 'q': leaf.description.split()[0]}
+
+
+def measure(case, client, ctx, iterations, warmup, warm_cache):
+    from django.db import connection, transaction
+    from django.test.utils import CaptureQueriesContext
+    from itemsapi import cache
+
+    def once(queries=None):
+        """Runs the case in a rolled back transaction, returns (status, seconds, CPU seconds)"""
+        with transaction.atomic():
+            try:
+                if not warm_cache:
+                    cache.invalidate_all()
+                run_ctx = dict(ctx, **case.setup(ctx)) if case.setup else ctx
+                with nullcontext() if queries is None else queries:
+                    started, cpu_started = time.perf_counter(), time.process_time()
+                    status = case.run(client, run_ctx)
+                    return status, time.perf_counter() - started, time.process_time() - cpu_started
+            finally:
+                transaction.set_rollback(True)
+
+    for _ in range(warmup):
+        once()
+    runs = [once() for _ in range(iterations)]
+    timings = [seconds for _, seconds, _ in runs]
+
+    tracemalloc.start()
+    try:
+        queries = CaptureQueriesContext(connection)
+        status, _, _ = once(queries)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'name': case.name,
+        'method': case.method,
+        'path': case.path,
+        'status': status,
+        'iterations': iterations,
+        'median_ms': statistics.median(timings) * 1000,
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        'min_ms': timings[0] * 1000,
+        'cpu_ms': statistics.median(cpu for _, _, cpu in runs) * 1000,
+        'queries': len(queries.captured_queries),
+        'peak_kb': peak / 1024,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--roots', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--notes', type=int, default=1, help="notes per item")
+    parser.add_argument('--emails', type=int, default=1, help="emails per item")
+    parser.add_argument('--codes', type=int, default=1, help="codes per item")
+    parser.add_argument('--files', type=int, default=0, help="files per item")
+    parser.add_argument('--email-size', type=int, default=2000, help="bytes per email body")
+    parser.add_argument('--listing-size', type=int, default=0, help="bytes per listing_json (0: none)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--warm-cache', action='store_true', help="keep cached responses between runs")
+    parser.add_argument('--only', help="regular expression selecting cases by name")
+    parser.add_argument('--output', help="JSON results file (default: bench-<commit>.json)")
+    args = parser.parse_args()
+
+    setup_django()
+    import django
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+    from benchmarks import trees
+
+    missing = uncovered_routes()
+    if missing:
+        print(f"warning: no benchmark case for {', '.join(missing)}", file=sys.stderr)
+
+    shape = trees.Shape(roots=args.roots, depth=args.depth, fan_out=args.fan_out, notes=args.notes,
+                        emails=args.emails, codes=args.codes, files=args.files, email_size=args.email_size,
+                        listing_size=args.listing_size, seed=args.seed)
+    cases = [case for case in CASES if not args.only or re.search(args.only, case.name)]
+    media = tempfile.mkdtemp()
+    setup_test_environment()
+    database = connection.creation.create_test_db(verbosity=0)
+    try:
+        with override_settings(MEDIA_ROOT=media, ITEMSAPI_THUMBNAIL_WORKERS=0, ALLOWED_HOSTS=['*']):
+            started = time.perf_counter()
+            item_ids = trees.generate(shape, progress=lambda msg: print(f"generating: {msg}", file=sys.stderr))
+            generated_in = time.perf_counter() - started
+            ctx = context(item_ids)
+            client = Client()
+            results = []
+            for case in cases:
+                result = measure(case, client, ctx, args.iterations, args.warmup, args.warm_cache)
+                results.append(result)
+                print(f"{result['name']:<28}{result['median_ms']:>10.2f} ms{result['cpu_ms']:>10.2f} ms CPU"
+                      f"{result['queries']:>6} queries{result['peak_kb']:>10.0f} KiB  [{result['status'] or '-'}]",
+                      file=sys.stderr)
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(media, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'shape': shape._asdict(),
+        'items': len(item_ids),
+        'generate_s': generated_in,
+        'warm_cache': args.warm_cache,
+        'results': results,
+    }
+    output = args.output or f"bench-{(commit or 'unknown')[:10]}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
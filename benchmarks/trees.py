@@ -0,0 +1,147 @@
+"""
+Synthetic inventories for benchmarks.
+
+A ``Shape`` describes the inventory: ``roots`` trees, each ``depth`` levels
+deep with ``fan_out`` children per node, every node carrying the given
+number of notes, emails, codes and files. Items are written with
+``bulk.import_items`` and attachments with ``bulk_create``; the bookkeeping
+signals would do (attachment counters, search index, blob reference
+counts, response cache) runs once at the end. Generation is seeded, so the
+same shape always yields the same inventory.
+"""
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import NamedTuple
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from itemsapi import blobs, bulk, cache, jobs, search
+from itemsapi.models import LISTING_STATUSES, Blob, CodeIdentifier, Email, File, Item, Note
+
+WORDS = (
+    'cpu', 'gpu', 'ram', 'ssd', 'hdd', 'psu', 'fan', 'cooler', 'board', 'cable', 'screen', 'keyboard',
+    'battery', 'charger', 'hinge', 'speaker', 'camera', 'sensor', 'thermal', 'paste', 'screw', 'bracket',
+    'dell', 'lenovo', 'asus', 'acer', 'samsung', 'intel', 'amd', 'nvidia', 'kingston', 'crucial',
+)
+KINDS = ('Rack', 'Shelf', 'Laptop', 'Board', 'Module', 'Part', 'Piece')
+MARKETPLACES = ('ebay', 'leboncoin', 'backmarket')
+BATCH_SIZE = 1000
+
+
+class Shape(NamedTuple):
+    roots: int = 4
+    depth: int = 4
+    fan_out: int = 4
+    notes: int = 1
+    emails: int = 1
+    codes: int = 1
+    files: int = 0
+    # Bytes of each email body and listing_json (0: items have no listing)
+    email_size: int = 2000
+    listing_size: int = 0
+    # Distinct file contents shared by the generated files, as real vendor PDFs are
+    distinct_files: int = 10
+    seed: int = 0
+
+    def items_per_root(self):
+        return sum(self.fan_out ** level for level in range(self.depth))
+
+    def total_items(self):
+        return self.roots * self.items_per_root()
+
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def _entry(rng, label, level, shape):
+    name = f"{KINDS[min(level, len(KINDS) - 1)]} {label}"
+    children = [] if level + 1 >= shape.depth else [
+        _entry(rng, f"{label}.{i}", level + 1, shape) for i in range(shape.fan_out)
+    ]
+    return SimpleNamespace(name=name, description=_text(rng, 60), qr_code=f"QR{label.replace('.', '')}{level}",
+                           ref=None, parent_ref=None, parent_id=None, children=children)
+
+
+def _listing(rng, size):
+    listing = {'title': _text(rng, 40), 'price': rng.randint(5, 900), 'currency': 'EUR',
+               'status': rng.choice(LISTING_STATUSES), 'marketplace': rng.choice(MARKETPLACES), 'description': ''}
+    listing['description'] = _text(rng, max(0, size - len(json.dumps(listing))))
+    return listing
+
+
+def _attachments(rng, item_ids, shape, file_blobs):
+    """Yields unsaved attachment rows per model, ``BATCH_SIZE`` item ids at a time"""
+    received = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for start in range(0, len(item_ids), BATCH_SIZE):
+        rows = {Note: [], Email: [], CodeIdentifier: [], File: []}
+        for pk in item_ids[start:start + BATCH_SIZE]:
+            for n in range(shape.notes):
+                rows[Note].append(Note(item_id=pk, content=_text(rng, 120), author="bench"))
+            for n in range(shape.emails):
+                email = Email(item_id=pk, subject=_text(rng, 50), body=_text(rng, shape.email_size),
+                              from_address="vendor@example.com", received_at=received + timedelta(minutes=pk * 7 + n),
+                              message_id=f"<{pk}.{n}@bench.example.com>")
+                email.content_hash = email.compute_content_hash()
+                rows[Email].append(email)
+            for n in range(shape.codes):
+                rows[CodeIdentifier].append(CodeIdentifier(item_id=pk, code=f"SN{pk:07d}{n}", source="label"))
+            for n in range(shape.files):
+                blob, file_type = file_blobs[rng.randrange(len(file_blobs))]
+                rows[File].append(File(item_id=pk, file=blob.name, file_type=file_type, blob=blob))
+        yield rows
+
+
+def _file_blobs(rng, shape):
+    """Stores ``distinct_files`` contents once and returns [(blob, file_type)]"""
+    if not shape.files:
+        return []
+    stored = []
+    for n in range(shape.distinct_files):
+        image = n % 2 == 0
+        content = ContentFile(_text(rng, 4000).encode(), name=f"sample{n}.{'png' if image else 'pdf'}")
+        stored.append((Blob.objects.store(content), 'image/png' if image else 'application/pdf'))
+    return stored
+
+
+def generate(shape=Shape(), progress=None):
+    """Creates the inventory described by ``shape``; returns the created item ids in tree order"""
+    rng = random.Random(shape.seed)
+    if shape.items_per_root() > bulk.MAX_ITEMS:
+        raise ValueError(f"A tree of this shape has more than {bulk.MAX_ITEMS} items")
+    item_ids = []
+    with transaction.atomic():
+        for root in range(shape.roots):
+            created, _ = bulk.import_items([_entry(rng, str(root), 0, shape)])
+            item_ids.extend(item.pk for item in created)
+            if progress:
+                progress(f"{len(item_ids)}/{shape.total_items()} items")
+
+        if shape.listing_size:
+            for start in range(0, len(item_ids), BATCH_SIZE):
+                chunk = item_ids[start:start + BATCH_SIZE]
+                Item.objects.bulk_update(
+                    [Item(pk=pk, listing_json=_listing(rng, shape.listing_size), listing_worker=jobs.PENDING)
+                     for pk in chunk], ['listing_json', 'listing_worker'], batch_size=BATCH_SIZE)
+
+        file_blobs = _file_blobs(rng, shape)
+        for rows in _attachments(rng, item_ids, shape, file_blobs):
+            for model, objs in rows.items():
+                model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+        if progress:
+            progress("attachments written")
+
+        Item.objects.recount_attachments()
+        blobs.recount()
+        search.rebuild()
+    cache.invalidate_all()
+    return list(Item.objects.filter(pk__in=item_ids).order_by('tree_id', 'lft').values_list('pk', flat=True))
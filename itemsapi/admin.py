@@ -6,7 +6,7 @@ from .models import Item, ComponentHistory, Note, File, Email, CodeIdentifier
 class ComponentHistoryAdmin(admin.ModelAdmin):
     list_display = ('item', 'action_type', 'old_parent', 'new_parent', 'changed_at')
     list_filter = ('action_type', 'changed_at')
-    search_fields = ('item__name', 'old_parent__name', 'new_parent__name')
+    search_fields = ('item__name', 'item_name', 'old_parent__name', 'new_parent__name')
     date_hierarchy = 'changed_at'
 
 @admin.register(Item)
@@ -1,12 +1,22 @@
 from ninja import NinjaAPI
-from .routers import router
+from . import renderers
+from .routers import RENDERER, router
 import sys
 
+
+class InventoryAPI(NinjaAPI):
+    def create_response(self, request, data, *, status=None, temporal_response=None):
+        response = super().create_response(request, data, status=status, temporal_response=temporal_response)
+        # The renderer negotiates JSON or MessagePack per request
+        return renderers.set_content_type(request, response)
+
+
 is_testing = 'test' in sys.argv
-api = NinjaAPI(
+api = InventoryAPI(
     urls_namespace='inventory_api',
     docs_url="/docs",  # This enables Swagger UI at /api/docs
     title="Inventory API",
     description="API for managing repair shop inventory and components",
+    renderer=RENDERER,
 )
-api.add_router('', router)
\ No newline at end of file
+api.add_router('', router)
@@ -0,0 +1,112 @@
+"""
+Attachments of a whole subtree.
+
+Every attachment table is joined to its item and restricted to the
+subtree's nested-set range (``tree_id`` and ``lft BETWEEN lft AND rght``,
+served by the (tree_id, lft) index), so the ids of the descendants never
+travel through Python. The page is one UNION ALL of the selected types
+ordered newest first, keyed by (created_at, type, id); the counts per type
+are one grouped UNION ALL; then one query per type present on the page
+loads the rows returned.
+"""
+from datetime import datetime
+
+from django.db.models import CharField, Count, Q, Value
+from ninja.errors import HttpError
+
+from .models import COUNTED_ATTACHMENTS
+from .pagination import decode_cursor, encode_cursor
+from .tree import ATTACHMENT_FIELDS, _serialize_file
+
+TYPES = COUNTED_ATTACHMENTS
+# Key of each attachment in a result entry
+SINGULAR = {'notes': 'note', 'files': 'file', 'emails': 'email', 'codes': 'code'}
+
+
+def parse_types(types):
+    """Returns the attachment types named in the comma separated ``types`` (all when empty), in TYPES order"""
+    if not types:
+        return TYPES
+    names = {name.strip() for name in types.split(',') if name.strip()}
+    unknown = names - set(TYPES)
+    if unknown:
+        raise ValueError(f"Unknown attachment types: {', '.join(sorted(unknown))}")
+    return tuple(name for name in TYPES if name in names)
+
+
+def _branch(item, related_name):
+    model = ATTACHMENT_FIELDS[related_name][0]
+    return model.objects.filter(item.subtree_q()).order_by().annotate(
+        type=Value(related_name, output_field=CharField()))
+
+
+def _after(related_name, cursor):
+    """Q selecting the rows of ``related_name`` after ``cursor`` in (-created_at, type, -id) order"""
+    created_at, cursor_type, cursor_id = cursor
+    if related_name < cursor_type:
+        return Q(created_at__lt=created_at)
+    if related_name > cursor_type:
+        return Q(created_at__lte=created_at)
+    return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=cursor_id)
+
+
+def _decode(cursor):
+    values = decode_cursor(cursor)
+    try:
+        created_at, cursor_type, cursor_id = values
+        return datetime.fromisoformat(created_at), str(cursor_type), int(cursor_id)
+    except (TypeError, ValueError):
+        raise HttpError(422, "Invalid cursor")
+
+
+def counts(item, types=TYPES):
+    """Returns {type: number of attachments in the subtree of ``item``}"""
+    branches = [_branch(item, name).values('type').annotate(n=Count('id')) for name in types]
+    result = dict.fromkeys(types, 0)
+    result.update((row['type'], row['n']) for row in branches[0].union(*branches[1:], all=True))
+    return result
+
+
+def _details(keys):
+    """Loads the serialized rows for [(type, id)], keyed the same way"""
+    ids = {}
+    for related_name, pk in keys:
+        ids.setdefault(related_name, []).append(pk)
+    rows = {}
+    for related_name, pks in ids.items():
+        model, fields = ATTACHMENT_FIELDS[related_name]
+        for row in model.objects.filter(pk__in=pks).values(*fields):
+            rows[related_name, row['id']] = _serialize_file(row) if related_name == 'files' else row
+    return rows
+
+
+def page(item, types=TYPES, cursor=None, limit=100):
+    """Returns (entries, next_cursor) for the attachments of the subtree of ``item``, newest first"""
+    after = _decode(cursor) if cursor else None
+    branches = []
+    for name in types:
+        branch = _branch(item, name)
+        if after:
+            branch = branch.filter(_after(name, after))
+        branches.append(branch.values('type', 'id', 'item_id', 'created_at'))
+    keys = list(branches[0].union(*branches[1:], all=True).order_by('-created_at', 'type', '-id')[:limit + 1])
+
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        last = keys[-1]
+        next_cursor = encode_cursor([last['created_at'].isoformat(), last['type'], last['id']])
+
+    rows = _details((key['type'], key['id']) for key in keys)
+    entries = [
+        {'type': key['type'], 'item_id': key['item_id'], 'created_at': key['created_at'],
+         SINGULAR[key['type']]: rows[key['type'], key['id']]}
+        for key in keys
+    ]
+    return entries, next_cursor
+
+
+def subtree(item, types=TYPES, cursor=None, limit=100):
+    """Returns ({'counts', 'results'}, next_cursor) for the attachments under ``item``"""
+    entries, next_cursor = page(item, types, cursor, limit)
+    return {'counts': counts(item, types), 'results': entries}, next_cursor
@@ -0,0 +1,143 @@
+"""
+Content-addressed attachment storage.
+
+File contents are stored once per SHA-256 under ``blobs/`` (see
+``Blob.objects.store``), so the same vendor PDF attached to a thousand items
+takes the space of one. ``Blob.ref_count`` counts the File rows sharing a
+blob; deleting the last of them leaves the blob in place until
+``collect_garbage`` runs (``manage.py gc_blobs``), which also deletes the
+files an upload wrote before its transaction rolled back. Its grace period
+counts from the blob's ``last_referenced_at``, refreshed whenever an upload
+reuses it.
+
+``HashingUploadHandler`` streams every upload to a temporary file while
+hashing it, so uploads are never held in memory and the file is moved, not
+copied, into the store.
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File as StoredFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import cache
+from .models import BLOB_DIR, Blob, File, derivative_name
+
+BATCH_SIZE = 500
+
+
+def grace_seconds():
+    """Age below which unreferenced blobs are kept, so uploads in flight are not collected"""
+    return getattr(settings, 'ITEMSAPI_BLOB_GRACE_SECONDS', 3600)
+
+
+def storage():
+    return File._meta.get_field('file').storage
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """Streams uploads to a temporary file and hashes them on the way"""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        upload = super().file_complete(file_size)
+        upload.sha256 = self.hasher.hexdigest()
+        return upload
+
+
+def recount():
+    """Recomputes every ``ref_count`` from the File rows"""
+    references = (File.objects.filter(blob=OuterRef('pk')).order_by()
+                  .values('blob').annotate(count=Count('pk')).values('count'))
+    return Blob.objects.update(ref_count=Coalesce(Subquery(references), 0))
+
+
+def adopt_legacy_files(batch_size=BATCH_SIZE):
+    """
+    Moves files stored under ``attachments/`` before the blob store into it,
+    deleting the original copies; returns how many File rows were moved.
+    Rows whose file is missing from storage are left alone.
+    """
+    files = storage()
+    adopted = 0
+    last_id = 0
+    while True:
+        rows = list(File.objects.filter(blob__isnull=True, id__gt=last_id).exclude(file='')
+                    .order_by('id').values_list('id', 'item_id', 'file')[:batch_size])
+        if not rows:
+            return adopted
+        last_id = rows[-1][0]
+        for pk, item_id, name in rows:
+            if not files.exists(name):
+                continue
+            with files.open(name) as content:
+                blob = Blob.objects.store(StoredFile(content, name=name))
+            with transaction.atomic():
+                File.objects.filter(pk=pk).update(blob=blob, file=blob.name)
+                Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+            if name != blob.name:
+                files.delete(name)
+            cache.invalidate_items([item_id])
+            adopted += 1
+
+
+def _stray_files(cutoff):
+    """Yields the names under ``blobs/`` no Blob row holds, last written before ``cutoff``"""
+    files = storage()
+    pending = [BLOB_DIR]
+    while pending:
+        directory = pending.pop()
+        if not files.exists(directory):
+            continue
+        subdirectories, names = files.listdir(directory)
+        pending.extend(f"{directory}/{name}" for name in subdirectories)
+        names = [f"{directory}/{name}" for name in names]
+        for start in range(0, len(names), BATCH_SIZE):
+            batch = names[start:start + BATCH_SIZE]
+            held = set(Blob.objects.filter(name__in=batch).values_list('name', flat=True))
+            for name in batch:
+                if name not in held and files.get_modified_time(name) <= cutoff:
+                    yield name
+
+
+def collect_garbage(grace=None, dry_run=False):
+    """
+    Deletes the blobs no File references any more, with their derivatives,
+    and the stored files left without a Blob row by rolled back uploads;
+    returns (blobs deleted, bytes freed).
+    """
+    seconds = grace_seconds() if grace is None else grace
+    cutoff = timezone.now() - timedelta(seconds=seconds)
+    orphans = Blob.objects.filter(ref_count__lte=0, last_referenced_at__lte=cutoff, files__isnull=True)
+    deleted = freed = 0
+    files = storage()
+    for blob in list(orphans.values('sha256', 'name', 'size')):
+        # Re-checked per blob: an upload may have picked it up, refreshing last_referenced_at, since the query
+        if not dry_run and not orphans.filter(pk=blob['sha256']).delete()[0]:
+            continue
+        if not dry_run:
+            files.delete(blob['name'])
+            # Storage backends ignore missing names, as for blobs whose derivatives were never made
+            for kind in Blob.DERIVATIVES:
+                files.delete(derivative_name(blob['sha256'], kind))
+        deleted += 1
+        freed += blob['size']
+    for name in list(_stray_files(cutoff)):
+        size = files.size(name)
+        if not dry_run:
+            files.delete(name)
+        deleted += 1
+        freed += size
+    return deleted, freed
@@ -0,0 +1,262 @@
+"""
+Bulk item import and moves.
+
+Imported items get their MPTT coordinates and materialized paths computed in
+memory and are inserted with ``bulk_create``, one batch per tree depth,
+instead of one ``save()`` (and one tree renumbering) per item. New trees are
+appended after the existing ones; an existing tree receiving items is opened
+once per parent and only re-sorted (``partial_rebuild``) when the new items
+must be interleaved with existing children. History rows and search index
+entries are written in bulk as well (history rows with the transaction's
+other history, at commit), and the response cache and the geometry of the
+trees written are invalidated once, when the transaction commits.
+
+Batch moves rewrite the ``parent``/``tree_id`` columns of the affected rows
+with one ``bulk_update`` and renumber each affected tree once.
+"""
+from collections import defaultdict
+
+from django.db.models import F, Max
+
+from . import cache, geometry, history, search
+from .models import Item, ComponentHistory, PATH_SEPARATOR
+
+MAX_ITEMS = 10000
+BATCH_SIZE = 500
+
+
+class BulkImportError(ValueError):
+    pass
+
+
+class BulkMoveError(ValueError):
+    pass
+
+
+class _Node:
+    __slots__ = ('fields', 'children', 'parent', 'parent_id', 'ref', 'parent_ref', 'obj')
+
+    def __init__(self, entry, parent):
+        self.ref = entry.ref
+        self.fields = {'name': entry.name, 'description': entry.description, 'qr_code': entry.qr_code}
+        self.children = []
+        self.parent = parent
+        self.parent_id = entry.parent_id if parent is None else None
+        self.parent_ref = entry.parent_ref if parent is None else None
+        self.obj = None
+
+
+def _collect(entries, parent_id):
+    """Flattens nested and parent-referencing entries into nodes and returns (nodes, roots)"""
+    nodes = []
+    by_ref = {}
+
+    def add(entry, parent):
+        node = _Node(entry, parent)
+        nodes.append(node)
+        if node.ref is not None:
+            if node.ref in by_ref:
+                raise BulkImportError(f"Duplicate ref '{entry.ref}'")
+            by_ref[node.ref] = node
+        for child in entry.children:
+            node.children.append(add(child, node))
+        return node
+
+    top = [add(entry, None) for entry in entries]
+    if len(nodes) > MAX_ITEMS:
+        raise BulkImportError(f"At most {MAX_ITEMS} items can be imported at once")
+
+    roots = []
+    for node in top:
+        if node.parent_ref is None:
+            node.parent_id = node.parent_id or parent_id
+            roots.append(node)
+            continue
+        if node.parent_id is not None:
+            raise BulkImportError("An item cannot have both parent_id and parent_ref")
+        parent = by_ref.get(node.parent_ref)
+        if parent is None:
+            raise BulkImportError(f"Unknown parent_ref '{node.parent_ref}'")
+        node.parent = parent
+        parent.children.append(node)
+
+    reachable = 0
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        reachable += 1
+        stack.extend(node.children)
+    if reachable != len(nodes):
+        raise BulkImportError("parent_ref links form a cycle")
+    return nodes, roots
+
+
+def _layout(node, cursor, level, tree_id, depths):
+    """Assigns MPTT coordinates depth-first with children in name order, returns the next cursor"""
+    node.children.sort(key=lambda child: child.fields['name'])
+    node.fields.update(tree_id=tree_id, lft=cursor, level=level)
+    depths[level].append(node)
+    cursor += 1
+    for child in node.children:
+        cursor = _layout(child, cursor, level + 1, tree_id, depths)
+    node.fields['rght'] = cursor
+    return cursor + 1
+
+
+def _size(node):
+    return 1 + sum(_size(child) for child in node.children)
+
+
+def import_items(entries, parent_id=None):
+    """Creates the items described by ``entries``; returns the created Items in payload order and {ref: id}"""
+    nodes, roots = _collect(entries, parent_id)
+    if not nodes:
+        return [], {}
+
+    by_parent = defaultdict(list)
+    for root in roots:
+        by_parent[root.parent_id].append(root)
+    existing_ids = [pk for pk in by_parent if pk is not None]
+    missing = set(existing_ids) - set(Item.objects.filter(pk__in=existing_ids).values_list('pk', flat=True))
+    if missing:
+        raise BulkImportError(f"Unknown parent_id: {', '.join(map(str, sorted(missing)))}")
+
+    depths = defaultdict(list)
+    resort_trees = set()
+    sizes = {pk: 2 * sum(_size(root) for root in by_parent[pk]) for pk in existing_ids}
+    for pk in existing_ids:
+        # Reloaded per parent: opening a gap shifts coordinates elsewhere in the tree
+        parent = Item.objects.only('tree_id', 'rght').get(pk=pk)
+        Item.objects.filter(tree_id=parent.tree_id, rght__gte=parent.rght).update(rght=F('rght') + sizes[pk])
+        Item.objects.filter(tree_id=parent.tree_id, lft__gt=parent.rght).update(lft=F('lft') + sizes[pk])
+    # Laid out once every gap is open, as a later gap may shift an earlier one; each gap ends at its parent's rght
+    parents = Item.objects.in_bulk(existing_ids)
+    for pk in existing_ids:
+        parent = parents[pk]
+        cursor = parent.rght - sizes[pk]
+        if cursor - parent.lft > 1:
+            # New children must be interleaved with existing ones
+            resort_trees.add(parent.tree_id)
+        for root in sorted(by_parent[pk], key=lambda node: node.fields['name']):
+            cursor = _layout(root, cursor, parent.level + 1, parent.tree_id, depths)
+
+    trees = {parent.tree_id for parent in parents.values()}
+    next_tree_id = (Item.objects.aggregate(top=Max('tree_id'))['top'] or 0) + 1
+    for tree_id, root in enumerate(sorted(by_parent.get(None, []), key=lambda n: n.fields['name']), next_tree_id):
+        _layout(root, 1, 0, tree_id, depths)
+        trees.add(tree_id)
+
+    for level in sorted(depths):
+        batch = []
+        for node in depths[level]:
+            if node.parent is not None:
+                parent_id, parent_path = node.parent.obj.pk, node.parent.obj.full_path
+            elif node.parent_id is not None:
+                parent_id, parent_path = node.parent_id, parents[node.parent_id].full_path
+            else:
+                parent_id, parent_path = None, None
+            node.fields['full_path'] = (
+                f"{parent_path}{PATH_SEPARATOR}{node.fields['name']}" if parent_path else node.fields['name']
+            )
+            node.obj = Item(parent_id=parent_id, **node.fields)
+            batch.append(node.obj)
+        Item.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+
+    created = [node.obj for node in nodes]
+    for level in sorted(depths):
+        for node in depths[level]:
+            if node.parent is not None:
+                prefix = node.parent.obj.path_ids
+            elif node.parent_id is not None:
+                prefix = parents[node.parent_id].path_ids
+            else:
+                prefix = None
+            node.obj.path_ids = f"{prefix}{PATH_SEPARATOR}{node.obj.pk}" if prefix else str(node.obj.pk)
+    Item.objects.bulk_update(created, ['path_ids'], batch_size=BATCH_SIZE)
+
+    for tree_id in resort_trees:
+        Item.objects.partial_rebuild(tree_id)
+
+    history.record([(obj.pk, None, obj.parent_id, ComponentHistory.CREATED) for obj in created])
+    search.reindex([obj.pk for obj in created])
+    cache.invalidate_all()
+    geometry.invalidate(trees)
+    return created, {node.ref: node.obj.pk for node in nodes if node.ref is not None}
+
+
+def _root_of(pk, parents, roots):
+    """Follows ``parents`` up from ``pk`` and returns its root, memoized in ``roots``"""
+    path = []
+    while pk not in roots:
+        path.append(pk)
+        parent_id = parents[pk]
+        if parent_id is None:
+            roots[pk] = pk
+            break
+        pk = parent_id
+    for node in path:
+        roots[node] = roots[pk]
+    return roots[pk]
+
+
+def move_items(moves):
+    """
+    Moves every ``(item_id, new_parent_id)`` pair, a None parent making the
+    item a root. Returns the ids of the items whose parent changed, in
+    request order.
+    """
+    targets = {}
+    for item_id, new_parent_id in moves:
+        if item_id in targets:
+            raise BulkMoveError(f"Item {item_id} is moved more than once")
+        targets[item_id] = new_parent_id
+    if not targets:
+        return []
+
+    known = Item.objects.in_bulk(set(targets) | {pk for pk in targets.values() if pk is not None})
+    missing = sorted((set(targets) | set(targets.values())) - set(known) - {None})
+    if missing:
+        raise BulkMoveError(f"Unknown item id: {', '.join(map(str, missing))}")
+    moved = [pk for pk, parent_id in targets.items() if known[pk].parent_id != parent_id]
+    if not moved:
+        return []
+
+    trees = {known[pk].tree_id for pk in targets.keys() | targets.values() if pk is not None}
+    rows = Item.objects.filter(tree_id__in=trees).values_list('id', 'parent_id', 'tree_id')
+    old_parents = {pk: parent_id for pk, parent_id, _ in rows}
+    old_trees = {pk: tree_id for pk, _, tree_id in rows}
+    parents = dict(old_parents)
+    parents.update(targets)
+
+    for pk in moved:
+        seen = {pk}
+        ancestor = parents[pk]
+        while ancestor is not None:
+            if ancestor in seen:
+                raise BulkMoveError(f"Cannot move item {pk} under its own descendant")
+            seen.add(ancestor)
+            ancestor = parents[ancestor]
+
+    # Items moved to the top level start new trees, appended in name order
+    new_roots = sorted((pk for pk in moved if targets[pk] is None), key=lambda pk: (known[pk].name, pk))
+    next_tree_id = (Item.objects.aggregate(top=Max('tree_id'))['top'] or 0) + 1
+    root_trees = {pk: tree_id for tree_id, pk in enumerate(new_roots, next_tree_id)}
+
+    roots = {}
+    changed = []
+    for pk in parents:
+        root = _root_of(pk, parents, roots)
+        tree_id = root_trees.get(root, old_trees[root])
+        if parents[pk] != old_parents[pk] or tree_id != old_trees[pk]:
+            changed.append(Item(pk=pk, parent_id=parents[pk], tree_id=tree_id))
+    Item.objects.bulk_update(changed, ['parent', 'tree_id'], batch_size=BATCH_SIZE)
+
+    # rebuild() also refreshes the materialized paths of each tree it renumbers
+    trees |= set(root_trees.values())
+    for tree_id in sorted(trees):
+        Item.objects.partial_rebuild(tree_id)
+
+    history.record([(pk, old_parents[pk], targets[pk], ComponentHistory.MOVED) for pk in moved])
+    cache.invalidate_all()
+    geometry.invalidate(trees)
+    return moved
@@ -0,0 +1,226 @@
+"""
+Response cache for item reads.
+
+Payloads are stored in the Django cache named by ``ITEMSAPI_CACHE``
+(local memory by default, Redis or any other backend through ``CACHES``).
+Every entry is keyed by version tokens rather than deleted on writes:
+
+* one token per item, replaced whenever the item, one of its descendants or
+  one of its attachments changes, so a write invalidates exactly the
+  subtree payloads of its ancestors (and its own descendants when it is
+  moved or renamed);
+* one token for the root listing, replaced on every write;
+* one epoch token covering everything, replaced by bulk operations that
+  bypass model signals;
+* one token per tree versioning its geometry (itemsapi.geometry), replaced
+  when an item of the tree is created, moved, renamed or deleted, and one
+  covering every tree, replaced when tree ids may have been renumbered.
+
+Tokens are random, so a token evicted from the cache can never bring an old
+entry back. They are replaced when the writing transaction commits: a read
+running meanwhile still sees the old rows, which must not be stored under
+the new tokens. The tokens of an entry and the negotiated encoding form its
+ETag, which lets If-None-Match requests be answered with a 304 before any
+payload is built.
+
+The ``a``-prefixed functions are the same reads for the async views.
+"""
+import hashlib
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from . import renderers
+from .models import Item, PATH_SEPARATOR
+
+PREFIX = 'itemsapi'
+EPOCH = 'epoch'
+LIST = 'list'
+GEOMETRY = 'geometry'
+
+
+def backend():
+    return caches[getattr(settings, 'ITEMSAPI_CACHE', 'default')]
+
+
+def timeout():
+    return getattr(settings, 'ITEMSAPI_CACHE_TIMEOUT', 300)
+
+
+def _token_key(name):
+    return f"{PREFIX}:v:{name}"
+
+
+def _new_token():
+    return uuid.uuid4().hex[:12]
+
+
+def _tokens(names):
+    """Returns the current token of each name, creating the missing ones"""
+    keys = {name: _token_key(name) for name in names}
+    found = backend().get_many(keys.values())
+    tokens = {name: found.get(key) for name, key in keys.items()}
+    missing = {keys[name]: _new_token() for name, token in tokens.items() if token is None}
+    if missing:
+        backend().set_many(missing, None)
+        tokens.update({name: missing[keys[name]] for name, token in tokens.items() if token is None})
+    return [tokens[name] for name in names]
+
+
+async def _atokens(names):
+    keys = {name: _token_key(name) for name in names}
+    found = await backend().aget_many(keys.values())
+    tokens = {name: found.get(key) for name, key in keys.items()}
+    missing = {keys[name]: _new_token() for name, token in tokens.items() if token is None}
+    if missing:
+        await backend().aset_many(missing, None)
+        tokens.update({name: missing[keys[name]] for name, token in tokens.items() if token is None})
+    return [tokens[name] for name in names]
+
+
+def _replace_tokens(names):
+    backend().set_many({_token_key(name): _new_token() for name in names}, None)
+
+
+def _bump(names):
+    """Replaces the tokens of ``names`` when the current transaction commits (at once outside a transaction)"""
+    transaction.on_commit(partial(_replace_tokens, list(names)))
+
+
+def _item_names(item_id):
+    return [EPOCH, f"item:{item_id}"]
+
+
+def _path_names(item):
+    root_id = item.path_ids.split(PATH_SEPARATOR, 1)[0]
+    return [EPOCH, f"item:{root_id}"]
+
+
+def _list_prefix(query_string):
+    return f"list:{hashlib.sha1(query_string.encode()).hexdigest()[:16]}:"
+
+
+def item_key(item_id):
+    """Key of GET /items/{id}: the item's subtree"""
+    return f"item:{item_id}:" + ':'.join(_tokens(_item_names(item_id)))
+
+
+def path_key(item):
+    """Key of GET /items/{id}/path: the subtrees of every ancestor, all covered by the root's token"""
+    return f"path:{item.pk}:" + ':'.join(_tokens(_path_names(item)))
+
+
+def list_key(query_string):
+    """Key of GET /items for one set of query parameters"""
+    return _list_prefix(query_string) + ':'.join(_tokens([EPOCH, LIST]))
+
+
+async def aitem_key(item_id):
+    return f"item:{item_id}:" + ':'.join(await _atokens(_item_names(item_id)))
+
+
+async def apath_key(item):
+    return f"path:{item.pk}:" + ':'.join(await _atokens(_path_names(item)))
+
+
+async def alist_key(query_string):
+    return _list_prefix(query_string) + ':'.join(await _atokens([EPOCH, LIST]))
+
+
+def _etag(request, key):
+    # Payloads are cached before encoding, but each encoding is a distinct representation
+    encoding = 'msgpack' if renderers.media_type(request) == renderers.MSGPACK else 'json'
+    return '"%s-%s"' % (key.replace(':', '-'), encoding)
+
+
+def _not_modified(request, etag):
+    if etag in request.headers.get('If-None-Match', ''):
+        not_modified = HttpResponseNotModified()
+        not_modified['ETag'] = etag
+        patch_vary_headers(not_modified, ['Accept'])
+        return not_modified
+    return None
+
+
+def respond(request, response, key, build):
+    """
+    Returns the payload cached under ``key``, building and storing it on a
+    miss, or a 304 when the client already holds it in the negotiated
+    encoding. ``response`` receives the ETag.
+    """
+    etag = _etag(request, key)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    cache_key = f"{PREFIX}:{key}"
+    payload = backend().get(cache_key)
+    if payload is None:
+        payload = build()
+        backend().set(cache_key, payload, timeout())
+    response['ETag'] = etag
+    return payload
+
+
+async def arespond(request, response, key, build):
+    """``respond`` with ``build`` returning an awaitable"""
+    etag = _etag(request, key)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    cache_key = f"{PREFIX}:{key}"
+    payload = await backend().aget(cache_key)
+    if payload is None:
+        payload = await build()
+        await backend().aset(cache_key, payload, timeout())
+    response['ETag'] = etag
+    return payload
+
+
+def _ancestor_ids(path_ids):
+    return [int(pk) for pk in path_ids.split(PATH_SEPARATOR) if pk]
+
+
+def invalidate_path(path_ids):
+    """Invalidates the item at ``path_ids`` ("1/.../id") and its ancestors"""
+    _bump([f"item:{pk}" for pk in _ancestor_ids(path_ids)] + [LIST])
+
+
+def invalidate_line(item, previous_path_ids=None):
+    """
+    Invalidates ``item``, its ancestors and its descendants, as after a
+    move or rename; ``previous_path_ids`` adds the ancestors it was moved from.
+    """
+    ids = set(Item.objects.filter(tree_id=item.tree_id).filter(
+        Q(lft__lte=item.lft, rght__gte=item.rght) | Q(lft__gt=item.lft, rght__lt=item.rght)
+    ).values_list('id', flat=True))
+    if previous_path_ids:
+        ids |= set(_ancestor_ids(previous_path_ids))
+    _bump([f"item:{pk}" for pk in ids] + [LIST])
+
+
+def invalidate_items(item_ids):
+    """Invalidates the given items and their ancestors"""
+    paths = Item.objects.filter(pk__in=list(item_ids)).values_list('path_ids', flat=True)
+    ids = {pk for path_ids in paths for pk in _ancestor_ids(path_ids)}
+    _bump([f"item:{pk}" for pk in ids] + [LIST])
+
+
+def geometry_version(tree_id):
+    """Version of the geometry of ``tree_id`` held by itemsapi.geometry"""
+    return ':'.join(_tokens([EPOCH, GEOMETRY, f"{GEOMETRY}:{tree_id}"]))
+
+
+def invalidate_geometry(tree_ids=None):
+    """Invalidates the geometry of ``tree_ids``, or of every tree when writes may have renumbered tree ids"""
+    _bump([GEOMETRY] if tree_ids is None else [f"{GEOMETRY}:{tree_id}" for tree_id in tree_ids])
+
+
+def invalidate_all():
+    """Invalidates every cached response, for writes that bypass model signals"""
+    _bump([EPOCH, LIST])
@@ -0,0 +1,206 @@
+"""
+Subtree deletion.
+
+``delete_subtree`` removes an item and its descendants without loading them
+as model instances: one DELETE per attachment table and one for the items,
+each restricted to the subtree's nested-set range (``tree_id`` and ``lft``
+between the root's ``lft`` and ``rght``), then one UPDATE closing the gap
+the subtree leaves in its tree's numbering. No delete signals fire, so what
+their receivers do per object is done once per subtree: history rows,
+search index, blob reference counts, response caches, geometry and email
+routes. Blob-backed files are then removed by ``gc_blobs`` once nothing
+references them; files stored before the blob store are deleted from
+storage by a background thread after the transaction commits.
+
+``trash_subtree`` first copies the rows into a TrashedSubtree, whose files
+keep their blob references, so ``restore`` can put the subtree back with
+the same ids under its old parent, or as a new tree when the parent is
+gone. ``purge`` drops a trashed subtree for good; ``manage.py purge_trash``
+purges those older than ITEMSAPI_TRASH_RETENTION_DAYS.
+"""
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Max, PositiveIntegerField, When
+from django.utils import timezone
+
+from . import blobs, cache, emails, geometry, history, search
+from .models import Blob, CodeIdentifier, ComponentHistory, Email, File, Item, Note, TrashedSubtree
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+# Attachment tables by snapshot key; their rows go before the items they point to
+ATTACHMENTS = {'notes': Note, 'codes': CodeIdentifier, 'emails': Email, 'files': File}
+# Item columns recomputed on restore rather than kept in snapshots
+TREE_FIELDS = {'tree_id', 'lft', 'rght', 'level'}
+
+_remover = None
+_remover_lock = threading.Lock()
+
+
+def retention_days():
+    return getattr(settings, 'ITEMSAPI_TRASH_RETENTION_DAYS', 30)
+
+
+def remover():
+    """The thread deleting files from storage"""
+    global _remover
+    with _remover_lock:
+        if _remover is None:
+            _remover = ThreadPoolExecutor(1, thread_name_prefix='itemsapi-remover')
+        return _remover
+
+
+def _remove(names):
+    storage = blobs.storage()
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.exception("Could not delete %s", name)
+
+
+def _release_files(files):
+    """
+    Drops the blob references of ``files``, (blob id, name) pairs of deleted
+    File rows, and queues the files stored outside the blob store for removal.
+    """
+    counts = Counter(blob_id for blob_id, _ in files if blob_id)
+    if counts:
+        Blob.objects.filter(pk__in=counts).update(ref_count=F('ref_count') - Case(
+            *[When(pk=blob_id, then=count) for blob_id, count in counts.items()]))
+    names = {name for blob_id, name in files if not blob_id and name}
+    names -= set(File.objects.filter(file__in=names).values_list('file', flat=True))
+    if names:
+        transaction.on_commit(lambda: remover().submit(_remove, sorted(names)))
+
+
+def _root(item):
+    """``item`` with its current tree columns"""
+    return Item.objects.only('tree_id', 'lft', 'rght', 'parent_id', 'name', 'full_path', 'path_ids').get(pk=item.pk)
+
+
+def _items(root):
+    return Item.objects.filter(tree_id=root.tree_id, lft__range=(root.lft, root.rght))
+
+
+def _delete_rows(root):
+    """Deletes the rows of ``root``'s subtree and closes the gap; returns (id, parent id, name) of the items"""
+    items = _items(root)
+    rows = list(items.values_list('id', 'parent_id', 'name'))
+    for model in ATTACHMENTS.values():
+        # Not delete(): the collector would load every row to send its delete signals
+        model.objects.filter(root.subtree_q())._raw_delete(model.objects.db)
+    items._raw_delete(items.db)
+    width = root.rght - root.lft + 1
+    Item.objects.filter(tree_id=root.tree_id, rght__gt=root.rght).update(
+        lft=Case(When(lft__gt=root.rght, then=F('lft') - width), default=F('lft'),
+                 output_field=PositiveIntegerField()),
+        rght=F('rght') - width)
+    return rows
+
+
+def _deleted(root, rows):
+    history.record([(pk, parent_id, None, ComponentHistory.DELETED) for pk, parent_id, _ in rows],
+                   {pk: name for pk, _, name in rows})
+    search.remove([pk for pk, _, _ in rows])
+    cache.invalidate_all()
+    geometry.invalidate([root.tree_id])
+    emails.resolver.clear()
+
+
+def delete_subtree(item):
+    """Deletes ``item`` and its descendants; returns how many items were deleted"""
+    root = _root(item)
+    files = list(File.objects.filter(root.subtree_q()).values_list('blob_id', 'file'))
+    rows = _delete_rows(root)
+    _release_files(files)
+    _deleted(root, rows)
+    return len(rows)
+
+
+def _columns(model):
+    return [field.attname for field in model._meta.concrete_fields
+            if not field.generated and field.attname not in TREE_FIELDS]
+
+
+def trash_subtree(item):
+    """Moves ``item`` and its descendants to the trash; returns the TrashedSubtree"""
+    root = _root(item)
+    snapshot = {'items': list(_items(root).order_by('lft').values(*_columns(Item)))}
+    for key, model in ATTACHMENTS.items():
+        snapshot[key] = list(model.objects.filter(root.subtree_q()).values(*_columns(model)))
+    rows = _delete_rows(root)
+    _deleted(root, rows)
+    return TrashedSubtree.objects.create(item_id=root.pk, name=root.name, parent_id=root.parent_id,
+                                         full_path=root.full_path, item_count=len(rows), snapshot=snapshot)
+
+
+def _insert(model, rows, **values):
+    """Inserts snapshot ``rows`` of ``model``, keeping their ids and creation times"""
+    opts = model._meta
+    objs = [model(**{name: opts.get_field(name).to_python(value) for name, value in row.items()}, **values)
+            for row in rows]
+    model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+    # bulk_create stamps auto_now_add fields with the current time
+    stamped = [field for field in opts.concrete_fields if getattr(field, 'auto_now_add', False)]
+    if stamped and objs:
+        for obj, row in zip(objs, rows):
+            for field in stamped:
+                setattr(obj, field.attname, field.to_python(row[field.attname]))
+        model.objects.bulk_update(objs, [field.name for field in stamped], batch_size=BATCH_SIZE)
+
+
+def restore(trashed):
+    """
+    Puts a trashed subtree back under its old parent, or as a new tree when
+    the parent is gone; returns its root item.
+    """
+    snapshot = trashed.snapshot
+    parent = Item.objects.filter(pk=trashed.parent_id).only('tree_id').first() if trashed.parent_id else None
+    if parent is not None:
+        tree_id = parent.tree_id
+    else:
+        tree_id = (Item.objects.aggregate(top=Max('tree_id'))['top'] or 0) + 1
+    items = snapshot['items']
+    # Snapshots list the items in tree order, root first
+    items[0]['parent_id'] = parent.pk if parent is not None else None
+    _insert(Item, items, tree_id=tree_id, lft=0, rght=0, level=0)
+    for key, model in ATTACHMENTS.items():
+        _insert(model, snapshot[key])
+    # Also recomputes the materialized paths, which change when the parent moved or is gone
+    Item.objects.partial_rebuild(tree_id)
+
+    ids = [row['id'] for row in items]
+    history.record([(row['id'], None, row['parent_id'], ComponentHistory.RESTORED) for row in items])
+    search.reindex(ids)
+    cache.invalidate_all()
+    geometry.invalidate([tree_id])
+    emails.resolver.clear()
+    trashed.delete()
+    return Item.objects.get(pk=trashed.item_id)
+
+
+def purge(trashed):
+    """Deletes a trashed subtree for good, releasing its files"""
+    _release_files([(row['blob_id'], row['file']) for row in trashed.snapshot['files']])
+    trashed.delete()
+
+
+def purge_expired(before=None):
+    """Purges the subtrees trashed before ``before`` (default: the retention period ago); returns how many"""
+    before = before or timezone.now() - timedelta(days=retention_days())
+    purged = 0
+    for pk in list(TrashedSubtree.objects.filter(deleted_at__lt=before).values_list('pk', flat=True)):
+        with transaction.atomic():
+            trashed = TrashedSubtree.objects.filter(pk=pk).first()
+            if trashed is not None:
+                purge(trashed)
+                purged += 1
+    return purged
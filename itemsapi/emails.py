@@ -0,0 +1,139 @@
+"""
+Bulk email storage and QR-code routing.
+
+Emails are deduplicated on ``Email.content_hash`` (see
+``email_content_hash``): a message already stored, or repeated within the
+same batch, is reported as a duplicate of the stored row instead of being
+inserted again. New rows are written with one ``bulk_create``; the
+bookkeeping normally done by the per-row signals (attachment counters,
+search index, response cache) runs once per batch.
+
+Routing files an email under the item whose ``qr_code`` (or one of whose
+``CodeIdentifier`` codes) matches the email's ``qr_code``. Codes are
+resolved with one ``IN`` query per batch, behind an in-process LRU that
+itemsapi.signals clears whenever item codes change.
+"""
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from . import cache, search
+from .models import CodeIdentifier, Email, Item
+
+CREATED = 'created'
+DUPLICATE = 'duplicate'
+ERROR = 'error'
+
+MAX_EMAILS = 1000
+BATCH_SIZE = 500
+ROUTE_CACHE_SIZE = 4096
+
+
+class CodeResolver:
+    """Maps codes to item ids, remembering up to ``size`` recent matches"""
+
+    def __init__(self, size=ROUTE_CACHE_SIZE):
+        self.size = size
+        self.recent = OrderedDict()
+
+    def clear(self):
+        self.recent.clear()
+
+    def resolve(self, codes):
+        """Returns {code: item_id} for the codes that match an item; an item's own qr_code wins"""
+        found = {}
+        missing = []
+        for code in set(codes):
+            if code in self.recent:
+                self.recent.move_to_end(code)
+                found[code] = self.recent[code]
+            else:
+                missing.append(code)
+        if missing:
+            matches = Item.objects.filter(qr_code__in=missing).order_by().values_list('qr_code', 'id', Value(0)).union(
+                CodeIdentifier.objects.filter(code__in=missing).order_by().values_list('code', 'item_id', Value(1)),
+                all=True,
+            )
+            best = {}
+            for code, item_id, rank in matches:
+                if code not in best or (rank, item_id) < best[code]:
+                    best[code] = (rank, item_id)
+            for code, (_, item_id) in best.items():
+                found[code] = self.recent[code] = item_id
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+        return found
+
+
+resolver = CodeResolver()
+
+
+def _refresh(item_ids):
+    Item.objects.recount_attachments(pk__in=item_ids)
+    search.reindex(item_ids)
+    cache.invalidate_items(item_ids)
+
+
+def import_emails(entries, route=False):
+    """
+    Stores ``entries`` (objects with the EmailCreate fields) and returns one
+    ``{'index', 'status', 'id', 'item_id', 'detail'}`` dict per entry, in
+    order. With ``route``, emails whose QR code matches an item are stored
+    under that item instead.
+    """
+    targets = resolver.resolve(entry.qr_code for entry in entries if entry.qr_code) if route else {}
+    rows = []
+    for entry in entries:
+        row = Email(item_id=targets.get(entry.qr_code, entry.item_id), subject=entry.subject[:255], body=entry.body,
+                    from_address=entry.from_address, received_at=entry.received_at,
+                    qr_code=entry.qr_code, message_id=getattr(entry, 'message_id', None))
+        row.content_hash = row.compute_content_hash()
+        rows.append(row)
+
+    known_items = set(Item.objects.filter(pk__in={row.item_id for row in rows}).values_list('pk', flat=True))
+    stored = dict(Email.objects.filter(content_hash__in=[row.content_hash for row in rows])
+                  .values_list('content_hash', 'id'))
+    results = [{'index': index, 'status': DUPLICATE, 'id': None, 'item_id': row.item_id, 'detail': None}
+               for index, row in enumerate(rows)]
+    new = {}
+    for index, row in enumerate(rows):
+        if row.item_id not in known_items:
+            results[index].update(status=ERROR, detail=f"Unknown item {row.item_id}")
+        elif row.content_hash not in stored and row.content_hash not in new:
+            new[row.content_hash] = row
+            results[index]['status'] = CREATED
+    if new:
+        with transaction.atomic():
+            # A concurrent import of the same message loses the race on the unique index and is skipped
+            Email.objects.bulk_create(new.values(), batch_size=BATCH_SIZE, ignore_conflicts=True)
+            stored.update(Email.objects.filter(content_hash__in=list(new)).values_list('content_hash', 'id'))
+            _refresh({row.item_id for row in new.values()})
+
+    for result, row in zip(results, rows):
+        if result['status'] != ERROR:
+            result['id'] = stored.get(row.content_hash)
+    return results
+
+
+def route_emails(queryset):
+    """Moves the emails of ``queryset`` whose QR code matches an item under that item; returns how many moved"""
+    rows = list(queryset.exclude(qr_code__isnull=True).exclude(qr_code='').values_list('id', 'item_id', 'qr_code'))
+    targets = resolver.resolve(code for _, _, code in rows)
+    moves = {}
+    touched = set()
+    for pk, item_id, code in rows:
+        target = targets.get(code)
+        if target is not None and target != item_id:
+            moves[pk] = target
+            touched.update((item_id, target))
+    if not moves:
+        return 0
+    with transaction.atomic():
+        ids = list(moves)
+        for start in range(0, len(ids), BATCH_SIZE):
+            chunk = ids[start:start + BATCH_SIZE]
+            Email.objects.filter(pk__in=chunk).update(item_id=Case(
+                *[When(pk=pk, then=Value(moves[pk])) for pk in chunk], output_field=IntegerField()))
+        _refresh(touched)
+    return len(moves)
@@ -0,0 +1,89 @@
+"""
+Streaming export of the whole inventory.
+
+Items are read in tree order (``tree_id``, ``lft``) through
+``iterator(chunk_size=...)``, which uses a server-side cursor where the
+database supports one, and their attachments are fetched one chunk at a
+time. Output is written chunk by chunk, so memory use does not grow with
+the size of the inventory.
+
+Two formats are produced: NDJSON, one flat item per line with its
+``parent_id`` and ``level``, and a nested JSON array shaped like GET /items,
+whose ``children`` arrays are opened and closed as the walk enters and
+leaves each subtree.
+"""
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import tree
+from .models import Item
+
+CHUNK_SIZE = 500
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+def _dumps(node):
+    return json.dumps(node, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+
+def _chunks(selection):
+    """Yields lists of node dicts (tree columns included) in tree order"""
+    chunk_size = CHUNK_SIZE
+    attachments = [name for name in tree.ATTACHMENT_FIELDS if name in selection.expand]
+    queryset = Item.objects.all()
+    if 'attachment_count' in selection.fields:
+        queryset = queryset.with_attachment_count()
+    columns = ['tree_id', 'lft', 'rght'] + [name for name in selection.fields if name not in ('tree_id', 'lft', 'rght')]
+    rows = queryset.order_by('tree_id', 'lft').values(*columns).iterator(chunk_size=chunk_size)
+
+    nodes = {}
+    for row in rows:
+        for related_name in attachments:
+            row[related_name] = []
+        nodes[row['id']] = row
+        if len(nodes) == chunk_size:
+            tree.attach(nodes, attachments, list(nodes))
+            yield list(nodes.values())
+            nodes = {}
+    if nodes:
+        tree.attach(nodes, attachments, list(nodes))
+        yield list(nodes.values())
+
+
+def _public(node, selection):
+    return {key: value for key, value in node.items() if key in selection.fields or key in selection.expand}
+
+
+def ndjson(selection=tree.FULL):
+    """Yields the inventory as NDJSON, one flat item per line"""
+    for chunk in _chunks(selection):
+        yield ''.join(_dumps(_public(node, selection)) + '\n' for node in chunk)
+
+
+def nested_json(selection=tree.FULL):
+    """Yields the inventory as a JSON array of root items with nested children"""
+    yield '['
+    open_nodes = []  # (tree_id, rght) of the items whose children array is still open
+    first = True
+    for chunk in _chunks(selection):
+        parts = []
+        for node in chunk:
+            while open_nodes and (open_nodes[-1][0] != node['tree_id'] or open_nodes[-1][1] < node['lft']):
+                open_nodes.pop()
+                parts.append(']}')
+                first = False
+            body = _dumps(_public(node, selection))
+            parts.append(('' if first else ',') + body[:-1] + ',"children":[')
+            open_nodes.append((node['tree_id'], node['rght']))
+            first = True
+        yield ''.join(parts)
+    yield ']}' * len(open_nodes) + ']'
+
+
+def stream(fmt, selection=tree.FULL):
+    """Returns the chunk generator for ``fmt``"""
+    return ndjson(selection) if fmt == 'ndjson' else nested_json(selection)
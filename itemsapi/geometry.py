@@ -0,0 +1,184 @@
+"""
+In-process cache of tree geometry.
+
+The parent, lft, rght, level and name of every item of a tree are loaded in
+one query into flat arrays, indexed by the item's position in tree order.
+Ancestor paths and containment checks are then answered from those arrays
+without touching the database. Each loaded tree remembers the version it
+was loaded at (``cache.geometry_version``).
+
+Writes call ``invalidate`` (from itemsapi.signals), which replaces the
+version once the transaction commits, so every process reloads the tree on
+its next use. Until then the writing thread reads the trees it changed
+straight from the database and keeps no copy of them, which a rollback
+could leave stale. At most ``ITEMSAPI_GEOMETRY_TREES`` trees are kept per
+process, least recently used first out.
+"""
+import threading
+from array import array
+from collections import OrderedDict
+from functools import partial
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from . import cache
+from .models import Item, PATH_SEPARATOR
+
+_trees = OrderedDict()
+_lock = threading.Lock()
+# Trees written by the current thread's open transaction (ALL: possibly every tree)
+_written = threading.local()
+ALL = 'all'
+
+
+def max_trees():
+    return getattr(settings, 'ITEMSAPI_GEOMETRY_TREES', 256)
+
+
+class Node(NamedTuple):
+    # The Item columns needed to address a subtree (tree.subtree_filter)
+    pk: int
+    parent_id: Optional[int]
+    tree_id: int
+    lft: int
+    rght: int
+    level: int
+    name: str
+
+
+class TreeGeometry:
+    """The geometry of one tree, as arrays in tree (lft) order"""
+
+    def __init__(self, tree_id, version, rows):
+        self.tree_id = tree_id
+        self.version = version
+        self.ids = array('q')
+        self.parents = array('l')  # Position of the parent, -1 for the root
+        self.lft = array('q')
+        self.rght = array('q')
+        self.level = array('l')
+        self.names = []
+        self.positions = {}
+        for pk, parent_id, lft, rght, level, name in rows:
+            self.positions[pk] = len(self.ids)
+            self.ids.append(pk)
+            self.parents.append(self.positions.get(parent_id, -1))
+            self.lft.append(lft)
+            self.rght.append(rght)
+            self.level.append(level)
+            self.names.append(name)
+
+    def __contains__(self, pk):
+        return pk in self.positions
+
+    def __len__(self):
+        return len(self.ids)
+
+    def node(self, pk):
+        i = self.positions[pk]
+        parent = self.parents[i]
+        return Node(pk, self.ids[parent] if parent >= 0 else None, self.tree_id,
+                    self.lft[i], self.rght[i], self.level[i], self.names[i])
+
+    def ancestors(self, pk, include_self=False):
+        """Ids from the root down to the parent of ``pk`` (or to ``pk`` itself)"""
+        i = self.positions[pk]
+        path = [pk] if include_self else []
+        i = self.parents[i]
+        while i >= 0:
+            path.append(self.ids[i])
+            i = self.parents[i]
+        path.reverse()
+        return path
+
+    def contains(self, ancestor_pk, pk, include_self=False):
+        """Whether ``pk`` is in the subtree of ``ancestor_pk``"""
+        if ancestor_pk == pk:
+            return include_self and pk in self.positions
+        a, i = self.positions.get(ancestor_pk), self.positions.get(pk)
+        if a is None or i is None:
+            return False
+        return self.lft[a] < self.lft[i] and self.rght[i] < self.rght[a]
+
+    def path(self, pk):
+        """The "Root/.../Name" path of ``pk``"""
+        return PATH_SEPARATOR.join(self.names[self.positions[i]] for i in self.ancestors(pk, include_self=True))
+
+
+def _load(tree_id, version):
+    rows = Item.objects.filter(tree_id=tree_id).order_by('lft').values_list(
+        'id', 'parent_id', 'lft', 'rght', 'level', 'name')
+    return TreeGeometry(tree_id, version, rows.iterator(chunk_size=2000))
+
+
+def _written_trees():
+    if not transaction.get_connection().in_atomic_block:
+        _written.trees = set()
+    elif not hasattr(_written, 'trees'):
+        _written.trees = set()
+    return _written.trees
+
+
+def _committed(tree_ids):
+    cache.invalidate_geometry(tree_ids)
+    _written.trees = set()
+
+
+def invalidate(tree_ids=None):
+    """Records a write to ``tree_ids`` (None: tree ids may have been renumbered) in the current transaction"""
+    if transaction.get_connection().in_atomic_block:
+        _written_trees().update([ALL] if tree_ids is None else tree_ids)
+    transaction.on_commit(partial(_committed, tree_ids))
+
+
+def get(tree_id):
+    """Returns the current geometry of ``tree_id``, loading it when this process has none or an old one"""
+    written = _written_trees()
+    if written and (ALL in written or tree_id in written):
+        return _load(tree_id, None)
+    version = cache.geometry_version(tree_id)
+    with _lock:
+        geometry = _trees.get(tree_id)
+        if geometry is not None and geometry.version == version:
+            _trees.move_to_end(tree_id)
+            return geometry
+    geometry = _load(tree_id, version)
+    with _lock:
+        _trees[tree_id] = geometry
+        _trees.move_to_end(tree_id)
+        while len(_trees) > max_trees():
+            _trees.popitem(last=False)
+    return geometry
+
+
+def clear():
+    """Forgets every loaded tree and the writes of the current transaction"""
+    with _lock:
+        _trees.clear()
+    _written.trees = set()
+
+
+def of(item):
+    """Returns the geometry of the tree holding ``item``, whose tree_id may be out of date"""
+    geometry = get(item.tree_id)
+    if item.pk not in geometry:
+        # Moved to another tree since the instance was loaded
+        geometry = get(Item.objects.values_list('tree_id', flat=True).get(pk=item.pk))
+    return geometry
+
+
+def ancestors(item, include_self=False):
+    """Nodes from the root down to ``item``'s parent (or ``item``)"""
+    geometry = of(item)
+    return [geometry.node(pk) for pk in geometry.ancestors(item.pk, include_self)]
+
+
+def is_ancestor(ancestor, item, include_self=False):
+    """Whether ``ancestor`` is an ancestor of ``item``"""
+    return of(item).contains(ancestor.pk, item.pk, include_self)
+
+
+def path(item):
+    return of(item).path(item.pk)
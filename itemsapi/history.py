@@ -0,0 +1,209 @@
+"""
+Component history: recording, compaction and the layout of the inventory in
+the past.
+
+Only creations, parent changes and deletions are recorded (signals and
+itemsapi.bulk), through ``record``. Rows are stamped when recorded but
+buffered until the transaction commits, then written with one
+``bulk_create`` per savepoint that recorded any; rows recorded in a
+savepoint that is rolled back are dropped with it. ``flush`` writes the
+buffered rows early, for a response that lists them. History rows do not
+reference their items through a database constraint, so they outlive
+deleted items as an audit trail.
+
+``compact`` merges each item's runs of consecutive moves
+older than a cutoff into one row that keeps the run's first old parent, its
+last new parent and the number of moves, so old history stays bounded by
+the number of items that moved rather than by the number of moves.
+
+``parents_as_of`` reads the latest row per item up to a time in one
+windowed query over the (item, changed_at) index; ``layout_as_of`` arranges
+those parents into the nested layout of then. A time within a compacted run
+places the item where it was before the run. Names are the current ones (or
+the last one of a deleted item), renames are not recorded.
+"""
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import ComponentHistory, Item
+
+BATCH_SIZE = 500
+
+# Rows waiting for a commit, per savepoint of the current thread's transaction
+_pending = threading.local()
+
+
+def _write(rows):
+    if rows:
+        ComponentHistory.objects.bulk_create(
+            [ComponentHistory(item_id=item_id, old_parent_id=old_parent_id, new_parent_id=new_parent_id,
+                              action_type=action, changed_at=changed_at, item_name=name)
+             for item_id, old_parent_id, new_parent_id, action, changed_at, name in rows],
+            batch_size=BATCH_SIZE)
+
+
+def _flush_batch(key, batch):
+    batches = _pending.__dict__.get('batches', {})
+    if key in batches and batches[key][0] is batch:
+        # Rows recorded from now on go to a new batch, flushed by a new hook
+        del batches[key]
+    rows = list(batch)
+    batch.clear()
+    _write(rows)
+
+
+def _batches(connection):
+    """{savepoint ids: rows} of the current transaction"""
+    state = _pending.__dict__
+    batches = state.setdefault('batches', {})
+    if connection.run_on_commit is not state.get('hooks'):
+        # A commit or rollback replaced the commit hooks: drop the batches whose flush is gone with them
+        registered = {hook for _, hook, _ in connection.run_on_commit}
+        for key in [key for key, (_, hook) in batches.items() if hook not in registered]:
+            del batches[key]
+        state['hooks'] = connection.run_on_commit
+    return batches
+
+
+def record(events, item_names=None):
+    """
+    Records history rows for ``events``, (item id, old parent id, new parent
+    id, action) tuples, when the current transaction commits (at once outside
+    a transaction). ``item_names`` ({item id: name}) fills item_name.
+    """
+    changed_at = timezone.now()
+    item_names = item_names or {}
+    rows = [(*event, changed_at, item_names.get(event[0], '')) for event in events]
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        _write(rows)
+        return
+    batches = _batches(connection)
+    key = tuple(connection.savepoint_ids)
+    if key not in batches:
+        batch = []
+        hook = partial(_flush_batch, key, batch)
+        # The hook is dropped, with the batch, if the savepoint rolls back
+        connection.on_commit(hook)
+        batches[key] = (batch, hook)
+    batches[key][0].extend(rows)
+
+
+def flush():
+    """Writes the rows buffered by the current transaction now"""
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        for key, (batch, _) in list(_batches(connection).items()):
+            _flush_batch(key, batch)
+
+
+def retention_days():
+    return getattr(settings, 'ITEMSAPI_HISTORY_RETENTION_DAYS', 90)
+
+
+def default_cutoff():
+    """Moves older than this are compacted by default"""
+    return timezone.now() - timedelta(days=retention_days())
+
+
+def _runs(rows):
+    """Yields the runs of two or more consecutive moves of the same item in ``rows``, ordered by item then time"""
+    run, item_id = [], None
+    for row in rows:
+        if row.item_id != item_id or row.action_type != ComponentHistory.MOVED:
+            if len(run) > 1:
+                yield run
+            run, item_id = [], row.item_id
+        if row.action_type == ComponentHistory.MOVED:
+            run.append(row)
+    if len(run) > 1:
+        yield run
+
+
+def compact(before=None, batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Merges the runs of consecutive moves made before ``before`` (default:
+    ``default_cutoff()``) into their last row. Returns (runs, rows removed).
+    """
+    before = before or default_cutoff()
+    candidates = (ComponentHistory.objects.filter(action_type=ComponentHistory.MOVED, changed_at__lt=before)
+                  .order_by('item_id').values('item_id').annotate(moves=Count('id')).filter(moves__gt=1)
+                  .values_list('item_id', flat=True))
+    runs = removed = 0
+    last_id = 0
+    while True:
+        item_ids = list(candidates.filter(item_id__gt=last_id)[:batch_size])
+        if not item_ids:
+            break
+        last_id = item_ids[-1]
+        rows = ComponentHistory.objects.filter(item_id__in=item_ids, changed_at__lt=before).order_by(
+            'item_id', 'changed_at', 'id')
+        kept, obsolete = [], []
+        for run in _runs(rows):
+            last = run[-1]
+            last.old_parent_id = run[0].old_parent_id
+            last.first_changed_at = run[0].first_changed_at or run[0].changed_at
+            last.moves = sum(row.moves for row in run)
+            kept.append(last)
+            obsolete.extend(row.pk for row in run[:-1])
+        runs += len(kept)
+        removed += len(obsolete)
+        if dry_run:
+            continue
+        with transaction.atomic():
+            ComponentHistory.objects.bulk_update(kept, ['old_parent', 'first_changed_at', 'moves'])
+            ComponentHistory.objects.filter(pk__in=obsolete).delete()
+    return runs, removed
+
+
+def parents_as_of(at):
+    """{item id: parent id} of the items that existed at ``at``"""
+    latest = (ComponentHistory.objects.filter(changed_at__lte=at).order_by()
+              .annotate(rank=Window(RowNumber(), partition_by=[F('item_id')],
+                                    order_by=[F('changed_at').desc(), F('id').desc()]))
+              .filter(rank=1).values_list('item_id', 'new_parent_id', 'action_type'))
+    return {pk: parent_id for pk, parent_id, action in latest if action != ComponentHistory.DELETED}
+
+
+def layout_as_of(at, root_id=None):
+    """
+    The forest of items as it was at ``at``, as nested {id, name, parent_id,
+    children} dicts, or the subtree of ``root_id`` (None when it did not
+    exist then).
+    """
+    parents = parents_as_of(at)
+    children = defaultdict(list)
+    for pk, parent_id in parents.items():
+        children[parent_id if parent_id in parents else None].append(pk)
+    if root_id is None:
+        ids = list(parents)
+        names = dict(Item.objects.values_list('id', 'name'))
+    elif root_id in parents:
+        ids, pending = [], [root_id]
+        while pending:
+            pk = pending.pop()
+            ids.append(pk)
+            pending.extend(children[pk])
+        names = dict(Item.objects.filter(pk__in=ids).values_list('id', 'name'))
+    else:
+        return None
+    deleted = set(ids) - set(names)
+    if deleted:
+        names.update(ComponentHistory.objects.filter(item_id__in=deleted, action_type=ComponentHistory.DELETED)
+                     .values_list('item_id', 'item_name'))
+
+    nodes = {pk: {'id': pk, 'name': names.get(pk, ''), 'parent_id': parents[pk], 'children': []} for pk in ids}
+    for node in nodes.values():
+        node['children'] = sorted((nodes[pk] for pk in children[node['id']]),
+                                  key=lambda child: (child['name'], child['id']))
+    if root_id is not None:
+        return nodes[root_id]
+    return sorted((nodes[pk] for pk in children[None]), key=lambda root: (root['name'], root['id']))
@@ -0,0 +1,43 @@
+"""
+Image derivative rendering.
+
+Runs in the worker processes of itemsapi.thumbnails, so it imports neither
+Django nor the rest of the app. Pillow is imported on first use.
+"""
+from io import BytesIO
+
+THUMBNAIL_SIZE = (256, 256)
+PREVIEW_SIZE = (1280, 1280)
+WEBP_QUALITY = 80
+
+
+def render(source):
+    """
+    Returns ``{'thumbnail': bytes, 'preview': bytes}`` for the image at
+    ``source`` (a path or the image bytes): a square WebP thumbnail cropped
+    to THUMBNAIL_SIZE and a WebP preview fitting in PREVIEW_SIZE.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+        # Lets JPEG decoding skip the resolution the preview does not need
+        image.draft('RGB', PREVIEW_SIZE)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        preview = image.copy()
+        preview.thumbnail(PREVIEW_SIZE)
+        rendered = {}
+        for kind, derivative in (('thumbnail', ImageOps.fit(preview, THUMBNAIL_SIZE)), ('preview', preview)):
+            out = BytesIO()
+            derivative.save(out, 'WEBP', quality=WEBP_QUALITY)
+            rendered[kind] = out.getvalue()
+        return rendered
+
+
+def render_safely(source):
+    """``render`` for pool maps: returns (derivatives, None) or (None, error message)"""
+    try:
+        return render(source), None
+    except Exception as exc:
+        return None, f"{type(exc).__name__}: {exc}"
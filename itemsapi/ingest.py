@@ -0,0 +1,231 @@
+"""
+Pipelined IMAP ingestion.
+
+New messages are found with one ``UID SEARCH`` from a persisted high-water
+mark and fetched ``FETCH_BATCH`` at a time with a single ``UID FETCH`` per
+batch. MIME parsing runs in a process pool while the next batch is being
+fetched, and parsed batches are handed in UID order to a sink that writes
+them (``OrmSink`` here, an HTTP sink posting to /emails/bulk in
+populate_emails.py). The high-water mark only advances once a batch has
+been written, so an interrupted run resumes after the last stored message;
+messages written twice anyway are skipped by their dedupe hash.
+
+This module imports Django lazily so populate_emails.py can use it without
+configuring Django.
+"""
+import email
+import imaplib
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.policy import default
+from email.utils import parsedate_to_datetime
+
+FETCH_BATCH = 50
+# Parsed batches waiting for the sink while the next one is fetched
+MAX_PENDING_BATCHES = 2
+
+_FETCH_UID = re.compile(rb'UID (\d+)')
+
+
+def connect(host, user, password, port=None, ssl=True):
+    """Opens an authenticated IMAP connection"""
+    if ssl:
+        mail = imaplib.IMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT)
+    else:
+        mail = imaplib.IMAP4(host, port or imaplib.IMAP4_PORT)
+    mail.login(user, password)
+    return mail
+
+
+class HighWaterMark:
+    """Last ingested UID per mailbox folder, persisted as JSON in ``path``"""
+
+    def __init__(self, path, mailbox):
+        self.path = path
+        self.mailbox = mailbox
+        self.uidvalidity = None
+        self.uid = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f).get(mailbox, {})
+            self.uidvalidity, self.uid = state.get('uidvalidity'), state.get('uid', 0)
+
+    def reset_if_invalid(self, uidvalidity):
+        """Forgets the mark when the server renumbered the folder's UIDs"""
+        if self.uidvalidity != uidvalidity:
+            self.uidvalidity, self.uid = uidvalidity, 0
+
+    def advance(self, uid):
+        self.uid = max(self.uid, uid)
+        state = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+        state[self.mailbox] = {'uidvalidity': self.uidvalidity, 'uid': self.uid}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def new_uids(mail, folder, mark):
+    """Selects ``folder`` read-only and returns the UIDs above the high-water mark, ascending"""
+    status, _ = mail.select(folder, readonly=True)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"Cannot select folder {folder}")
+    _, [uidvalidity] = mail.response('UIDVALIDITY')
+    mark.reset_if_invalid(int(uidvalidity))
+    _, data = mail.uid('SEARCH', None, f'UID {mark.uid + 1}:*')
+    # "N:*" always matches the last message, even when its UID is below N
+    return sorted(uid for uid in map(int, data[0].split()) if uid > mark.uid)
+
+
+def fetch_batches(mail, uids, batch_size=FETCH_BATCH):
+    """Yields lists of (uid, raw message) with one UID FETCH per ``batch_size`` UIDs"""
+    for start in range(0, len(uids), batch_size):
+        chunk = uids[start:start + batch_size]
+        _, data = mail.uid('FETCH', ','.join(map(str, chunk)), '(RFC822)')
+        batch = []
+        for part in data:
+            if isinstance(part, tuple):
+                match = _FETCH_UID.search(part[0])
+                if match:
+                    batch.append((int(match.group(1)), part[1]))
+        yield sorted(batch)
+
+
+def extract_qr_from_subject(subject):
+    """Extract QR code from email subject"""
+    match = re.search(r'(?:Re:\s*)?(\w+)$', subject)
+    return match.group(1) if match else None
+
+
+def _decode(part):
+    payload = part.get_payload(decode=True) or b''
+    return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+
+
+def get_email_body(msg):
+    """Extract the plain text body from the email message"""
+    if msg.is_multipart():
+        body = next((_decode(part) for part in msg.walk() if part.get_content_type() == 'text/plain'), '')
+    else:
+        body = _decode(msg)
+    return body if body else 'No body found'
+
+
+def get_email_attachments(msg):
+    """Extract image and application attachments from the email message"""
+    attachments = []
+    for part in msg.walk():
+        if part.get_content_maintype() in ('image', 'application') and part.get_filename():
+            attachments.append({
+                'filename': part.get_filename(),
+                'content_type': part.get_content_type(),
+                'content': part.get_payload(decode=True),
+            })
+    return attachments
+
+
+def parse_message(uid, raw):
+    """Parses one raw message into the fields of an Email plus its attachments"""
+    msg = email.message_from_bytes(raw, policy=default)
+    subject = str(msg['subject'] or 'No Subject')
+    try:
+        received_at = parsedate_to_datetime(msg['date'])
+    except (TypeError, ValueError):
+        received_at = datetime.now(timezone.utc)
+    return {
+        'uid': uid,
+        'message_id': str(msg['message-id'] or '').strip() or None,
+        'subject': subject,
+        'from_address': str(msg['from'] or 'unknown@domain.com'),
+        'received_at': received_at,
+        'body': get_email_body(msg),
+        'qr_code': extract_qr_from_subject(subject),
+        'attachments': get_email_attachments(msg),
+    }
+
+
+class _InlineExecutor:
+    """Stands in for the process pool when ``workers`` is 0"""
+
+    def map(self, fn, *iterables):
+        return list(map(fn, *iterables))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def ingest(mail, folder, sink, mark, batch_size=FETCH_BATCH, workers=None, limit=None):
+    """
+    Streams the messages of ``folder`` above ``mark`` into ``sink`` and
+    returns how many were written. ``workers`` sizes the parsing pool
+    (default: one per CPU, 0 parses inline).
+    """
+    uids = new_uids(mail, folder, mark)
+    if limit is not None:
+        uids = uids[:limit]
+    written = 0
+    pool = _InlineExecutor() if workers == 0 else ProcessPoolExecutor(workers)
+    with pool:
+        pending = deque()
+
+        def drain():
+            nonlocal written
+            emails = list(pending.popleft())
+            sink.write(emails)
+            written += len(emails)
+            mark.advance(emails[-1]['uid'])
+
+        for batch in fetch_batches(mail, uids, batch_size):
+            if not batch:
+                continue
+            uid_list, raws = zip(*batch)
+            pending.append(pool.map(parse_message, uid_list, raws))
+            if len(pending) >= MAX_PENDING_BATCHES:
+                drain()
+        while pending:
+            drain()
+    return written
+
+
+class OrmSink:
+    """
+    Writes parsed emails (and their attachments as files) straight to the
+    database under ``item_id``, or under the item matching their QR code
+    when ``route`` is set.
+    """
+
+    def __init__(self, item_id, route=True):
+        self.item_id = item_id
+        self.route = route
+
+    def write(self, parsed):
+        from types import SimpleNamespace
+
+        from django.core.files.base import ContentFile
+        from django.db import transaction
+
+        from . import emails
+        from .models import File
+
+        with transaction.atomic():
+            results = emails.import_emails([SimpleNamespace(item_id=self.item_id, **e) for e in parsed],
+                                           route=self.route)
+            for e, result in zip(parsed, results):
+                if result['status'] == emails.ERROR:
+                    raise ValueError(result['detail'])
+                if result['status'] != emails.CREATED:
+                    continue
+                # Attachments of a duplicate were stored with the first copy
+                for attachment in e['attachments']:
+                    File.objects.create(item_id=result['item_id'], file_type=attachment['content_type'],
+                                        file=ContentFile(attachment['content'], name=attachment['filename']))
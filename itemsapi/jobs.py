@@ -0,0 +1,78 @@
+"""
+Listing job queue.
+
+An item whose ``listing_worker`` is ``'pending'`` is a job. Workers claim a
+batch of jobs with a single ``UPDATE ... RETURNING`` statement; on PostgreSQL
+the candidate rows are picked with ``FOR UPDATE SKIP LOCKED`` so concurrent
+workers never wait on, or receive, the same rows. A claim holds a lease;
+jobs whose lease expired before completion are put back to pending on the
+next claim. Claims write the queue columns directly and fire no model
+signals, so the response cache is invalidated here.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import cache
+from .models import Item
+
+PENDING = 'pending'
+MAX_BATCH = 100
+MAX_LEASE_SECONDS = 24 * 3600
+
+
+def lease_seconds():
+    return getattr(settings, 'ITEMSAPI_LISTING_LEASE_SECONDS', 600)
+
+
+def requeue_expired(now=None):
+    """Puts jobs whose lease has expired back to pending, returns how many"""
+    now = now or timezone.now()
+    expired = Item.objects.filter(listing_lease_expires_at__lt=now)
+    item_ids = list(expired.values_list('id', flat=True))
+    if not item_ids:
+        return 0
+    requeued = expired.filter(id__in=item_ids).update(listing_worker=PENDING, listing_lease_expires_at=None)
+    cache.invalidate_items(item_ids)
+    return requeued
+
+
+def claim(worker_name, count=1, lease=None):
+    """Assigns up to ``count`` pending jobs to ``worker_name`` and returns their item ids, oldest first"""
+    if worker_name == PENDING:
+        raise ValueError(f"'{PENDING}' is reserved and cannot be used as a worker name")
+    if lease is not None and not 0 < lease <= MAX_LEASE_SECONDS:
+        # A lease already expired when granted would let the job be claimed twice
+        raise ValueError(f"lease_seconds must be between 1 and {MAX_LEASE_SECONDS}")
+    count = max(1, min(count, MAX_BATCH))
+    now = timezone.now()
+    expires = now + timedelta(seconds=lease_seconds() if lease is None else lease)
+
+    qn = connection.ops.quote_name
+    table = qn(Item._meta.db_table)
+    lock = 'FOR UPDATE SKIP LOCKED' if connection.features.has_select_for_update_skip_locked else ''
+    sql = (
+        f"UPDATE {table} SET {qn('listing_worker')} = %s, {qn('listing_lease_expires_at')} = %s "
+        f"WHERE {qn('id')} IN ("
+        f"SELECT {qn('id')} FROM {table} "
+        f"WHERE {qn('listing_worker')} = %s AND {qn('listing_json')} IS NOT NULL "
+        f"ORDER BY {qn('id')} LIMIT %s {lock}"
+        f") RETURNING {qn('id')}"
+    )
+    params = [worker_name, connection.ops.adapt_datetimefield_value(expires), PENDING, count]
+    with transaction.atomic():
+        requeue_expired(now)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            item_ids = sorted(row[0] for row in cursor.fetchall())
+    cache.invalidate_items(item_ids)
+    return item_ids
+
+
+def complete(item_id, worker_name):
+    """Releases the lease held by ``worker_name``; returns False if the worker no longer holds the job"""
+    return bool(Item.objects.filter(
+        id=item_id, listing_worker=worker_name, listing_lease_expires_at__gte=timezone.now()
+    ).update(listing_lease_expires_at=None))
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from itemsapi import history
+
+
+class Command(BaseCommand):
+    help = "Merges old runs of consecutive moves of each component into one history row (run it daily)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None,
+                            help="compact moves older than this many days "
+                                 "(default: ITEMSAPI_HISTORY_RETENTION_DAYS)")
+        parser.add_argument('--batch-size', type=int, default=history.BATCH_SIZE, help="components per transaction")
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        days = history.retention_days() if options['older_than'] is None else options['older_than']
+        runs, removed = history.compact(timezone.now() - timedelta(days=days), options['batch_size'],
+                                        dry_run=options['dry_run'])
+        verb = "Would merge" if options['dry_run'] else "Merged"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {runs} runs of moves, removing {removed} history rows"))
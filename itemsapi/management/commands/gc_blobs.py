@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from itemsapi import blobs
+
+
+class Command(BaseCommand):
+    help = "Deletes stored file contents that no attachment references any more"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=None,
+                            help="keep unreferenced blobs younger than this many seconds")
+        parser.add_argument('--recount', action='store_true', help="recompute reference counts first")
+        parser.add_argument('--adopt-legacy', action='store_true',
+                            help="first move files stored under attachments/ into the blob store")
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['adopt_legacy'] and not options['dry_run']:
+            self.stdout.write(f"Moved {blobs.adopt_legacy_files()} legacy files into the blob store")
+        if options['recount'] and not options['dry_run']:
+            self.stdout.write(f"Recounted {blobs.recount()} blobs")
+        deleted, freed = blobs.collect_garbage(options['grace'], dry_run=options['dry_run'])
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {deleted} unreferenced blobs ({freed} bytes)"))
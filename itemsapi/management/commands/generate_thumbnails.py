@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from itemsapi import thumbnails
+
+
+class Command(BaseCommand):
+    help = "Renders the thumbnails and previews missing for image attachments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=thumbnails.BATCH_SIZE)
+        parser.add_argument('--retry-failed', action='store_true', help="also retry images that failed to render")
+
+    def handle(self, *args, **options):
+        def progress(done, total):
+            self.stdout.write(f"Rendered {done}/{total} images")
+
+        ready, failed = thumbnails.backfill(options['retry_failed'], options['batch_size'], progress)
+        self.stdout.write(self.style.SUCCESS(f"{ready} images ready, {failed} failed"))
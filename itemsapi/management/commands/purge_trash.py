@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from itemsapi import deletion
+
+
+class Command(BaseCommand):
+    help = "Deletes for good the subtrees trashed longer ago than the retention period (run it daily)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None,
+                            help="purge subtrees trashed more than this many days ago "
+                                 "(default: ITEMSAPI_TRASH_RETENTION_DAYS)")
+
+    def handle(self, *args, **options):
+        days = deletion.retention_days() if options['older_than'] is None else options['older_than']
+        purged = deletion.purge_expired(timezone.now() - timedelta(days=days))
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} trashed subtrees"))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from itemsapi import search
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search index for items, notes and emails"
+
+    def handle(self, *args, **options):
+        if not search.rebuild():
+            raise CommandError("No search index for this database backend; searches use icontains")
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
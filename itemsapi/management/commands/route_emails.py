@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from itemsapi import emails
+from itemsapi.models import Email, Item
+
+
+class Command(BaseCommand):
+    help = "Moves emails parked under the Unprocessed item to the items matching their QR codes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--item', default='Unprocessed', help="name of the item holding the backlog")
+        parser.add_argument('--batch-size', type=int, default=emails.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        inbox = Item.objects.filter(name=options['item']).order_by('id').first()
+        if inbox is None:
+            raise CommandError(f"No item named '{options['item']}'")
+        last_id = 0
+        moved = 0
+        while True:
+            ids = list(Email.objects.filter(item=inbox, id__gt=last_id).order_by('id')
+                       .values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            moved += emails.route_emails(Email.objects.filter(id__in=ids))
+            self.stdout.write(f"Routed {moved} emails (up to email {last_id})")
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved} emails out of '{inbox.name}'"))
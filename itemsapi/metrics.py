@@ -0,0 +1,243 @@
+"""
+Per-endpoint request metrics.
+
+A sampled request (``ITEMSAPI_METRICS_SAMPLE_RATE``) gets a ``Sample``
+held in a context variable while it runs: a wrapper installed on every
+database connection adds each query's SQL and duration to it, and
+``TimedRenderer`` adds the time spent encoding the response. Context
+variables follow sync_to_async, so the queries of async views are counted
+too. Requests that are not sampled pay for one random draw and one
+context variable lookup per query.
+
+When the request finishes its totals are added to the histograms of its
+endpoint (``Registry``), a ``Server-Timing`` header is set, and SQL
+statements repeated ``ITEMSAPI_N_PLUS_ONE_THRESHOLD`` times with
+different parameters are reported as a likely N+1 pattern. Histograms
+live in the serving process; GET /api/metrics returns them to staff users.
+"""
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from ninja.renderers import BaseRenderer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = {
+    'duration_ms': (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+    'db_ms': (1, 5, 10, 25, 50, 100, 250, 500, 1000),
+    'queries': (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    'serialize_ms': (1, 5, 10, 25, 50, 100, 250, 500),
+    'response_bytes': (1_000, 10_000, 100_000, 1_000_000, 10_000_000),
+}
+
+_current = ContextVar('itemsapi_metrics_sample', default=None)
+_IN_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+_NUMBER = re.compile(r'\b\d+\b')
+
+
+def sample_rate():
+    return getattr(settings, 'ITEMSAPI_METRICS_SAMPLE_RATE', 0.01)
+
+
+def n_plus_one_threshold():
+    return getattr(settings, 'ITEMSAPI_N_PLUS_ONE_THRESHOLD', 10)
+
+
+def sql_shape(sql):
+    """The statement with IN lists and inlined numbers collapsed, so queries differing only by values match"""
+    return _NUMBER.sub('N', _IN_LIST.sub('%s...', sql))
+
+
+class Sample:
+    __slots__ = ('started', 'statements', 'db_seconds', 'serialize_seconds', 'token')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.token = None
+
+    def repeated_statements(self, threshold):
+        """Returns [(shape, count)] of the statements run at least ``threshold`` times, most repeated first"""
+        counts = Counter(sql_shape(sql) for sql in self.statements)
+        return [(shape, count) for shape, count in counts.most_common() if count >= threshold]
+
+
+def _record_query(execute, sql, params, many, context):
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.db_seconds += time.perf_counter() - started
+        sample.statements.append(sql)
+
+
+def install(connection, **kwargs):
+    """Adds the query recorder to ``connection`` once"""
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install, dispatch_uid='itemsapi.metrics.install')
+
+
+def install_all():
+    """Installs the recorder on the connections already open in this thread"""
+    for connection in connections.all(initialized_only=True):
+        install(connection)
+
+
+class TimedRenderer(BaseRenderer):
+    """Wraps a renderer to count its time in the current sample"""
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.media_type = renderer.media_type
+        self.charset = renderer.charset
+
+    def render(self, request, data, *, response_status):
+        sample = _current.get()
+        if sample is None:
+            return self.renderer.render(request, data, response_status=response_status)
+        started = time.perf_counter()
+        try:
+            return self.renderer.render(request, data, response_status=response_status)
+        finally:
+            sample.serialize_seconds += time.perf_counter() - started
+
+
+class Histogram:
+    """Counts of observed values per upper bound, the last bucket holding everything above"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        return {
+            'buckets': {**{str(bound): n for bound, n in zip(self.bounds, self.counts)}, '+Inf': self.counts[-1]},
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'mean': round(self.sum / self.count, 3) if self.count else None,
+            'max': round(self.max, 3),
+        }
+
+
+class Registry:
+    """Histograms of sampled requests per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.started_at = time.time()
+
+    def record(self, endpoint, values, n_plus_one):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'samples': 0, 'n_plus_one': 0, 'statuses': Counter(),
+                    'histograms': {name: Histogram(bounds) for name, bounds in BUCKETS.items()},
+                }
+            stats['samples'] += 1
+            stats['n_plus_one'] += bool(n_plus_one)
+            stats['statuses'][values.pop('status')] += 1
+            for name, value in values.items():
+                if value is not None:
+                    stats['histograms'][name].observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'since': self.started_at,
+                'sample_rate': sample_rate(),
+                'endpoints': {
+                    endpoint: {
+                        'samples': stats['samples'],
+                        'n_plus_one': stats['n_plus_one'],
+                        'statuses': {str(status): n for status, n in sorted(stats['statuses'].items())},
+                        'histograms': {name: h.as_dict() for name, h in stats['histograms'].items()},
+                    }
+                    for endpoint, stats in sorted(self.endpoints.items())
+                },
+            }
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.started_at = time.time()
+
+
+registry = Registry()
+
+
+def start():
+    """Begins a Sample for the current request, or returns None when it is not sampled"""
+    rate = sample_rate()
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return None
+    sample = Sample()
+    sample.token = _current.set(sample)
+    return sample
+
+
+def endpoint_of(request):
+    match = getattr(request, 'resolver_match', None)
+    return f"{request.method} /{match.route}" if match and match.route else f"{request.method} (unmatched)"
+
+
+def discard(sample):
+    _current.reset(sample.token)
+
+
+def finish(sample, request, response):
+    """Ends ``sample``, records it and sets the Server-Timing header of ``response``"""
+    _current.reset(sample.token)
+    duration_ms = (time.perf_counter() - sample.started) * 1000
+    db_ms = sample.db_seconds * 1000
+    serialize_ms = sample.serialize_seconds * 1000
+    endpoint = endpoint_of(request)
+
+    repeated = sample.repeated_statements(n_plus_one_threshold())
+    for shape, count in repeated:
+        logger.warning("Possible N+1 in %s: %d x %s", endpoint, count, shape[:300])
+
+    size = None if response.streaming else len(response.content)
+    registry.record(endpoint, {
+        'status': response.status_code,
+        'duration_ms': duration_ms,
+        'db_ms': db_ms,
+        'queries': len(sample.statements),
+        'serialize_ms': serialize_ms,
+        'response_bytes': size,
+    }, bool(repeated))
+    response['Server-Timing'] = ', '.join([
+        f'db;dur={db_ms:.1f};desc="{len(sample.statements)} queries"',
+        f'serialize;dur={serialize_ms:.1f}',
+        f'total;dur={duration_ms:.1f}',
+    ])
+    return response
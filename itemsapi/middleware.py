@@ -1,3 +1,8 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
 class RequestLoggingMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -11,3 +16,40 @@ class RequestLoggingMiddleware:
         print(f"Response Status: {response.status_code}")
         print(f"Response Content: {response.content}\n")
         return response
+
+
+class InstrumentationMiddleware:
+    """Records query count, DB time, serialization time and response size of sampled requests (see metrics)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        metrics.install_all()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        sample = metrics.start()
+        if sample is None:
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            metrics.discard(sample)
+            raise
+        return metrics.finish(sample, request, response)
+
+    async def __acall__(self, request):
+        sample = metrics.start()
+        if sample is None:
+            return await self.get_response(request)
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            metrics.discard(sample)
+            raise
+        return metrics.finish(sample, request, response)
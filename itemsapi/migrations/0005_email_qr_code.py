@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0004_item_listing_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='qr_code',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:08
+
+from django.db import migrations, models
+
+
+def populate_paths(apps, schema_editor):
+    Item = apps.get_model('itemsapi', 'Item')
+    paths = {}
+    batch = []
+    rows = Item.objects.order_by('tree_id', 'lft').values_list('id', 'parent_id', 'name')
+    for pk, parent_id, name in rows.iterator(chunk_size=2000):
+        parent = paths.get(parent_id)
+        paths[pk] = (f"{parent[0]}/{name}", f"{parent[1]}/{pk}") if parent else (name, str(pk))
+        batch.append(Item(id=pk, full_path=paths[pk][0], path_ids=paths[pk][1]))
+        if len(batch) >= 500:
+            Item.objects.bulk_update(batch, ['full_path', 'path_ids'])
+            batch = []
+    Item.objects.bulk_update(batch, ['full_path', 'path_ids'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0005_email_qr_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='full_path',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='path_ids',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(populate_paths, migrations.RunPython.noop),
+    ]
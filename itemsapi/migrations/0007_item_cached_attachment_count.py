@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:09
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_attachments(apps, schema_editor):
+    Item = apps.get_model('itemsapi', 'Item')
+    total = 0
+    for model_name in ('Note', 'File', 'Email', 'CodeIdentifier'):
+        model = apps.get_model('itemsapi', model_name)
+        counts = (model.objects.filter(item=OuterRef('pk')).order_by()
+                  .values('item').annotate(count=Count('pk')).values('count'))
+        total = total + Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+    Item.objects.update(cached_attachment_count=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0006_item_full_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='cached_attachment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_attachments, migrations.RunPython.noop),
+    ]
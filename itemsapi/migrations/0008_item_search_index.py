@@ -0,0 +1,51 @@
+from django.db import migrations
+
+
+SQLITE_CREATE = """
+    CREATE VIRTUAL TABLE itemsapi_item_search USING fts5(
+        name, qr_code, description, listing, notes, emails,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )
+"""
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE itemsapi_item_search (
+        item_id bigint PRIMARY KEY REFERENCES itemsapi_item (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX itemsapi_item_search_document ON itemsapi_item_search USING GIN (document)",
+]
+
+
+def create_search_index(apps, schema_editor):
+    from itemsapi import search
+
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = [SQLITE_CREATE]
+    elif vendor == 'postgresql':
+        statements = POSTGRES_CREATE
+    else:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+        search.BACKENDS[vendor].rebuild(cursor)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute("DROP TABLE IF EXISTS itemsapi_item_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0007_item_cached_attachment_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
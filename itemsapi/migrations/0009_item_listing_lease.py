@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0008_item_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='listing_lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('listing_worker', 'pending')), fields=['id'], name='item_listing_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('listing_lease_expires_at__isnull', False)), fields=['listing_lease_expires_at'], name='item_listing_lease_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['tree_id', 'lft'], name='itemsapi_item_tree_id_lft_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:26
+
+from django.db import migrations, models
+
+from itemsapi.models import email_content_hash
+
+
+def hash_emails(apps, schema_editor):
+    # Emails imported more than once keep their hash on the oldest copy only
+    Email = apps.get_model('itemsapi', 'Email')
+    seen = set()
+    changed = []
+    for email in Email.objects.order_by('id').iterator(chunk_size=2000):
+        content_hash = email_content_hash(None, email.from_address, email.received_at, email.subject, email.body)
+        if content_hash not in seen:
+            seen.add(content_hash)
+            email.content_hash = content_hash
+            changed.append(email)
+    Email.objects.bulk_update(changed, ['content_hash'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0009_item_listing_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='content_hash',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='message_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(hash_emails, migrations.RunPython.noop),
+    ]
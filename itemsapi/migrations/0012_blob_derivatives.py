@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0011_blob_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='derivatives_status',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=10),
+        ),
+    ]
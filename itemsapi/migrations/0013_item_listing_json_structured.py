@@ -0,0 +1,109 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:05
+
+import json
+from decimal import Decimal, InvalidOperation
+
+import django.db.models.fields.json
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def parse_listing(text):
+    """
+    Returns the JSON object stored as ``text``. Text that is not a JSON object
+    is kept under "raw", and a price that is not a number under "raw_price",
+    so the generated price column can always be computed.
+    """
+    try:
+        listing = json.loads(text)
+    except ValueError:
+        listing = None
+    if not isinstance(listing, dict):
+        return {'raw': text}
+    price = listing.get('price')
+    if price is not None and (isinstance(price, bool) or not isinstance(price, (int, float))):
+        try:
+            listing['price'] = float(Decimal(str(price).strip()))
+        except (InvalidOperation, ValueError):
+            listing['raw_price'] = listing.pop('price')
+    return listing
+
+
+def convert_listings(apps, schema_editor):
+    Item = apps.get_model('itemsapi', 'Item')
+    last_id = 0
+    while True:
+        rows = list(Item.objects.filter(id__gt=last_id, listing_json__isnull=False)
+                    .order_by('id').values_list('id', 'listing_json')[:BATCH_SIZE])
+        if not rows:
+            break
+        Item.objects.bulk_update([Item(id=pk, listing_data=parse_listing(text)) for pk, text in rows],
+                                 ['listing_data'])
+        last_id = rows[-1][0]
+
+
+def restore_listings(apps, schema_editor):
+    Item = apps.get_model('itemsapi', 'Item')
+    last_id = 0
+    while True:
+        rows = list(Item.objects.filter(id__gt=last_id, listing_data__isnull=False)
+                    .order_by('id').values_list('id', 'listing_data')[:BATCH_SIZE])
+        if not rows:
+            break
+        Item.objects.bulk_update([Item(id=pk, listing_json=json.dumps(listing)) for pk, listing in rows],
+                                 ['listing_json'])
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0012_blob_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='listing_data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(convert_listings, restore_listings),
+        migrations.RemoveField(
+            model_name='item',
+            name='listing_json',
+        ),
+        migrations.RenameField(
+            model_name='item',
+            old_name='listing_data',
+            new_name='listing_json',
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='listing_marketplace',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.fields.json.KT('listing_json__marketplace'), output_field=models.CharField(max_length=50)),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='listing_price',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(django.db.models.fields.json.KT('listing_json__price'), models.DecimalField(decimal_places=2, max_digits=12)), output_field=models.DecimalField(decimal_places=2, max_digits=12)),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='listing_status',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.fields.json.KT('listing_json__status'), output_field=models.CharField(max_length=20)),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['listing_status', 'listing_price', 'id'], name='item_listing_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['listing_marketplace', 'listing_price', 'id'], name='item_listing_market_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('listing_price__isnull', False)), fields=['listing_price', 'id'], name='item_listing_price_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0013_item_listing_json_structured'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='componenthistory',
+            name='first_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='componenthistory',
+            name='moves',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='componenthistory',
+            index=models.Index(fields=['item', 'changed_at', 'id'], name='history_item_changed_idx'),
+        ),
+    ]
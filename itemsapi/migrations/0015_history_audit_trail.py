@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:59
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0014_history_compaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='componenthistory',
+            name='item_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='componenthistory',
+            name='changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='componenthistory',
+            name='item',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='history', to='itemsapi.item'),
+        ),
+        migrations.AlterField(
+            model_name='componenthistory',
+            name='new_parent',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='new_parent_history', to='itemsapi.item'),
+        ),
+        migrations.AlterField(
+            model_name='componenthistory',
+            name='old_parent',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='old_parent_history', to='itemsapi.item'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:06
+
+import itemsapi.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0015_history_audit_trail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrashedSubtree',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item_id', models.BigIntegerField(unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('parent_id', models.BigIntegerField(blank=True, null=True)),
+                ('full_path', models.TextField(blank=True, default='')),
+                ('item_count', models.PositiveIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('snapshot', models.JSONField(encoder=itemsapi.models.SnapshotEncoder)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='componenthistory',
+            name='action_type',
+            field=models.CharField(choices=[('created', 'Created'), ('moved', 'Moved'), ('deleted', 'Deleted'), ('restored', 'Restored')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:18
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def copy_created_at(apps, schema_editor):
+    Blob = apps.get_model('itemsapi', 'Blob')
+    Blob.objects.update(last_referenced_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itemsapi', '0016_trashed_subtree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='last_referenced_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,131 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from django.conf import settings
 from django.db import models
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, Coalesce, Concat, Substr
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
+from mptt.querysets import TreeQuerySet
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.timezone import now
+
+PATH_SEPARATOR = '/'
+
+# Storage directories of content-addressed blobs and of their image derivatives
+BLOB_DIR = 'blobs'
+DERIVATIVE_DIR = 'derivatives'
+
+# Values of listing_json's "status" key
+LISTING_STATUSES = ('draft', 'active', 'sold', 'ended')
+
+# Related names counted by Item.attachment_count
+COUNTED_ATTACHMENTS = ('notes', 'files', 'emails', 'codes')
+
+
+def attachment_count_expression():
+    """Returns an expression summing one correlated COUNT subquery per attachment type"""
+    total = None
+    for related_name in COUNTED_ATTACHMENTS:
+        model = Item._meta.get_field(related_name).related_model
+        counts = (model.objects.filter(item=OuterRef('pk')).order_by()
+                  .values('item').annotate(count=Count('pk')).values('count'))
+        term = Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+        total = term if total is None else total + term
+    return total
+
+
+def email_content_hash(message_id, from_address, received_at, subject, body):
+    """Dedupe key of an email: its Message-ID when it has one, else its sender, date, subject and body"""
+    if message_id:
+        source = message_id.strip()
+    else:
+        if received_at.tzinfo is not None:
+            received_at = received_at.astimezone(timezone.utc)
+        source = '\0'.join((from_address, received_at.isoformat(), subject, body))
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+class ItemQuerySet(TreeQuerySet):
+    def with_attachment_count(self):
+        """Annotates attachment_count, from the cached counter column when ITEMSAPI_CACHED_ATTACHMENT_COUNTS is set"""
+        if getattr(settings, 'ITEMSAPI_CACHED_ATTACHMENT_COUNTS', False):
+            return self.annotate(attachment_count=F('cached_attachment_count'))
+        return self.annotate(attachment_count=attachment_count_expression())
+
+
+class ItemManager(TreeManager.from_queryset(ItemQuerySet)):
+    def rebuild(self, batch_size=1000, **filters):
+        """Rebuilds MPTT coordinates, then the materialized paths that depend on them"""
+        super().rebuild(batch_size=batch_size, **filters)
+        self.rebuild_paths(**filters)
+
+    def rebuild_paths(self, **filters):
+        """Recomputes full_path/path_ids in one ordered pass, writing only rows that changed"""
+        rows = self.filter(**filters).order_by('tree_id', 'lft').values_list('id', 'parent_id', 'name', 'full_path', 'path_ids')
+        paths = {}
+        changed = []
+        for pk, parent_id, name, full_path, path_ids in rows.iterator(chunk_size=2000):
+            parent = paths.get(parent_id)
+            new_paths = (
+                (f"{parent[0]}{PATH_SEPARATOR}{name}", f"{parent[1]}{PATH_SEPARATOR}{pk}")
+                if parent else (name, str(pk))
+            )
+            paths[pk] = new_paths
+            if new_paths != (full_path, path_ids):
+                changed.append(self.model(id=pk, full_path=new_paths[0], path_ids=new_paths[1]))
+        self.bulk_update(changed, ['full_path', 'path_ids'], batch_size=500)
+        return len(changed)
+
+    def recount_attachments(self, **filters):
+        """Resynchronizes cached_attachment_count with the attachment tables in one UPDATE"""
+        return self.filter(**filters).update(cached_attachment_count=attachment_count_expression())
+
 
 class Item(MPTTModel):
     name = models.CharField(max_length=255, db_index=True)
-    listing_json = models.TextField(blank=True, null=True)
+    listing_json = models.JSONField(blank=True, null=True)
+    # Hot keys of listing_json, computed and stored by the database so GET /listings filters and sorts in SQL
+    listing_price = models.GeneratedField(
+        expression=Cast(KT('listing_json__price'), models.DecimalField(max_digits=12, decimal_places=2)),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2), db_persist=True)
+    listing_status = models.GeneratedField(
+        expression=KT('listing_json__status'), output_field=models.CharField(max_length=20), db_persist=True)
+    listing_marketplace = models.GeneratedField(
+        expression=KT('listing_json__marketplace'), output_field=models.CharField(max_length=50), db_persist=True)
     listing_worker = models.CharField(max_length=255, blank=True, null=True)
+    # End of the claiming worker's lease; NULL while pending or once completed
+    listing_lease_expires_at = models.DateTimeField(blank=True, null=True)
     qr_code = models.CharField(max_length=255, db_index=True, blank=True, null=True)
     description = models.TextField(blank=True, null=True)
     parent = TreeForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized "Root/.../Name" and "1/.../id" paths, kept current by save()
+    full_path = models.TextField(blank=True, default='', editable=False)
+    path_ids = models.TextField(blank=True, default='', editable=False)
+    # Number of notes, files, emails and codes, kept current by itemsapi.signals
+    cached_attachment_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ItemManager()
+
+    class Meta:
+        indexes = [
+            # Keep job claims (itemsapi.jobs) flat however large the backlog grows
+            models.Index(fields=['id'], condition=models.Q(listing_worker='pending'),
+                         name='item_listing_pending_idx'),
+            models.Index(fields=['listing_lease_expires_at'],
+                         condition=models.Q(listing_lease_expires_at__isnull=False),
+                         name='item_listing_lease_idx'),
+            # GET /listings: filtered by status or marketplace, sorted by price then id
+            models.Index(fields=['listing_status', 'listing_price', 'id'], name='item_listing_status_idx'),
+            models.Index(fields=['listing_marketplace', 'listing_price', 'id'], name='item_listing_market_idx'),
+            models.Index(fields=['listing_price', 'id'], condition=models.Q(listing_price__isnull=False),
+                         name='item_listing_price_idx'),
+        ]
 
     class MPTTMeta:
         order_insertion_by = ['name']
@@ -17,26 +133,81 @@ class Item(MPTTModel):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._path_source = (instance.__dict__.get('parent_id'), instance.__dict__.get('name'))
+        instance._tree_source = instance.__dict__.get('tree_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Saves the item and refreshes the materialized paths of its subtree on create, move or rename"""
+        adding = self._state.adding
+        source = getattr(self, '_path_source', None)
+        # Read by the history receiver: only a real parent change is logged as a move
+        self._previous_parent_id = source[0] if source else None
+        self._parent_changed = not adding and (source is None or source[0] != self.parent_id)
+        # Read by the cache receiver: None while the paths are unchanged, else the ids path before this save
+        self._previous_path_ids = None
+        # Read by the geometry receiver: the tree the item was loaded from, which a move may have changed
+        self._previous_tree_id = getattr(self, '_tree_source', None)
+        if not adding and source == (self.parent_id, self.name):
+            super().save(*args, **kwargs)
+            return
+
+        ids = [pk for pk in (None if adding else self.pk, self.parent_id) if pk is not None]
+        current = {
+            pk: (full_path, path_ids)
+            for pk, full_path, path_ids in Item.objects.filter(pk__in=ids).values_list('id', 'full_path', 'path_ids')
+        } if ids else {}
+        parent_path, parent_ids = current.get(self.parent_id, (None, None))
+        full_path = f"{parent_path}{PATH_SEPARATOR}{self.name}" if parent_path else self.name
+        if adding:
+            self._previous_path_ids = ''
+            self.full_path, self.path_ids = full_path, parent_ids or ''
+            super().save(*args, **kwargs)
+            self.path_ids = f"{parent_ids}{PATH_SEPARATOR}{self.pk}" if parent_ids else str(self.pk)
+            Item.objects.filter(pk=self.pk).update(path_ids=self.path_ids)
+        else:
+            # The row keeps its old paths until the range UPDATE below rewrites the whole subtree
+            self.full_path, self.path_ids = old_path, old_ids = current[self.pk]
+            self._previous_path_ids = old_ids
+            path_ids = f"{parent_ids}{PATH_SEPARATOR}{self.pk}" if parent_ids else str(self.pk)
+            super().save(*args, **kwargs)
+            Item.objects.filter(tree_id=self.tree_id, lft__gte=self.lft, rght__lte=self.rght).update(
+                full_path=Concat(Value(full_path), Substr('full_path', len(old_path) + 1),
+                                 output_field=models.TextField()),
+                path_ids=Concat(Value(path_ids), Substr('path_ids', len(old_ids) + 1),
+                                output_field=models.TextField()),
+            )
+            self.full_path, self.path_ids = full_path, path_ids
+        self._path_source = (self.parent_id, self.name)
+        self._tree_source = self.tree_id
+
     def validate_move(self, new_parent):
         """Validates move operation before execution"""
+        from . import geometry
+
         if new_parent:
-            if self.is_ancestor_of(new_parent):
+            if geometry.is_ancestor(self, new_parent):
                 raise ValidationError("Cannot move item under its own descendant")
             if new_parent == self:
                 raise ValidationError("Cannot move item under itself")
         return True
 
     def move_under(self, new_parent):
-        """Enhanced move method with validation and history tracking"""
-        try:
-            self.validate_move(new_parent)
-            old_parent = self.parent
-            self._previous_parent = old_parent
-            self.parent = new_parent
-            self.save()
+        """Moves the item and its subtree under ``new_parent`` (None for a root), keeping siblings in name order"""
+        self.validate_move(new_parent)
+        if self.parent_id == (new_parent.pk if new_parent else None):
             return self
-        except ValidationError as e:
-            raise e  # Re-raise to be caught by view layer
+        # move_to() would save every column; shift the coordinates the same way, then write the parent only
+        right_sibling = self._mptt_meta.get_ordered_insertion_target(self, new_parent)
+        if right_sibling:
+            self._tree_manager._move_node(self, right_sibling, 'left')
+        else:
+            self._tree_manager._move_node(self, new_parent, 'last-child')
+        self.save(update_fields=['parent'])
+        return self
 
     def get_inventory_tree(self):
         """Returns complete inventory structure"""
@@ -48,7 +219,7 @@ class Item(MPTTModel):
 
     def get_full_path(self):
         """Returns complete path from root to this item"""
-        return '/'.join([item.name for item in self.get_ancestors(include_self=True)])
+        return self.full_path
     @classmethod
     def get_prefetch_fields(cls):
         """Returns list of related fields to prefetch for better performance"""
@@ -60,14 +231,18 @@ class Item(MPTTModel):
             'codes',
             'history'
         ]
+    def subtree_q(self, prefix='item'):
+        """Q selecting rows whose ``prefix`` relation is this item or a descendant, as a join on tree_id and lft"""
+        return Q(**{f'{prefix}__tree_id': self.tree_id, f'{prefix}__lft__range': (self.lft, self.rght)})
+
     def get_all_attachments(self):
         """Returns all types of attachments for this item and descendants"""
-        item_ids = self.get_descendants(include_self=True).values_list('id', flat=True)
+        subtree = self.subtree_q()
         return {
-            'notes': Note.objects.filter(item_id__in=item_ids),
-            'files': File.objects.filter(item_id__in=item_ids),
-            'emails': Email.objects.filter(item_id__in=item_ids),
-            'codes': CodeIdentifier.objects.filter(item_id__in=item_ids)
+            'notes': Note.objects.filter(subtree),
+            'files': File.objects.filter(subtree),
+            'emails': Email.objects.filter(subtree),
+            'codes': CodeIdentifier.objects.filter(subtree)
         }
 class CodeIdentifier(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='codes')
@@ -81,11 +256,88 @@ class Note(models.Model):
     author = models.CharField(max_length=255, default='System')
     created_at = models.DateTimeField(auto_now_add=True)
 
+class BlobManager(models.Manager):
+    def store(self, content):
+        """Returns the Blob holding ``content``, writing it to storage only when no blob has its SHA-256"""
+        # HashingUploadHandler hashes uploads while they are received
+        digest = getattr(content, 'sha256', None)
+        if digest is None:
+            hasher = hashlib.sha256()
+            for chunk in content.chunks():
+                hasher.update(chunk)
+            digest = hasher.hexdigest()
+        # Refreshed before it is returned, so gc_blobs keeps a reused blob for its grace period
+        if self.filter(pk=digest).update(last_referenced_at=now()):
+            return self.get(pk=digest)
+        storage = File._meta.get_field('file').storage
+        extension = os.path.splitext(content.name or '')[1].lower()[:16]
+        # A file whose row is rolled back is left without one; gc_blobs deletes it after the grace period
+        name = storage.save(f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{extension}", content)
+        try:
+            blob, created = self.get_or_create(sha256=digest, defaults={'name': name, 'size': content.size})
+        except Exception:
+            storage.delete(name)
+            raise
+        if not created:
+            # A concurrent upload of the same content was stored first
+            storage.delete(name)
+            self.filter(pk=digest).update(last_referenced_at=now())
+        return blob
+
+class Blob(models.Model):
+    """File content stored once per SHA-256 and shared by every File holding it"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    # Number of File rows pointing here, kept by itemsapi.signals
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last time an upload stored or reused this content; the gc_blobs grace period counts from it
+    last_referenced_at = models.DateTimeField(default=now)
+
+    # Image derivatives rendered by itemsapi.thumbnails
+    DERIVATIVES = ('thumbnail', 'preview')
+    PENDING = ''
+    READY = 'ready'
+    FAILED = 'failed'
+    derivatives_status = models.CharField(max_length=10, blank=True, default=PENDING, db_index=True)
+
+    objects = BlobManager()
+
+def derivative_name(sha256, kind):
+    """Storage name of one derivative (``Blob.DERIVATIVES``) of the blob ``sha256``"""
+    return f"{DERIVATIVE_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}-{kind}.webp"
+
+def derivative_url(sha256, status, kind):
+    """URL of a derivative, or None until it has been rendered"""
+    if not sha256 or status != Blob.READY:
+        return None
+    return File._meta.get_field('file').storage.url(derivative_name(sha256, kind))
+
 class File(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='files')
     file = models.FileField(upload_to='attachments/')
     file_type = models.CharField(max_length=50)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Null for files stored under attachments/ before the blob store
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, editable=False,
+                             related_name='files')
+
+    @property
+    def thumbnail(self):
+        return derivative_url(self.blob_id, self.blob.derivatives_status, 'thumbnail') if self.blob_id else None
+
+    @property
+    def preview(self):
+        return derivative_url(self.blob_id, self.blob.derivatives_status, 'preview') if self.blob_id else None
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.file._committed:
+            # New content goes to the shared blob store rather than upload_to
+            self.blob = Blob.objects.store(self.file.file)
+            self.file.name = self.blob.name
+            self.file._committed = True
+        super().save(*args, **kwargs)
 
 class Email(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='emails')
@@ -95,22 +347,70 @@ class Email(models.Model):
     received_at = models.DateTimeField()
     created_at = models.DateTimeField(auto_now_add=True)
     qr_code = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    message_id = models.CharField(max_length=255, blank=True, null=True)
+    # email_content_hash() of the message; unique so a message is only imported once
+    content_hash = models.CharField(max_length=64, unique=True, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        if self.content_hash is None:
+            self.content_hash = self.compute_content_hash()
+        super().save(*args, **kwargs)
+
+    def compute_content_hash(self):
+        received_at = self._meta.get_field('received_at').to_python(self.received_at)
+        return email_content_hash(self.message_id, self.from_address, received_at, self.subject, self.body)
 
 class ComponentHistory(models.Model):
     CREATED = 'created'
     MOVED = 'moved'
     DELETED = 'deleted'
+    RESTORED = 'restored'
     ACTION_CHOICES = [
         (CREATED, 'Created'),
         (MOVED, 'Moved'),
         (DELETED, 'Deleted'),
+        (RESTORED, 'Restored'),
     ]
     
-    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='history')
-    old_parent = models.ForeignKey(Item, on_delete=models.SET_NULL, null=True, related_name='old_parent_history')
-    new_parent = models.ForeignKey(Item, on_delete=models.SET_NULL, null=True, related_name='new_parent_history')
+    # An audit trail: rows are written by itemsapi.history and outlive the items they mention
+    item = models.ForeignKey(Item, on_delete=models.DO_NOTHING, db_constraint=False, related_name='history')
+    old_parent = models.ForeignKey(Item, on_delete=models.DO_NOTHING, db_constraint=False, null=True,
+                                   related_name='old_parent_history')
+    new_parent = models.ForeignKey(Item, on_delete=models.DO_NOTHING, db_constraint=False, null=True,
+                                   related_name='new_parent_history')
     action_type = models.CharField(max_length=20, choices=ACTION_CHOICES)
-    changed_at = models.DateTimeField(auto_now_add=True)
+    changed_at = models.DateTimeField(default=now)
+    # Name of the item, recorded on deletion
+    item_name = models.CharField(max_length=255, blank=True, default='')
+    # Set by history.compact: the row stands for ``moves`` parent changes made from first_changed_at on
+    moves = models.PositiveIntegerField(default=1)
+    first_changed_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-changed_at']
+        indexes = [
+            # Per-item history pages and the latest row per item as of a time (history.parents_as_of)
+            models.Index(fields=['item', 'changed_at', 'id'], name='history_item_changed_idx'),
+        ]
+
+
+class SnapshotEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder keeping the microseconds of datetimes, so restored rows compare equal"""
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class TrashedSubtree(models.Model):
+    """A subtree deleted in trash mode, kept as a snapshot of its rows until restored or purged (itemsapi.deletion)"""
+    # Id of the subtree's root item, which keeps it on restore
+    item_id = models.BigIntegerField(unique=True)
+    name = models.CharField(max_length=255)
+    parent_id = models.BigIntegerField(null=True, blank=True)
+    full_path = models.TextField(blank=True, default='')
+    item_count = models.PositiveIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # {table: [row values]} of the items and their attachments
+    snapshot = models.JSONField(encoder=SnapshotEncoder)
@@ -0,0 +1,95 @@
+"""
+Keyset (cursor) pagination for list endpoints.
+
+A page is the ``limit`` rows that follow the cursor in the queryset's sort
+order, so a page deep into a large table costs the same as the first one.
+Cursors are opaque URL-safe strings; list bodies stay plain JSON arrays and
+the cursor for the following page is returned in the ``X-Next-Cursor``
+response header.
+"""
+import base64
+import json
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from ninja.errors import HttpError
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+def clamp_limit(limit, default=DEFAULT_LIMIT):
+    return default if limit is None else max(1, min(limit, MAX_LIMIT))
+
+
+def encode_cursor(values):
+    payload = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise HttpError(422, "Invalid cursor")
+
+
+def _after(model, keys, values):
+    """Returns a Q selecting rows strictly after ``values`` in the ``keys`` ordering"""
+    q = Q()
+    equal = Q()
+    for key, value in zip(keys, values):
+        name = key.lstrip('-')
+        field = model._meta.get_field(name)
+        value = (field.output_field if field.generated else field).to_python(value)
+        lookup = f"{name}__lt" if key.startswith('-') else f"{name}__gt"
+        q |= equal & Q(**{lookup: value})
+        equal &= Q(**{name: value})
+    return q
+
+
+def _page_queryset(queryset, keys, cursor, limit):
+    queryset = queryset.order_by(*keys)
+    if cursor:
+        values = decode_cursor(cursor)
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise HttpError(422, "Invalid cursor")
+        queryset = queryset.filter(_after(queryset.model, keys, values))
+    return queryset[:limit + 1]
+
+
+def _page(rows, keys, limit):
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    values = [getattr(rows[-1], key.lstrip('-')) for key in keys]
+    # DjangoJSONEncoder would cut datetimes to milliseconds, skipping the rows in between
+    return rows, encode_cursor([value.isoformat() if isinstance(value, datetime) else value for value in values])
+
+
+def keyset_page(queryset, keys, cursor=None, limit=DEFAULT_LIMIT):
+    """Returns (rows, next_cursor) for the page of ``queryset`` ordered by ``keys`` that follows ``cursor``"""
+    return _page(list(_page_queryset(queryset, keys, cursor, limit)), keys, limit)
+
+
+async def akeyset_page(queryset, keys, cursor=None, limit=DEFAULT_LIMIT):
+    """``keyset_page`` through the async ORM"""
+    return _page([row async for row in _page_queryset(queryset, keys, cursor, limit)], keys, limit)
+
+
+def offset_page(cursor=None, offset=0):
+    """Decodes a cursor for ranked results that cannot be keyed, returning the offset it points to"""
+    if not cursor:
+        return offset
+    values = decode_cursor(cursor)
+    if not isinstance(values, dict) or not isinstance(values.get('offset'), int):
+        raise HttpError(422, "Invalid cursor")
+    return values['offset']
+
+
+def set_next_cursor(response, next_cursor):
+    if next_cursor:
+        response[NEXT_CURSOR_HEADER] = next_cursor
@@ -0,0 +1,106 @@
+"""
+Response encodings.
+
+``NegotiatingRenderer`` encodes responses as MessagePack when the Accept
+header prefers ``application/msgpack`` (and msgpack is installed), as JSON
+otherwise. JSON is written by orjson when it is installed, falling back to
+the standard library. Values either library would encode differently from
+Django's JSON encoder (datetimes, decimals, schemas) go through that
+encoder, so every encoding carries the same documents.
+"""
+from django.utils.cache import patch_vary_headers
+from ninja.renderers import BaseRenderer
+from ninja.responses import NinjaJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+_encoder = NinjaJSONEncoder()
+
+
+def _default(value):
+    return _encoder.default(value)
+
+
+def _accepted(accept):
+    """Yields (media type, quality) of the Accept header in header order"""
+    for part in accept.split(','):
+        media_type, *params = [piece.strip() for piece in part.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            yield media_type.lower(), quality
+
+
+def media_type(request):
+    """MSGPACK when the request's most preferred media type is MessagePack, else JSON"""
+    if msgpack is None:
+        return JSON
+    accept = request.headers.get('Accept', '')
+    if 'msgpack' not in accept:
+        return JSON
+    best, best_quality = JSON, 0.0
+    for accepted, quality in _accepted(accept):
+        if quality > best_quality:
+            best, best_quality = accepted, quality
+    return MSGPACK if best in MSGPACK_TYPES else JSON
+
+
+def content_type(request):
+    negotiated = media_type(request)
+    return negotiated if negotiated == MSGPACK else f"{JSON}; charset=utf-8"
+
+
+def dumps(data):
+    """``data`` as JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return _encoder.encode(data).encode()
+
+
+def packb(data):
+    """``data`` as MessagePack bytes"""
+    return msgpack.packb(data, default=_default, datetime=False)
+
+
+def set_content_type(request, response):
+    """Labels ``response`` with the encoding negotiated for ``request``"""
+    response['Content-Type'] = content_type(request)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def render_response(request, renderer, data, response):
+    """
+    Fills ``response`` with ``data`` encoded by ``renderer``, for views whose
+    documents are built as plain dicts and skip their response schema.
+    """
+    response.content = renderer.render(request, data, response_status=response.status_code)
+    return set_content_type(request, response)
+
+
+class NegotiatingRenderer(BaseRenderer):
+    media_type = JSON
+
+    def render(self, request, data, *, response_status):
+        if media_type(request) == MSGPACK:
+            return packb(data)
+        return dumps(data)
@@ -1,50 +1,145 @@
+from asgiref.sync import sync_to_async
 from ninja import Router, File
 from ninja.errors import HttpError
 from ninja.files import UploadedFile
-from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from mptt.exceptions import InvalidMove
+from datetime import datetime
 from typing import List, Optional
 from django.core.exceptions import ValidationError
-from .models import ComponentHistory, Item, Note, File as FileModel, Email
+from .models import ComponentHistory, Item, Note, File as FileModel, Email, TrashedSubtree
 from .schemas import (
-    ComponentHistorySchema, ItemCreate, ItemOut, MovePayload,
-    NoteCreate, NoteSchema, FileSchema, ListingUpdate, EmailCreate, EmailSchema
+    BulkImport, BulkImportResult, ComponentHistorySchema, ItemCreate, ItemFieldsOut, ItemOut, MoveBatch, MovePayload,
+    NoteCreate, NoteSchema, FileSchema, ListingUpdate, EmailBulk, EmailBulkResult, EmailCreate, EmailSchema,
+    HistoricalItem, ItemSkeleton, ListingOut, SubtreeAttachments, TrashedSubtreeOut
 )
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import (attachments, bulk, cache, deletion, emails, export, geometry, history, jobs, metrics, pagination,
+               renderers, search, tree)
 
 router = Router()
-@router.get("/items", response=List[ItemOut])
-def list_items(request):
-    """Get full inventory tree starting from root items (computers, storage, etc)"""
-    return Item.objects.root_nodes().prefetch_related(*Item.get_prefetch_fields())
+# The API's renderer, also used by views that render their documents themselves
+RENDERER = metrics.TimedRenderer(renderers.NegotiatingRenderer())
+
+def _selection(fields, expand):
+    try:
+        return tree.parse_selection(fields, expand)
+    except ValueError as e:
+        raise HttpError(422, str(e))
+
+@router.get("/items", response=List[ItemFieldsOut], exclude_unset=True)
+async def list_items(request, response: HttpResponse, fields: Optional[str] = None, expand: Optional[str] = None,
+                     cursor: Optional[str] = None, limit: Optional[int] = None):
+    """Get full inventory tree starting from root items (computers, storage, etc)
+
+    Pass ``limit``/``cursor`` to page through root items and ``fields``/``expand`` to trim the payload.
+    """
+    selection = _selection(fields, expand)
+    if limit is None and cursor is None:
+        return await cache.arespond(request, response, await cache.alist_key(request.GET.urlencode()),
+                                    lambda: tree.abuild_forest(selection))
+    roots, next_cursor = await pagination.akeyset_page(
+        Item.objects.root_nodes(), ('tree_id', 'lft'), cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return await tree.abuild_subtrees(roots, selection)
+
+@router.get("/items/export")
+def export_items(request, format: str = 'ndjson', fields: Optional[str] = None, expand: Optional[str] = None):
+    """Stream the whole inventory as NDJSON (one flat item per line) or as nested JSON (format=json)"""
+    if format not in export.FORMATS:
+        raise HttpError(422, f"Unknown format '{format}', expected one of: {', '.join(export.FORMATS)}")
+    selection = _selection(fields, expand)
+    response = StreamingHttpResponse(export.stream(format, selection), content_type=export.FORMATS[format])
+    response['Content-Disposition'] = f'attachment; filename="inventory.{format}"'
+    return response
+
+@router.get("/items/skeleton", response=List[ItemSkeleton])
+async def get_skeleton(request, response: HttpResponse):
+    """Get the whole inventory as a lean tree of names, for tree views and pickers
+
+    The rows come from the ORM as plain dicts and are rendered without going through the response schema.
+    """
+    payload = await cache.arespond(request, response, await cache.alist_key('skeleton'),
+                                   tree.abuild_skeleton)
+    if isinstance(payload, HttpResponse):
+        return payload
+    return renderers.render_response(request, RENDERER, payload, response)
+
+def _aware(at):
+    return timezone.make_aware(at) if timezone.is_naive(at) else at
+
+@router.get("/items/as-of", response=List[HistoricalItem])
+def get_inventory_as_of(request, at: datetime):
+    """Get the inventory tree as it was laid out at time ``at``, rebuilt from the movement history"""
+    return history.layout_as_of(_aware(at))
+
+@router.get("/items/search", response=List[ItemFieldsOut], exclude_unset=True)
+async def search_items(request, response: HttpResponse, q: str, limit: Optional[int] = None, offset: int = 0,
+                       cursor: Optional[str] = None, fields: Optional[str] = None, expand: Optional[str] = None):
+    """Search components by name, description, QR code, listing, notes or emails, best match first"""
+    selection = _selection(fields, expand)
+    limit = pagination.clamp_limit(limit, default=50)
+    offset = pagination.offset_page(cursor, offset)
+    # The index is queried with raw SQL, which has no async API
+    items = await sync_to_async(search.search_items)(q, limit=limit + 1, offset=offset)
+    if len(items) > limit:
+        items = items[:limit]
+        pagination.set_next_cursor(response, pagination.encode_cursor({'offset': offset + limit}))
+    return await tree.abuild_subtrees(items, selection)
+
+@router.post("/items/bulk", response={201: BulkImportResult})
+def bulk_create_items(request, payload: BulkImport):
+    """Import many items at once, as nested children or a flat list linked by ref/parent_ref"""
+    with transaction.atomic():
+        try:
+            created, refs = bulk.import_items(payload.items, payload.parent_id)
+        except bulk.BulkImportError as e:
+            raise HttpError(422, str(e))
+    return 201, {'created': len(created), 'ids': [obj.pk for obj in created], 'refs': refs}
+
+@router.put("/items/move-batch", response=List[ItemOut])
+def move_items(request, payload: MoveBatch):
+    """Move many items at once, renumbering each affected tree a single time"""
+    with transaction.atomic():
+        try:
+            moved = bulk.move_items([(move.item_id, move.new_parent_id or None) for move in payload.moves])
+        except bulk.BulkMoveError as e:
+            raise HttpError(422, str(e))
+        items = Item.objects.in_bulk(moved)
+        history.flush()  # The response lists the new history rows
+        return tree.build_subtrees([items[pk] for pk in moved])
 
 @router.get("/items/{item_id}", response=ItemOut)
-def get_item(request, item_id: int):
+async def get_item(request, response: HttpResponse, item_id: int):
     """Get item with its complete subtree (e.g., GPU with waterblock)"""
-    return get_object_or_404(Item.objects.prefetch_related(*Item.get_prefetch_fields()), id=item_id)
+    async def build():
+        return await tree.abuild_subtree(await aget_object_or_404(Item, id=item_id))
+
+    return await cache.arespond(request, response, await cache.aitem_key(item_id), build)
 
 @router.get("/items/{item_id}/path", response=List[ItemOut])
-def get_component_path(request, item_id: int):
+async def get_component_path(request, response: HttpResponse, item_id: int):
     """Get full path to component (e.g., Shop->Laptop->Motherboard->CPU)"""
-    item = get_object_or_404(Item, id=item_id)
-    return item.get_ancestors(include_self=True)
+    item = await aget_object_or_404(Item, id=item_id)
+
+    async def build():
+        # The ancestors come from the in-process tree geometry, without a query
+        return await tree.abuild_subtrees(await sync_to_async(geometry.ancestors)(item, include_self=True))
+
+    return await cache.arespond(request, response, await cache.apath_key(item), build)
 
-@router.get("/items/{item_id}/siblings", response=List[ItemOut])
-def get_similar_components(request, item_id: int):
+@router.get("/items/{item_id}/siblings", response=List[ItemFieldsOut], exclude_unset=True)
+def get_similar_components(request, response: HttpResponse, item_id: int, cursor: Optional[str] = None,
+                           limit: Optional[int] = None, fields: Optional[str] = None, expand: Optional[str] = None):
     """Get components at same level - useful for finding compatible parts"""
+    selection = _selection(fields, expand)
     item = get_object_or_404(Item, id=item_id)
-    return item.get_siblings(include_self=False)
-
-@router.get("/items/search", response=List[ItemOut])
-def search_items(request, q: str):
-    """Search components by name, description or QR code"""
-    return Item.objects.filter(
-        Q(name__icontains=q) |
-        Q(description__icontains=q) |
-        Q(qr_code__iexact=q) |
-        Q(listing_json__icontains=q)
-    ).prefetch_related(*Item.get_prefetch_fields())
+    siblings, next_cursor = pagination.keyset_page(
+        item.get_siblings(include_self=False), ('tree_id', 'lft'), cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return tree.build_subtrees(siblings, selection)
 
 @router.post("/items", response={201: ItemOut})
 def create_item(request, payload: ItemCreate):
@@ -56,13 +151,26 @@ def create_item(request, payload: ItemCreate):
             qr_code=payload.qr_code,
             parent=parent
         )
-        return 201, item
+        history.flush()
+        return 201, tree.build_subtree(item)
     
 @router.get("/items/{item_id}/history", response=List[ComponentHistorySchema])
-def get_item_history(request, item_id: int):
-    """Get complete movement history for a component"""
-    item = get_object_or_404(Item, id=item_id)
-    return item.history.all()
+async def get_item_history(request, response: HttpResponse, item_id: int, cursor: Optional[str] = None,
+                           limit: Optional[int] = None):
+    """Get movement history for a component, newest first"""
+    item = await aget_object_or_404(Item, id=item_id)
+    rows, next_cursor = await pagination.akeyset_page(
+        item.history.all(), ('-changed_at', '-id'), cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return rows
+
+@router.get("/items/{item_id}/as-of", response=HistoricalItem)
+def get_item_as_of(request, item_id: int, at: datetime):
+    """Get the subtree of a component as it was at time ``at``"""
+    layout = history.layout_as_of(_aware(at), item_id)
+    if layout is None:
+        raise HttpError(404, f"Item {item_id} did not exist at {at.isoformat()}")
+    return layout
 
 @router.put("/items/{item_id}/move", response=ItemOut)
 def move_item(request, item_id: int, payload: MovePayload):
@@ -71,16 +179,51 @@ def move_item(request, item_id: int, payload: MovePayload):
         new_parent = get_object_or_404(Item, id=payload.new_parent_id) if payload.new_parent_id else None
         try:
             moved_item = item.move_under(new_parent)
-            return moved_item
+            history.flush()
+            return tree.build_subtree(moved_item)
         except ValidationError as e:
             raise HttpError(422, str(e))
 
-
 @router.delete("/items/{item_id}", response={204: None})
-def delete_item(request, item_id: int):
-    """Delete component and all its subcomponents"""
-    item = get_object_or_404(Item, id=item_id)
-    item.delete()
+def delete_item(request, item_id: int, trash: bool = False):
+    """Delete component and all its subcomponents
+
+    With ``trash=true`` the subtree goes to the trash, from which POST /trash/{item_id}/restore brings it back.
+    """
+    with transaction.atomic():
+        item = get_object_or_404(Item, id=item_id)
+        if trash:
+            deletion.trash_subtree(item)
+        else:
+            deletion.delete_subtree(item)
+    return 204, None
+
+@router.get("/trash", response=List[TrashedSubtreeOut])
+def list_trash(request, response: HttpResponse, cursor: Optional[str] = None, limit: Optional[int] = None):
+    """Get the subtrees deleted to the trash, most recent first"""
+    trashed, next_cursor = pagination.keyset_page(
+        TrashedSubtree.objects.defer('snapshot'), ('-deleted_at', '-id'), cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return trashed
+
+@router.post("/trash/{item_id}/restore", response=ItemOut)
+def restore_item(request, item_id: int):
+    """Put a trashed subtree back where it was, with its attachments"""
+    with transaction.atomic():
+        trashed = get_object_or_404(TrashedSubtree, item_id=item_id)
+        try:
+            with transaction.atomic():
+                item = deletion.restore(trashed)
+        except IntegrityError:
+            raise HttpError(409, f"Item {item_id} cannot be restored: some of its rows were recreated since")
+        history.flush()
+        return tree.build_subtree(item)
+
+@router.delete("/trash/{item_id}", response={204: None})
+def purge_trashed_item(request, item_id: int):
+    """Delete a trashed subtree for good"""
+    with transaction.atomic():
+        deletion.purge(get_object_or_404(TrashedSubtree, item_id=item_id))
     return 204, None
 
 @router.post("/items/{item_id}/notes", response=NoteSchema)
@@ -95,29 +238,103 @@ def add_note(request, item_id: int, payload: NoteCreate):
     return note
 
 @router.get("/items/{item_id}/notes", response=List[NoteSchema])
-def get_item_notes(request, item_id: int):
-    """Get all notes for an item"""
-    item = get_object_or_404(Item, id=item_id)
-    return item.notes.all().order_by('-created_at')
+async def get_item_notes(request, response: HttpResponse, item_id: int, cursor: Optional[str] = None,
+                         limit: Optional[int] = None):
+    """Get notes for an item, newest first"""
+    item = await aget_object_or_404(Item, id=item_id)
+    notes, next_cursor = await pagination.akeyset_page(
+        item.notes.all(), ('-created_at', '-id'), cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return notes
+
+@router.get("/items/{item_id}/attachments", response=SubtreeAttachments, exclude_unset=True)
+async def get_subtree_attachments(request, response: HttpResponse, item_id: int, types: Optional[str] = None,
+                                  cursor: Optional[str] = None, limit: Optional[int] = None):
+    """Get the attachments of a component and all its subcomponents, newest first, with counts per type
+
+    types: comma separated subset of notes, files, emails and codes
+    """
+    item = await aget_object_or_404(Item.objects.only('tree_id', 'lft', 'rght'), id=item_id)
+    try:
+        types = attachments.parse_types(types)
+    except ValueError as e:
+        raise HttpError(422, str(e))
+    result, next_cursor = await sync_to_async(attachments.subtree)(
+        item, types, cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return result
 
 @router.put("/items/{item_id}/listing", response=ItemOut)
 def update_listing(request, item_id: int, payload: ListingUpdate):
     """Update item's listing data and set worker status to pending"""
     item = get_object_or_404(Item, id=item_id)
-    item.listing_json = payload.listing_json
-    item.listing_worker = 'pending'  # Set to pending when listing is updated
-    item.save()
-    return item
+    item.listing_json = payload.listing_json.model_dump(mode='json', exclude_unset=True)
+    item.listing_worker = jobs.PENDING  # Set to pending when listing is updated
+    item.listing_lease_expires_at = None
+    item.save(update_fields=['listing_json', 'listing_worker', 'listing_lease_expires_at'])
+    return tree.build_subtree(item)
+
+LISTING_SORTS = {
+    'id': ('id',),
+    '-id': ('-id',),
+    'price': ('listing_price', 'id'),
+    '-price': ('-listing_price', '-id'),
+}
+
+@router.get("/listings", response=List[ListingOut])
+async def list_listings(request, response: HttpResponse, status: Optional[str] = None,
+                        marketplace: Optional[str] = None, min_price: Optional[float] = None,
+                        max_price: Optional[float] = None, sort: str = '-id', cursor: Optional[str] = None,
+                        limit: Optional[int] = None):
+    """List items that have a listing, filtered and sorted on its indexed keys
+
+    sort: id, -id, price or -price; sorting by price leaves out listings without one
+    """
+    if sort not in LISTING_SORTS:
+        raise HttpError(422, f"Unknown sort '{sort}', expected one of: {', '.join(LISTING_SORTS)}")
+    listings = Item.objects.filter(listing_json__isnull=False).only(
+        'name', 'full_path', 'listing_json', 'listing_worker', 'listing_price', 'listing_status', 'listing_marketplace')
+    if status is not None:
+        listings = listings.filter(listing_status=status)
+    if marketplace is not None:
+        listings = listings.filter(listing_marketplace=marketplace)
+    if min_price is not None:
+        listings = listings.filter(listing_price__gte=min_price)
+    if max_price is not None:
+        listings = listings.filter(listing_price__lte=max_price)
+    if sort in ('price', '-price'):
+        listings = listings.filter(listing_price__isnull=False)
+    page, next_cursor = await pagination.akeyset_page(
+        listings, LISTING_SORTS[sort], cursor, pagination.clamp_limit(limit))
+    pagination.set_next_cursor(response, next_cursor)
+    return page
+
+def _claim(worker_name, count, lease_seconds=None):
+    try:
+        item_ids = jobs.claim(worker_name, count, lease_seconds)
+    except ValueError as e:
+        raise HttpError(422, str(e))
+    return tree.build_subtrees(Item.objects.filter(id__in=item_ids).order_by('id'))
 
 @router.get("/listing/job/{worker_name}", response={200: ItemOut, 404: None})
-def get_listing_job(request, worker_name: str):
-    """Get first pending listing job and assign it to worker"""
-    item = Item.objects.filter(listing_worker='pending', listing_json__isnull=False).first()
-    if not item:
+def get_listing_job(request, worker_name: str, lease_seconds: Optional[int] = None):
+    """Claim the oldest pending listing job for worker under a lease"""
+    claimed = _claim(worker_name, 1, lease_seconds)
+    if not claimed:
         return 404, None
-    item.listing_worker = worker_name
-    item.save()
-    return 200, item
+    return 200, claimed[0]
+
+@router.get("/listing/jobs/{worker_name}", response=List[ItemOut])
+def get_listing_jobs(request, worker_name: str, count: int = 10, lease_seconds: Optional[int] = None):
+    """Claim up to ``count`` pending listing jobs for worker in one call"""
+    return _claim(worker_name, count, lease_seconds)
+
+@router.post("/listing/job/{item_id}/complete", response={204: None, 409: None})
+def complete_listing_job(request, item_id: int, worker_name: str):
+    """Release a claimed job; 409 when the worker's lease expired and the job was requeued"""
+    if not jobs.complete(item_id, worker_name):
+        return 409, None
+    return 204, None
 
 @router.post("/items/{item_id}/files", response=FileSchema)
 def upload_file(request, item_id: int, file: UploadedFile = File(...)):
@@ -132,13 +349,43 @@ def upload_file(request, item_id: int, file: UploadedFile = File(...)):
 
 @router.post("/items/{item_id}/emails", response=EmailSchema)
 def create_email(request, item_id: int, payload: EmailCreate):
-    """Create an email attachment for an item"""
+    """Create an email attachment for an item; a message already imported is returned as is"""
     item = get_object_or_404(Item, id=item_id)
-    email = Email.objects.create(
+    email = Email(
         item=item,
         subject=payload.subject,
         body=payload.body,
         from_address=payload.from_address,
-        received_at=payload.received_at
+        received_at=payload.received_at,
+        qr_code=payload.qr_code,
+        message_id=payload.message_id
     )
+    existing = Email.objects.filter(content_hash=email.compute_content_hash()).first()
+    if existing:
+        return existing
+    email.save()
     return email
+
+@router.post("/emails/bulk", response=EmailBulkResult)
+def bulk_create_emails(request, payload: EmailBulk):
+    """Import many emails at once, skipping messages already stored, with one status per email"""
+    if len(payload.emails) > emails.MAX_EMAILS:
+        raise HttpError(422, f"At most {emails.MAX_EMAILS} emails can be imported at once")
+    results = emails.import_emails(payload.emails, route=payload.route)
+    statuses = [result['status'] for result in results]
+    return {
+        'created': statuses.count(emails.CREATED),
+        'duplicates': statuses.count(emails.DUPLICATE),
+        'errors': statuses.count(emails.ERROR),
+        'results': results,
+    }
+
+@router.get("/metrics")
+def get_metrics(request, reset: bool = False):
+    """Request metrics of this server process per endpoint, for staff users"""
+    if not request.user.is_staff:
+        raise HttpError(403, "Staff only")
+    snapshot = metrics.registry.snapshot()
+    if reset:
+        metrics.registry.reset()
+    return snapshot
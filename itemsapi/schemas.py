@@ -1,7 +1,9 @@
+import json
 from ninja import Schema
-from typing import List, Optional
+from typing import Any, Dict, List, Literal, Optional
 from datetime import datetime
-from pydantic import field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from .models import LISTING_STATUSES
 
 # Base schemas for attachments
 class AttachmentBase(Schema):
@@ -18,6 +20,9 @@ class ComponentHistorySchema(Schema):
     new_parent_id: Optional[int]
     action_type: str
     changed_at: datetime
+    # More than one move when old history was compacted, from first_changed_at to changed_at
+    moves: int = 1
+    first_changed_at: Optional[datetime] = None
 
 class NoteCreate(Schema):
     content: str
@@ -30,6 +35,9 @@ class NoteSchema(AttachmentBase):
 class FileSchema(AttachmentBase):
     file: str
     file_type: str
+    # WebP derivatives of image files, null until rendered
+    thumbnail: Optional[str] = None
+    preview: Optional[str] = None
 
 class EmailSchema(AttachmentBase):
     subject: str
@@ -38,6 +46,19 @@ class EmailSchema(AttachmentBase):
     received_at: datetime
     qr_code: Optional[str] = None
 
+class SubtreeAttachment(Schema):
+    type: str  # notes, files, emails or codes; the attachment is under the matching singular key
+    item_id: int
+    created_at: datetime
+    note: Optional[NoteSchema] = None
+    file: Optional[FileSchema] = None
+    email: Optional[EmailSchema] = None
+    code: Optional[CodeIdentifierSchema] = None
+
+class SubtreeAttachments(Schema):
+    counts: Dict[str, int]  # Per type, over the whole subtree
+    results: List[SubtreeAttachment]
+
 class EmailCreate(Schema):
     item_id: int
     subject: str
@@ -45,22 +66,56 @@ class EmailCreate(Schema):
     from_address: str
     received_at: datetime
     qr_code: Optional[str] = None
-    
+    message_id: Optional[str] = None
+
+class EmailBulk(Schema):
+    emails: List[EmailCreate]
+    # File each email under the item matching its qr_code instead of item_id
+    route: bool = False
+
+class EmailBulkStatus(Schema):
+    index: int
+    status: str  # created, duplicate or error
+    id: Optional[int] = None
+    item_id: Optional[int] = None
+    detail: Optional[str] = None
+
+class EmailBulkResult(Schema):
+    created: int
+    duplicates: int
+    errors: int
+    results: List[EmailBulkStatus]
+
 # Item schemas with inheritance
+class Listing(BaseModel):
+    # Keys stored in generated columns (Item.listing_price/status/marketplace) are
+    # validated; any other key is kept as sent (a plain model: Schema drops extra keys)
+    model_config = ConfigDict(extra='allow')
+
+    title: Optional[str] = None
+    price: Optional[float] = Field(None, ge=0, lt=10 ** 10)
+    currency: Optional[str] = Field(None, min_length=3, max_length=3)
+    status: Optional[Literal[LISTING_STATUSES]] = None
+    marketplace: Optional[str] = Field(None, max_length=50)
+
 class ListingUpdate(Schema):
-    listing_json: str
+    listing_json: Listing  # An object, or the same object encoded as a JSON string
+
+    @field_validator('listing_json', mode='before')
+    def parse_listing(cls, value):
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except ValueError:
+                raise ValueError("listing_json is not valid JSON")
+        return value
 
 class ItemBase(Schema):
     name: str
     description: Optional[str] = None
     qr_code: Optional[str] = None
-    listing_json: Optional[str] = None
-    
-    # Remove level from base schema since it's computed
-    @staticmethod
-    def resolve_level(obj):
-        return obj.get_level()
-    
+    listing_json: Optional[Dict[str, Any]] = None
+
 class MovePayload(Schema):
     new_parent_id: Optional[int] = 0
     
@@ -70,6 +125,12 @@ class MovePayload(Schema):
             raise ValueError("Parent ID must be a positive integer")
         return value
 
+class MoveBatchEntry(MovePayload):
+    item_id: int
+
+class MoveBatch(Schema):
+    moves: List[MoveBatchEntry]
+
 class ItemCreate(Schema):
     # Separate from ItemBase to avoid level requirement in creation
     name: str
@@ -77,7 +138,27 @@ class ItemCreate(Schema):
     qr_code: Optional[str] = None
     parent_id: Optional[int] = None
 
+class BulkItemIn(Schema):
+    name: str
+    description: Optional[str] = None
+    qr_code: Optional[str] = None
+    ref: Optional[str] = None  # Client-side key other entries can point at with parent_ref
+    parent_ref: Optional[str] = None  # Parent given by ref, for flat parent-referencing lists
+    parent_id: Optional[int] = None  # Existing parent item
+    children: List['BulkItemIn'] = []
+
+class BulkImport(Schema):
+    parent_id: Optional[int] = None  # Default existing parent for top-level entries
+    items: List[BulkItemIn]
+
+class BulkImportResult(Schema):
+    created: int
+    ids: List[int]  # In payload order, nested entries depth-first
+    refs: Dict[str, int] = {}
+
 class ItemOut(ItemBase):
+    # Built from the node dicts assembled in itemsapi/tree.py rather than
+    # resolved per item, so serializing a tree costs no extra queries
     id: int
     parent_id: Optional[int]
     created_at: datetime
@@ -91,16 +172,62 @@ class ItemOut(ItemBase):
     full_path: str
     attachment_count: int
     listing_worker: Optional[str] = None
-    
-    @staticmethod
-    def resolve_children(obj):
-        return obj.get_children().prefetch_related(*obj.get_prefetch_fields())
-    
-    @staticmethod
-    def resolve_full_path(obj):
-        return obj.get_full_path()
-    
-    @staticmethod
-    def resolve_attachment_count(obj):
-        return (obj.notes.count() + obj.files.count() + 
-                obj.emails.count() + obj.codes.count())
+
+
+class ListingOut(Schema):
+    id: int
+    name: str
+    full_path: str
+    price: Optional[float] = Field(None, alias='listing_price')
+    status: Optional[str] = Field(None, alias='listing_status')
+    marketplace: Optional[str] = Field(None, alias='listing_marketplace')
+    listing_worker: Optional[str] = None
+    listing: Dict[str, Any] = Field(alias='listing_json')
+
+
+class ItemSkeleton(Schema):
+    # Documents GET /items/skeleton, whose trusted rows are rendered without validation
+    id: int
+    name: str
+    qr_code: Optional[str] = None
+    attachment_count: int
+    children: List['ItemSkeleton'] = []
+
+
+class TrashedSubtreeOut(Schema):
+    item_id: int
+    name: str
+    parent_id: Optional[int] = None
+    full_path: str
+    item_count: int
+    deleted_at: datetime
+
+
+class HistoricalItem(Schema):
+    # An item where it was at a past time (GET /items/as-of); names are current
+    id: int
+    name: str
+    parent_id: Optional[int] = None
+    children: List['HistoricalItem'] = []
+
+
+class ItemFieldsOut(Schema):
+    # ItemOut for list endpoints taking fields=/expand=: fields that were not
+    # selected are left unset and dropped from the response (exclude_unset)
+    id: int
+    name: Optional[str] = None
+    description: Optional[str] = None
+    qr_code: Optional[str] = None
+    listing_json: Optional[Dict[str, Any]] = None
+    listing_worker: Optional[str] = None
+    parent_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    level: Optional[int] = None
+    full_path: Optional[str] = None
+    attachment_count: Optional[int] = None
+    children: List['ItemFieldsOut'] = []
+    history: List[ComponentHistorySchema] = []
+    notes: List[NoteSchema] = []
+    codes: List[CodeIdentifierSchema] = []
+    files: List[FileSchema] = []
+    emails: List[EmailSchema] = []
@@ -0,0 +1,173 @@
+"""
+Full-text search index for items.
+
+Each item has one row in ``itemsapi_item_search`` covering its name, QR
+code, description, listing, note contents and email subjects/bodies. On
+SQLite the table is an FTS5 virtual table ranked with bm25(); on PostgreSQL
+it holds a weighted tsvector behind a GIN index. Rows are refreshed
+incrementally from itemsapi.signals. Other backends, or databases where the
+index table is missing, fall back to the original ``icontains`` scan.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Item
+
+INDEX_TABLE = 'itemsapi_item_search'
+CHUNK_SIZE = 500
+
+_available = {}
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def _placeholders(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+class SQLiteBackend:
+    # Column weights for bm25(): name, qr_code, description, listing, notes, emails
+    WEIGHTS = (10.0, 10.0, 4.0, 2.0, 1.0, 1.0)
+
+    DOCUMENT_SELECT = f"""
+        INSERT INTO {INDEX_TABLE} (rowid, name, qr_code, description, listing, notes, emails)
+        SELECT i.id, i.name, COALESCE(i.qr_code, ''), COALESCE(i.description, ''),
+               COALESCE(i.listing_json, ''),
+               COALESCE((SELECT group_concat(n.content, ' ') FROM itemsapi_note n WHERE n.item_id = i.id), ''),
+               COALESCE((SELECT group_concat(e.subject || ' ' || e.body, ' ')
+                         FROM itemsapi_email e WHERE e.item_id = i.id), '')
+        FROM itemsapi_item i
+    """
+
+    def remove(self, cursor, ids):
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE rowid IN ({_placeholders(ids)})", ids)
+
+    def reindex(self, cursor, ids):
+        self.remove(cursor, ids)
+        cursor.execute(f"{self.DOCUMENT_SELECT} WHERE i.id IN ({_placeholders(ids)})", ids)
+
+    def rebuild(self, cursor):
+        cursor.execute(f"DELETE FROM {INDEX_TABLE}")
+        cursor.execute(self.DOCUMENT_SELECT)
+
+    def search(self, cursor, terms, limit, offset):
+        query = ' '.join('"%s"*' % term for term in terms)
+        weights = ', '.join(str(weight) for weight in self.WEIGHTS)
+        cursor.execute(
+            f"SELECT rowid FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s "
+            f"ORDER BY bm25({INDEX_TABLE}, {weights}), rowid LIMIT %s OFFSET %s",
+            [query, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresBackend:
+    DOCUMENT_SELECT = f"""
+        INSERT INTO {INDEX_TABLE} (item_id, document)
+        SELECT i.id,
+               setweight(to_tsvector('simple', i.name || ' ' || COALESCE(i.qr_code, '')), 'A') ||
+               setweight(to_tsvector('simple', COALESCE(i.description, '')), 'B') ||
+               setweight(to_tsvector('simple', COALESCE(i.listing_json::text, '')), 'C') ||
+               setweight(to_tsvector('simple',
+                   COALESCE((SELECT string_agg(n.content, ' ') FROM itemsapi_note n WHERE n.item_id = i.id), '')
+                   || ' ' ||
+                   COALESCE((SELECT string_agg(e.subject || ' ' || e.body, ' ')
+                             FROM itemsapi_email e WHERE e.item_id = i.id), '')), 'D')
+        FROM itemsapi_item i
+    """
+
+    def remove(self, cursor, ids):
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE item_id = ANY(%s)", [ids])
+
+    def reindex(self, cursor, ids):
+        cursor.execute(
+            f"{self.DOCUMENT_SELECT} WHERE i.id = ANY(%s) "
+            "ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document",
+            [ids],
+        )
+
+    def rebuild(self, cursor):
+        cursor.execute(f"TRUNCATE {INDEX_TABLE}")
+        cursor.execute(self.DOCUMENT_SELECT)
+
+    def search(self, cursor, terms, limit, offset):
+        query = ' & '.join(f"{term}:*" for term in terms)
+        cursor.execute(
+            f"SELECT item_id FROM {INDEX_TABLE}, to_tsquery('simple', %s) query "
+            "WHERE document @@ query ORDER BY ts_rank(document, query) DESC, item_id LIMIT %s OFFSET %s",
+            [query, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend(),
+    'postgresql': PostgresBackend(),
+}
+
+
+def get_backend():
+    """Returns the index backend for the default connection, or None when there is no index"""
+    backend = BACKENDS.get(connection.vendor)
+    if backend is None:
+        return None
+    key = connection.settings_dict['NAME']
+    if key not in _available:
+        _available[key] = INDEX_TABLE in connection.introspection.table_names()
+    return backend if _available[key] else None
+
+
+def reindex(item_ids):
+    """Refreshes the index rows of ``item_ids``"""
+    backend = get_backend()
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        for ids in _chunks(item_ids):
+            backend.reindex(cursor, ids)
+
+
+def remove(item_ids):
+    """Drops the index rows of ``item_ids``"""
+    backend = get_backend()
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        for ids in _chunks(item_ids):
+            backend.remove(cursor, ids)
+
+
+def rebuild():
+    """Rebuilds the whole index from the item, note and email tables"""
+    backend = get_backend()
+    if backend is None:
+        return False
+    with connection.cursor() as cursor:
+        backend.rebuild(cursor)
+    return True
+
+
+def search_items(q, limit=50, offset=0):
+    """Returns items matching every word of ``q`` as a prefix, best match first"""
+    terms = re.findall(r'\w+', q.lower())
+    if not terms:
+        return []
+    offset = max(0, offset)
+    backend = get_backend()
+    if backend is None:
+        return list(Item.objects.filter(
+            Q(name__icontains=q) |
+            Q(description__icontains=q) |
+            Q(qr_code__iexact=q) |
+            Q(listing_json__icontains=q)
+        )[offset:offset + limit])
+    with connection.cursor() as cursor:
+        ids = backend.search(cursor, terms, limit, offset)
+    items = Item.objects.in_bulk(ids)
+    return [items[pk] for pk in ids if pk in items]
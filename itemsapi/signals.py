@@ -1,22 +1,150 @@
-from django.db.models.signals import post_save, pre_delete
+from functools import partial
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from .models import Item, ComponentHistory
+from .models import Item, ComponentHistory, Note, File, Email, CodeIdentifier, Blob
+from . import cache, emails, geometry, history, search, thumbnails
+
+# Item columns that feed the search index
+SEARCH_FIELDS = {'name', 'description', 'qr_code', 'listing_json'}
 
 @receiver(post_save, sender=Item)
 def track_item_changes(sender, instance, created, **kwargs):
-    action_type = ComponentHistory.CREATED if created else ComponentHistory.MOVED
-    ComponentHistory.objects.create(
-        item=instance,
-        old_parent=getattr(instance, '_previous_parent', None),
-        new_parent=instance.parent,
-        action_type=action_type
-    )
+    if not created and not getattr(instance, '_parent_changed', False):
+        return
+    history.record([(
+        instance.pk,
+        None if created else instance._previous_parent_id,
+        instance.parent_id,
+        ComponentHistory.CREATED if created else ComponentHistory.MOVED,
+    )])
 
 @receiver(pre_delete, sender=Item)
 def track_item_deletion(sender, instance, **kwargs):
-    ComponentHistory.objects.create(
-        item=instance,
-        old_parent=instance.parent,
-        new_parent=None,
-        action_type=ComponentHistory.DELETED
-    )
+    history.record([(instance.pk, instance.parent_id, None, ComponentHistory.DELETED)], {instance.pk: instance.name})
+
+
+def _adjust_attachment_count(item_id, delta):
+    Item.objects.filter(pk=item_id).update(cached_attachment_count=F('cached_attachment_count') + delta)
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_save, sender=File)
+@receiver(post_save, sender=Email)
+@receiver(post_save, sender=CodeIdentifier)
+def count_attachment_added(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        _adjust_attachment_count(instance.item_id, 1)
+
+
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=File)
+@receiver(post_delete, sender=Email)
+@receiver(post_delete, sender=CodeIdentifier)
+def count_attachment_removed(sender, instance, **kwargs):
+    _adjust_attachment_count(instance.item_id, -1)
+
+
+@receiver(post_save, sender=Item)
+def index_item(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or SEARCH_FIELDS & set(update_fields):
+        search.reindex([instance.pk])
+
+
+@receiver(post_delete, sender=Item)
+def unindex_item(sender, instance, **kwargs):
+    search.remove([instance.pk])
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_save, sender=Email)
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=Email)
+def index_item_text(sender, instance, **kwargs):
+    search.reindex([instance.item_id])
+
+
+@receiver(post_save, sender=Item)
+def invalidate_item_cache(sender, instance, raw=False, **kwargs):
+    if raw:
+        cache.invalidate_all()
+        return
+    previous_path_ids = getattr(instance, '_previous_path_ids', None)
+    if previous_path_ids is None:
+        cache.invalidate_path(instance.path_ids)
+    else:
+        cache.invalidate_line(instance, previous_path_ids)
+
+
+@receiver(pre_delete, sender=Item)
+def invalidate_deleted_item_cache(sender, instance, **kwargs):
+    cache.invalidate_path(instance.path_ids)
+
+
+@receiver(post_save, sender=Item)
+def invalidate_item_geometry(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        # Fixtures may write any tree
+        geometry.invalidate(None)
+        return
+    # Only creates, moves and renames change geometry
+    if getattr(instance, '_previous_path_ids', None) is None:
+        return
+    was_root = instance._parent_changed and instance._previous_parent_id is None
+    if instance.parent_id is None or was_root:
+        # Roots are kept in name order by renumbering the tree ids of the trees after them
+        geometry.invalidate(None)
+    else:
+        geometry.invalidate({instance.tree_id, instance._previous_tree_id} - {None})
+
+
+@receiver(post_delete, sender=Item)
+def invalidate_deleted_item_geometry(sender, instance, **kwargs):
+    geometry.invalidate([instance.tree_id])
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_save, sender=File)
+@receiver(post_save, sender=Email)
+@receiver(post_save, sender=CodeIdentifier)
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=File)
+@receiver(post_delete, sender=Email)
+@receiver(post_delete, sender=CodeIdentifier)
+def invalidate_attachment_cache(sender, instance, **kwargs):
+    cache.invalidate_items([instance.item_id])
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=CodeIdentifier)
+@receiver(post_delete, sender=CodeIdentifier)
+def forget_email_routes(sender, update_fields=None, **kwargs):
+    if sender is Item and update_fields is not None and 'qr_code' not in update_fields:
+        return
+    emails.resolver.clear()
+
+
+def _adjust_blob_refs(blob_id, delta):
+    Blob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') + delta)
+
+
+@receiver(post_save, sender=File)
+def reference_blob(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.blob_id:
+        _adjust_blob_refs(instance.blob_id, 1)
+
+
+@receiver(post_save, sender=File)
+def render_derivatives(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.blob_id and thumbnails.is_image(instance.file_type):
+        transaction.on_commit(partial(thumbnails.schedule, instance.blob_id))
+
+
+@receiver(post_delete, sender=File)
+def release_blob(sender, instance, **kwargs):
+    # The blob itself is only removed by blobs.collect_garbage()
+    if instance.blob_id:
+        _adjust_blob_refs(instance.blob_id, -1)
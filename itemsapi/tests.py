@@ -1,12 +1,37 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from io import BytesIO, StringIO
+from email.message import EmailMessage
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import RequestFactory, TestCase, override_settings
 from django.core.management import call_command
 from django.utils import timezone
 from django.db import transaction
 from ninja.testing import TestClient
 
-from .models import Item, Note, Email, File, CodeIdentifier, ComponentHistory
+from .models import Item, Note, Email, File, CodeIdentifier, ComponentHistory, Blob, TrashedSubtree, derivative_name
 from .api import api
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+from . import blobs, cache, deletion, emails, export, geometry, history, imaging, ingest, metrics, renderers, thumbnails
+
 class InventorySystemTests(TestCase):
     """
     Test suite for inventory management system
@@ -56,43 +81,45 @@ class InventorySystemTests(TestCase):
 
     def test_repair_shop_workflow(self):
         """Test complete repair workflow with documentation"""
-        # Create repair case
-        laptop = Item.objects.create(
-            name="Dell XPS 15",
-            description="Customer laptop - overheating",
-            parent=self.workbench
-        )
-        print(f"Created test laptop with ID: {laptop.id}, under workbench ID: {self.workbench.id}")
-        # Test documentation
-        note = Note.objects.create(
-            item=laptop,
-            content="Initial diagnosis: Thermal paste needs replacement"
-        )
+        # Writes invalidate cached responses when they commit
+        with self.captureOnCommitCallbacks(execute=True):
+            # Create repair case
+            laptop = Item.objects.create(
+                name="Dell XPS 15",
+                description="Customer laptop - overheating",
+                parent=self.workbench
+            )
+            print(f"Created test laptop with ID: {laptop.id}, under workbench ID: {self.workbench.id}")
+            # Test documentation
+            note = Note.objects.create(
+                item=laptop,
+                content="Initial diagnosis: Thermal paste needs replacement"
+            )
         
-        # Test part movement
-        thermal_paste = Item.objects.create(
-            name="Arctic MX-4",
-            description="Thermal compound",
-            parent=self.storage
-        )
-        print(f"Created thermal_paste with ID: {thermal_paste.id}, under storage ID: {self.storage.id}")
+            # Test part movement
+            thermal_paste = Item.objects.create(
+                name="Arctic MX-4",
+                description="Thermal compound",
+                parent=self.storage
+            )
+            print(f"Created thermal_paste with ID: {thermal_paste.id}, under storage ID: {self.storage.id}")
     
-        print(f"Attempting move operation: thermal_paste {thermal_paste.id} -> laptop {laptop.id}")
+            print(f"Attempting move operation: thermal_paste {thermal_paste.id} -> laptop {laptop.id}")
        
         
-        response = self.client.put(
-            f"/api/items/{thermal_paste.id}/move",
-            {"new_parent_id": laptop.id},
-            content_type="application/json"
-        )
-        print(f"Move operation response: {response.json()}")
-        self.assertEqual(response.status_code, 200)
+            response = self.client.put(
+                f"/api/items/{thermal_paste.id}/move",
+                {"new_parent_id": laptop.id},
+                content_type="application/json"
+            )
+            print(f"Move operation response: {response.json()}")
+            self.assertEqual(response.status_code, 200)
         
-        # Verify documentation
-        Note.objects.create(
-            item=laptop,
-            content="Thermal paste replaced, temperatures normal"
-        )
+            # Verify documentation
+            Note.objects.create(
+                item=laptop,
+                content="Thermal paste replaced, temperatures normal"
+            )
         
         # Verify history tracking
         history = self.client.get(f"/api/items/{laptop.id}/history")
@@ -150,15 +177,15 @@ class InventorySystemTests(TestCase):
         )
         
         # Test name search
-        response = self.client.get("/api/items/search", params={"q": "DDR4"})
+        response = self.client.get("/api/items/search?q=DDR4")
         self.assertEqual(len(response.json()), 1)
         
         # Test description search
-        response = self.client.get("/api/items/search", params={"q": "1600MHz"})
+        response = self.client.get("/api/items/search?q=1600MHz")
         self.assertEqual(len(response.json()), 1)
         
         # Test QR code search
-        response = self.client.get("/api/items/search", params={"q": "RAM001"})
+        response = self.client.get("/api/items/search?q=RAM001")
         self.assertEqual(len(response.json()), 1)
 
     def test_attachment_management(self):
@@ -236,3 +263,1421 @@ class InventorySystemTests(TestCase):
         File.objects.all().delete()
         Item.objects.all().delete()
         super().tearDown()
+
+
+class TreeAssemblyTests(TestCase):
+    """Nested ItemOut payloads are built with a constant number of queries"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def _grow(self, parent, depth, fan_out):
+        for i in range(fan_out):
+            child = Item.objects.create(name=f"{parent.name}.{i}", parent=parent)
+            Note.objects.create(item=child, content="checked")
+            if depth > 1:
+                self._grow(child, depth - 1, fan_out)
+
+    def _count_queries(self, path):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response.json()
+
+    def test_query_count_independent_of_tree_size(self):
+        small = Item.objects.create(name="Small")
+        self._grow(small, 1, 2)
+        small_count, _ = self._count_queries("/api/items")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            big = Item.objects.create(name="Big")
+            self._grow(big, 3, 3)
+        big_count, data = self._count_queries("/api/items")
+
+        self.assertEqual(small_count, big_count)
+        big_data = next(node for node in data if node['name'] == "Big")
+        self.assertEqual(len(big_data['children']), 3)
+        leaf = big_data['children'][0]['children'][0]['children'][0]
+        self.assertEqual(leaf['full_path'], "Big/Big.0/Big.0.0/Big.0.0.0")
+        self.assertEqual(leaf['attachment_count'], 1)
+
+    def test_subtree_includes_ancestor_path(self):
+        root = Item.objects.create(name="Shop")
+        self._grow(root, 2, 2)
+        item = Item.objects.get(name="Shop.1")
+        _, data = self._count_queries(f"/api/items/{item.id}")
+        self.assertEqual(data['full_path'], "Shop/Shop.1")
+        self.assertEqual([c['full_path'] for c in data['children']], ["Shop/Shop.1/Shop.1.0", "Shop/Shop.1/Shop.1.1"])
+        self.assertEqual(len(data['notes']), 1)
+
+
+class MaterializedPathTests(TestCase):
+    """full_path/path_ids stay current across create, move and rename"""
+
+    def test_move_and_rename_update_subtree(self):
+        shop = Item.objects.create(name="Shop")
+        shelf = Item.objects.create(name="Shelf", parent=shop)
+        laptop = Item.objects.create(name="Laptop", parent=shelf)
+        cpu = Item.objects.create(name="CPU", parent=laptop)
+        bench = Item.objects.create(name="Bench")
+        self.assertEqual(cpu.full_path, "Shop/Shelf/Laptop/CPU")
+        self.assertEqual(cpu.path_ids, f"{shop.id}/{shelf.id}/{laptop.id}/{cpu.id}")
+
+        Item.objects.get(id=laptop.id).move_under(Item.objects.get(id=bench.id))
+        self.assertEqual(Item.objects.get(id=laptop.id).full_path, "Bench/Laptop")
+        cpu.refresh_from_db()
+        self.assertEqual(cpu.full_path, "Bench/Laptop/CPU")
+        self.assertEqual(cpu.path_ids, f"{bench.id}/{laptop.id}/{cpu.id}")
+
+        bench = Item.objects.get(id=bench.id)
+        bench.name = "Workbench"
+        bench.save()
+        cpu.refresh_from_db()
+        self.assertEqual(cpu.full_path, "Workbench/Laptop/CPU")
+        self.assertEqual(Item.objects.get(id=shelf.id).full_path, "Shop/Shelf")
+
+    def test_rebuild_restores_paths(self):
+        root = Item.objects.create(name="Root")
+        child = Item.objects.create(name="Child", parent=root)
+        Item.objects.update(full_path='', path_ids='')
+        Item.objects.rebuild()
+        child.refresh_from_db()
+        self.assertEqual((child.full_path, child.path_ids), ("Root/Child", f"{root.id}/{child.id}"))
+
+
+class AttachmentCountTests(TestCase):
+    """attachment_count comes from annotations or the cached counter, not per-item COUNTs"""
+
+    def setUp(self):
+        self.gpu = Item.objects.create(name="GPU")
+        Note.objects.create(item=self.gpu, content="Fan noise")
+        Note.objects.create(item=self.gpu, content="Replaced fan")
+        CodeIdentifier.objects.create(item=self.gpu, code="GPU9", source="manufacturer")
+
+    def test_annotation_matches_cached_counter(self):
+        item = Item.objects.with_attachment_count().get(id=self.gpu.id)
+        self.assertEqual(item.attachment_count, 3)
+        self.assertEqual(item.cached_attachment_count, 3)
+
+        Note.objects.filter(item=self.gpu).first().delete()
+        self.assertEqual(Item.objects.get(id=self.gpu.id).cached_attachment_count, 2)
+
+    def test_recount_resynchronizes_counter(self):
+        Item.objects.update(cached_attachment_count=0)
+        Item.objects.recount_attachments(id=self.gpu.id)
+        self.assertEqual(Item.objects.get(id=self.gpu.id).cached_attachment_count, 3)
+        with self.settings(ITEMSAPI_CACHED_ATTACHMENT_COUNTS=True):
+            self.assertEqual(Item.objects.with_attachment_count().get(id=self.gpu.id).attachment_count, 3)
+
+
+class SearchIndexTests(TestCase):
+    """/items/search is served from the full-text index and kept current by signals"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def _search(self, q, **params):
+        from urllib.parse import urlencode
+        response = self.client.get(f"/api/items/search?{urlencode({'q': q, **params})}")
+        self.assertEqual(response.status_code, 200, response.content)
+        return [item['name'] for item in response.json()]
+
+    def test_indexes_notes_and_emails(self):
+        from . import search
+        self.assertIsNotNone(search.get_backend())
+        psu = Item.objects.create(name="PSU 650W")
+        note = Note.objects.create(item=psu, content="Capacitor bulging near the fan")
+        Email.objects.create(item=psu, subject="Warranty claim", body="Serial attached",
+                             from_address="rma@vendor.com", received_at=timezone.now())
+        self.assertEqual(self._search("capacitor"), ["PSU 650W"])
+        self.assertEqual(self._search("warr"), ["PSU 650W"])
+
+        note.delete()
+        self.assertEqual(self._search("capacitor"), [])
+        psu.delete()
+        self.assertEqual(self._search("warranty"), [])
+
+    def test_ranking_and_pagination(self):
+        Item.objects.create(name="Spare parts bin", description="Contains a fan")
+        Item.objects.create(name="Fan 120mm")
+        Item.objects.create(name="Fan 80mm")
+        self.assertEqual(self._search("fan")[2], "Spare parts bin")
+        self.assertEqual(len(self._search("fan", limit=2)), 2)
+        self.assertEqual(len(self._search("fan", limit=2, offset=2)), 1)
+
+
+class PaginationAndFieldsTests(TestCase):
+    """List endpoints page with keyset cursors and only build selected fields"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def setUp(self):
+        self.shelf = Item.objects.create(name="Shelf")
+        for name in ("Bin A", "Bin B", "Bin C"):
+            bin_ = Item.objects.create(name=name, parent=self.shelf, qr_code=name.replace(" ", ""))
+            Note.objects.create(item=bin_, content="Long inspection report")
+
+    def test_fields_selection_skips_relations(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/api/items?fields=name,qr_code")
+        self.assertEqual(len(ctx), 1)
+        self.assertEqual(response.json(), [{'id': self.shelf.id, 'name': "Shelf", 'qr_code': None}])
+
+        data = self.client.get("/api/items?fields=name&expand=children").json()
+        self.assertEqual([child['name'] for child in data[0]['children']], ["Bin A", "Bin B", "Bin C"])
+        self.assertNotIn('notes', data[0]['children'][0])
+
+        response = self.client.get("/api/items?fields=secret")
+        self.assertEqual(response.status_code, 422)
+
+    def test_keyset_pagination(self):
+        first = Item.objects.get(name="Bin A")
+        response = self.client.get(f"/api/items/{first.id}/siblings?limit=1&fields=name")
+        self.assertEqual([item['name'] for item in response.json()], ["Bin B"])
+        cursor = response['X-Next-Cursor']
+        response = self.client.get(f"/api/items/{first.id}/siblings?limit=1&fields=name&cursor={cursor}")
+        self.assertEqual([item['name'] for item in response.json()], ["Bin C"])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+        for i in range(3):
+            Note.objects.create(item=first, content=f"Follow-up {i}")
+        response = self.client.get(f"/api/items/{first.id}/notes?limit=2")
+        self.assertEqual(len(response.json()), 2)
+        rest = self.client.get(f"/api/items/{first.id}/notes?limit=2&cursor={response['X-Next-Cursor']}").json()
+        self.assertEqual(len(rest), 2)
+        self.assertFalse({n['id'] for n in response.json()} & {n['id'] for n in rest})
+
+    def test_cursor_keeps_microseconds(self):
+        item = Item.objects.create(name="Drawer")
+        base = timezone.now().replace(microsecond=0)
+        notes = [Note.objects.create(item=item, content=f"Check {i}") for i in range(6)]
+        for i, note in enumerate(notes):
+            Note.objects.filter(pk=note.pk).update(created_at=base + timedelta(microseconds=100 * i))
+        ids, cursor = [], ''
+        while True:
+            response = self.client.get(f"/api/items/{item.id}/notes?limit=2{cursor}")
+            ids.extend(note['id'] for note in response.json())
+            if 'X-Next-Cursor' not in response.headers:
+                break
+            cursor = f"&cursor={response['X-Next-Cursor']}"
+        self.assertEqual(ids, [note.id for note in reversed(notes)])
+
+
+class ListingJobQueueTests(TestCase):
+    """Listing jobs are claimed atomically in batches under expiring leases"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def setUp(self):
+        self.items = [
+            Item.objects.create(name=f"Listing {i}", listing_json={'price': 10}, listing_worker='pending')
+            for i in range(3)
+        ]
+
+    def test_batch_claims_do_not_overlap(self):
+        history_before = ComponentHistory.objects.count()
+        first = self.client.get("/api/listing/jobs/worker-a?count=2").json()
+        second = self.client.get("/api/listing/jobs/worker-b?count=2").json()
+        self.assertEqual([item['id'] for item in first], [self.items[0].id, self.items[1].id])
+        self.assertEqual([item['id'] for item in second], [self.items[2].id])
+        self.assertEqual(first[0]['listing_worker'], "worker-a")
+        self.assertEqual(ComponentHistory.objects.count(), history_before)
+        self.assertEqual(self.client.get("/api/listing/job/worker-c").status_code, 404)
+
+    def test_expired_lease_is_requeued(self):
+        from datetime import timedelta
+        from . import jobs
+        claimed = jobs.claim("worker-a", count=3)
+        self.assertEqual(len(claimed), 3)
+        Item.objects.filter(id=claimed[0]).update(
+            listing_lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(jobs.claim("worker-b", count=3), [claimed[0]])
+
+        response = self.client.post(f"/api/listing/job/{claimed[0]}/complete?worker_name=worker-a")
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(f"/api/listing/job/{claimed[0]}/complete?worker_name=worker-b")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(jobs.claim("worker-c"), [])
+
+    def test_lease_must_be_positive(self):
+        for lease in (0, -60, 10 ** 9):
+            response = self.client.get(f"/api/listing/jobs/worker-a?lease_seconds={lease}")
+            self.assertEqual(response.status_code, 422)
+        self.assertFalse(Item.objects.exclude(listing_worker='pending').exists())
+        response = self.client.get("/api/listing/job/worker-a?lease_seconds=30")
+        self.assertEqual(response.status_code, 200)
+
+
+class BulkImportTests(TestCase):
+    """POST /items/bulk inserts whole trees with valid MPTT coordinates"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def _tree_snapshot(self):
+        # tree_id is left out: rebuild() renumbers root trees in name order
+        return sorted(Item.objects.values_list('full_path', 'lft', 'rght', 'level'))
+
+    def test_nested_and_flat_import_match_rebuild(self):
+        shelf = Item.objects.create(name="Shelf")
+        Item.objects.create(name="Box M", parent=shelf)
+        payload = {
+            'items': [
+                {'name': "Box Z", 'parent_id': shelf.id, 'children': [{'name': "Cable"}, {'name': "Adapter"}]},
+                {'name': "Box A", 'parent_id': shelf.id, 'ref': "a"},
+                {'name': "Fan", 'parent_ref': "a", 'ref': "fan"},
+                {'name': "Lot", 'children': [{'name': "Screw"}]},
+            ],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/items/bulk", payload, content_type="application/json")
+        self.assertEqual(response.status_code, 201, response.content)
+        data = response.json()
+        self.assertEqual(data['created'], 7)
+        self.assertEqual(set(data['refs']), {"a", "fan"})
+
+        fan = Item.objects.get(id=data['refs']['fan'])
+        self.assertEqual(fan.full_path, "Shelf/Box A/Fan")
+        self.assertEqual(fan.path_ids, f"{shelf.id}/{data['refs']['a']}/{fan.id}")
+        self.assertEqual(ComponentHistory.objects.filter(item_id__in=data['ids']).count(), 7)
+        self.assertEqual(
+            [c.name for c in Item.objects.get(id=shelf.id).get_children()], ["Box A", "Box M", "Box Z"])
+
+        before = self._tree_snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._tree_snapshot())
+
+    def test_import_under_leaf_parents_of_one_tree(self):
+        root = Item.objects.create(name="Root")
+        a = Item.objects.create(name="A", parent=root)
+        b = Item.objects.create(name="B", parent=root)
+        # Payload order is the reverse of tree order
+        payload = {'items': [{'name': "x", 'parent_id': b.id, 'children': [{'name': "x1"}]},
+                             {'name': "y", 'parent_id': a.id}]}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/items/bulk", payload, content_type="application/json")
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self._tree_snapshot(), [
+            ("Root", 1, 12, 0), ("Root/A", 2, 5, 1), ("Root/A/y", 3, 4, 2),
+            ("Root/B", 6, 11, 1), ("Root/B/x", 7, 10, 2), ("Root/B/x/x1", 8, 9, 3),
+        ])
+        before = self._tree_snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._tree_snapshot())
+
+    def test_rejects_cycles_and_unknown_parents(self):
+        payload = {'items': [{'name': "A", 'ref': "a", 'parent_ref': "b"}, {'name': "B", 'ref': "b", 'parent_ref': "a"}]}
+        self.assertEqual(self.client.post("/api/items/bulk", payload, content_type="application/json").status_code, 422)
+        payload = {'parent_id': 999999, 'items': [{'name': "A"}]}
+        self.assertEqual(self.client.post("/api/items/bulk", payload, content_type="application/json").status_code, 422)
+        self.assertFalse(Item.objects.filter(name="A").exists())
+
+
+class MoveTests(TestCase):
+    """Moves keep name order, log history only on a parent change and batch per tree"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def _snapshot(self):
+        # tree_id is left out: rebuild() renumbers root trees in name order
+        return sorted(Item.objects.values_list('full_path', 'path_ids', 'lft', 'rght', 'level'))
+
+    def test_move_keeps_name_order_and_history_is_move_only(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            bench = Item.objects.create(name="Bench")
+            for name in ("Drill", "Saw"):
+                Item.objects.create(name=name, parent=bench)
+            shelf = Item.objects.create(name="Shelf")
+            fan = Item.objects.create(name="Fan", parent=shelf)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(f"/api/items/{fan.id}/listing", {'listing_json': '{}'},
+                                       content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ComponentHistory.objects.filter(item=fan, action_type=ComponentHistory.MOVED).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.get(id=fan.id).move_under(Item.objects.get(id=bench.id))
+        self.assertEqual([c.name for c in Item.objects.get(id=bench.id).get_children()], ["Drill", "Fan", "Saw"])
+        move = ComponentHistory.objects.get(item=fan, action_type=ComponentHistory.MOVED)
+        self.assertEqual((move.old_parent_id, move.new_parent_id), (shelf.id, bench.id))
+        self.assertEqual(Item.objects.get(id=fan.id).listing_json, {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.get(id=fan.id).move_under(Item.objects.get(id=bench.id))
+        self.assertEqual(ComponentHistory.objects.filter(item=fan, action_type=ComponentHistory.MOVED).count(), 1)
+
+        before = self._snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._snapshot())
+
+    def test_move_batch(self):
+        bench = Item.objects.create(name="Bench")
+        shelf = Item.objects.create(name="Shelf")
+        box = Item.objects.create(name="Box", parent=shelf)
+        cable = Item.objects.create(name="Cable", parent=box)
+        fan = Item.objects.create(name="Fan", parent=shelf)
+        lot = Item.objects.create(name="Lot")
+        moves = [
+            {'item_id': box.id, 'new_parent_id': bench.id},
+            {'item_id': lot.id, 'new_parent_id': fan.id},
+            {'item_id': cable.id, 'new_parent_id': None},
+        ]
+        response = self.client.put("/api/items/move-batch", {'moves': moves}, content_type="application/json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual([node['id'] for node in response.json()], [box.id, lot.id, cable.id])
+        self.assertEqual(Item.objects.get(id=lot.id).full_path, "Shelf/Fan/Lot")
+        self.assertTrue(Item.objects.get(id=cable.id).is_root_node())
+        self.assertEqual(ComponentHistory.objects.filter(action_type=ComponentHistory.MOVED).count(), 3)
+
+        before = self._snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._snapshot())
+
+    def test_move_batch_rejects_cycles(self):
+        a = Item.objects.create(name="A")
+        b = Item.objects.create(name="B", parent=a)
+        moves = [{'item_id': a.id, 'new_parent_id': b.id}]
+        response = self.client.put("/api/items/move-batch", {'moves': moves}, content_type="application/json")
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Item.objects.get(id=b.id).parent_id, a.id)
+
+
+class ExportTests(TestCase):
+    """GET /items/export streams the same content as GET /items"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+        shop = Item.objects.create(name="Shop")
+        shelf = Item.objects.create(name="Shelf", parent=shop)
+        Item.objects.create(name="Fan", parent=shelf)
+        Note.objects.create(item=shelf, content="dusty")
+        Item.objects.create(name="Bench", parent=shop)
+        Item.objects.create(name="Annex")
+
+    def _content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_nested_json_matches_list(self):
+        # Small chunks so subtrees are opened and closed across chunk boundaries
+        with mock.patch.object(export, 'CHUNK_SIZE', 2):
+            response = self.client.get("/api/items/export?format=json")
+            self.assertEqual(response.status_code, 200)
+            exported = json.loads(self._content(response))
+        self.assertEqual(exported, self.client.get("/api/items").json())
+
+    def test_ndjson_lines(self):
+        response = self.client.get("/api/items/export?fields=name,parent_id,level&expand=notes")
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertEqual([line['name'] for line in lines], ["Annex", "Shop", "Bench", "Shelf", "Fan"])
+        self.assertEqual(lines[3]['notes'][0]['content'], "dusty")
+        self.assertEqual(set(lines[4]), {'id', 'name', 'parent_id', 'level', 'notes'})
+
+        self.assertEqual(self.client.get("/api/items/export?format=xml").status_code, 422)
+
+
+class ResponseCacheTests(TestCase):
+    """Item reads are cached per subtree, revalidated with ETags and invalidated by writes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+
+    def setUp(self):
+        cache.backend().clear()
+        self.shop = Item.objects.create(name="Shop")
+        self.shelf = Item.objects.create(name="Shelf", parent=self.shop)
+        self.fan = Item.objects.create(name="Fan", parent=self.shelf)
+        self.bench = Item.objects.create(name="Bench")
+
+    def _get(self, path, **headers):
+        return self.client.get(path, headers=headers)
+
+    def test_hits_and_not_modified(self):
+        first = self._get(f"/api/items/{self.shop.id}")
+        with self.assertNumQueries(0):
+            second = self._get(f"/api/items/{self.shop.id}")
+        self.assertEqual(first.json(), second.json())
+        with self.assertNumQueries(0):
+            response = self._get(f"/api/items/{self.shop.id}", **{'If-None-Match': first['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_writes_invalidate_ancestors_only(self):
+        etags = {item.id: self._get(f"/api/items/{item.id}")['ETag']
+                 for item in (self.shop, self.shelf, self.fan, self.bench)}
+        path_etag = self._get(f"/api/items/{self.fan.id}/path")['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/api/items/{self.shelf.id}/notes", {'content': "dusty"},
+                             content_type="application/json")
+        changed = {pk for pk, etag in etags.items() if self._get(f"/api/items/{pk}")['ETag'] != etag}
+        self.assertEqual(changed, {self.shop.id, self.shelf.id})
+        self.assertEqual(self._get(f"/api/items/{self.shop.id}").json()['children'][0]['notes'][0]['content'],
+                         "dusty")
+        self.assertNotEqual(self._get(f"/api/items/{self.fan.id}/path")['ETag'], path_etag)
+
+    def test_tokens_change_when_the_write_commits(self):
+        etag = self._get(f"/api/items/{self.shelf.id}")['ETag']
+        with self.captureOnCommitCallbacks() as callbacks:
+            Note.objects.create(item=self.fan, content="rattles")
+            # A read racing the open transaction stores what it sees under the old tokens only
+            self.assertEqual(self._get(f"/api/items/{self.shelf.id}")['ETag'], etag)
+        for callback in callbacks:
+            callback()
+        response = self._get(f"/api/items/{self.shelf.id}")
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['children'][0]['notes'][0]['content'], "rattles")
+
+    def test_move_and_delete_invalidate_both_trees(self):
+        self.assertEqual(self._get(f"/api/items/{self.fan.id}").json()['full_path'], "Shop/Shelf/Fan")
+        self.assertEqual(len(self._get("/api/items").json()[1]['children']), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f"/api/items/{self.shelf.id}/move", {'new_parent_id': self.bench.id},
+                            content_type="application/json")
+        self.assertEqual(self._get(f"/api/items/{self.fan.id}").json()['full_path'], "Bench/Shelf/Fan")
+        self.assertEqual(self._get(f"/api/items/{self.shop.id}").json()['children'], [])
+        self.assertEqual([len(r['children']) for r in self._get("/api/items").json()], [1, 0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/items/{self.shelf.id}")
+        self.assertEqual(self._get(f"/api/items/{self.fan.id}").status_code, 404)
+        self.assertEqual(self._get(f"/api/items/{self.bench.id}").json()['children'], [])
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Just enough IMAP4rev1 (LOGIN, EXAMINE, UID SEARCH, UID FETCH) to drive itemsapi.ingest"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, uidvalidity=1):
+        self.messages = dict(messages)  # uid -> raw bytes
+        self.uidvalidity = uidvalidity
+        self.fetches = 0
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def uids(self, spec):
+        wanted = set()
+        for part in spec.split(','):
+            low, _, high = part.partition(':')
+            top = max(self.messages, default=0) if high == '*' else int(high or low)
+            wanted.update(range(min(int(low), top), max(int(low), top) + 1))
+        return sorted(wanted & set(self.messages))
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        self.wfile.write(b"* OK [CAPABILITY IMAP4rev1] fake server ready\r\n")
+        for line in self.rfile:
+            tag, command, *args = line.decode().split()
+            command = command.upper()
+            if command == 'CAPABILITY':
+                self.wfile.write(b"* CAPABILITY IMAP4rev1\r\n")
+            elif command in ('SELECT', 'EXAMINE'):
+                self.wfile.write(f"* {len(server.messages)} EXISTS\r\n"
+                                 f"* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid\r\n".encode())
+            elif command == 'UID' and args[0].upper() == 'SEARCH':
+                found = server.uids(args[-1])
+                self.wfile.write(f"* SEARCH {' '.join(map(str, found))}\r\n".encode())
+            elif command == 'UID' and args[0].upper() == 'FETCH':
+                server.fetches += 1
+                for uid in server.uids(args[1]):
+                    raw = server.messages[uid]
+                    self.wfile.write(f"* {uid} FETCH (UID {uid} RFC822 {{{len(raw)}}}\r\n".encode() + raw + b")\r\n")
+            elif command == 'LOGOUT':
+                self.wfile.write(b"* BYE\r\n")
+            self.wfile.write(f"{tag} OK {command} completed\r\n".encode())
+            if command == 'LOGOUT':
+                return
+
+
+def make_message(uid, subject, attachment=None):
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = f"sender{uid}@example.com"
+    msg['Date'] = f"Mon, 0{uid % 9 + 1} Sep 2025 10:00:00 +0000"
+    msg.set_content(f"Body of message {uid}")
+    if attachment:
+        msg.add_attachment(attachment, maintype='image', subtype='png', filename=f"photo{uid}.png")
+    return bytes(msg)
+
+
+class IngestPipelineTests(TestCase):
+    """itemsapi.ingest fetches in UID batches and resumes from its high-water mark"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        media = override_settings(MEDIA_ROOT=self.tmp)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.state = os.path.join(self.tmp, 'state.json')
+        self.inbox = Item.objects.create(name="Unprocessed")
+        self.server = FakeIMAPServer(
+            {uid: make_message(uid, f"Repair RAM{uid:03d}", b"png" if uid == 2 else None) for uid in range(1, 6)},
+            uidvalidity=7)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _run(self, **kwargs):
+        mail = ingest.connect('127.0.0.1', 'user', 'secret', port=self.server.server_address[1], ssl=False)
+        try:
+            mark = ingest.HighWaterMark(self.state, 'user/Sent')
+            return ingest.ingest(mail, 'Sent', ingest.OrmSink(self.inbox.id), mark, batch_size=2, **kwargs), mark
+        finally:
+            mail.logout()
+
+    def test_batched_fetch_and_resume(self):
+        written, mark = self._run(workers=0)
+        self.assertEqual((written, mark.uid, self.server.fetches), (5, 5, 3))
+        emails = Email.objects.filter(item=self.inbox).order_by('received_at')
+        self.assertEqual([e.qr_code for e in emails], [f"RAM{uid:03d}" for uid in range(1, 6)])
+        self.assertEqual(File.objects.filter(item=self.inbox).count(), 1)
+        self.assertEqual(Item.objects.get(id=self.inbox.id).cached_attachment_count, 6)
+
+        self.server.messages[6] = make_message(6, "Repair RAM006")
+        self.server.messages[7] = make_message(7, "Repair RAM007")
+        written, mark = self._run(workers=2)
+        self.assertEqual((written, mark.uid), (2, 7))
+        self.assertEqual(Email.objects.filter(item=self.inbox).count(), 7)
+
+        written, _ = self._run(workers=0)
+        self.assertEqual(written, 0)
+
+    def test_uidvalidity_change_restarts(self):
+        self._run(workers=0)
+        self.server.uidvalidity = 8
+        written, mark = self._run(workers=0)
+        self.assertEqual((written, mark.uidvalidity), (5, 8))
+
+
+class BulkEmailTests(TestCase):
+    """POST /emails/bulk stores new messages once and reports a status per email"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+        cls.inbox = Item.objects.create(name="Inbox")
+
+    def _email(self, n, **extra):
+        return {'item_id': self.inbox.id, 'subject': f"Repair RAM{n:03d}", 'body': f"Body {n}",
+                'from_address': "shop@example.com", 'received_at': f"2025-09-0{n}T10:00:00Z",
+                'qr_code': f"RAM{n:03d}", **extra}
+
+    def _post(self, entries):
+        return self.client.post("/api/emails/bulk", {'emails': entries}, content_type="application/json")
+
+    def test_dedupes_against_stored_and_batch(self):
+        first = self._post([self._email(1), self._email(2, message_id="<a@example.com>")]).json()
+        self.assertEqual(first['created'], 2)
+        self.assertEqual(Email.objects.get(id=first['results'][0]['id']).qr_code, "RAM001")
+
+        again = self._post([
+            self._email(1),
+            self._email(9, message_id="<a@example.com>"),
+            self._email(3),
+            self._email(3),
+            {**self._email(4), 'item_id': 999999},
+        ]).json()
+        self.assertEqual([r['status'] for r in again['results']],
+                         ['duplicate', 'duplicate', 'created', 'duplicate', 'error'])
+        self.assertEqual(again['results'][0]['id'], first['results'][0]['id'])
+        self.assertEqual(again['results'][2]['id'], again['results'][3]['id'])
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(Item.objects.get(id=self.inbox.id).cached_attachment_count, 3)
+
+    def test_single_create_keeps_qr_code_and_is_idempotent(self):
+        payload = self._email(5)
+        first = self.client.post(f"/api/items/{self.inbox.id}/emails", payload, content_type="application/json")
+        second = self.client.post(f"/api/items/{self.inbox.id}/emails", payload, content_type="application/json")
+        self.assertEqual(first.json()['qr_code'], "RAM005")
+        self.assertEqual(first.json()['id'], second.json()['id'])
+
+
+class EmailRoutingTests(TestCase):
+    """Emails are filed under the item matching their QR code"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = TestClient(api)
+        cls.inbox = Item.objects.create(name="Unprocessed")
+        cls.ram = Item.objects.create(name="RAM", qr_code="RAM001")
+        cls.gpu = Item.objects.create(name="GPU")
+        CodeIdentifier.objects.create(item=cls.gpu, code="GPU777", source="serial")
+
+    def setUp(self):
+        emails.resolver.clear()
+
+    def _email(self, n, qr_code):
+        return {'item_id': self.inbox.id, 'subject': f"Repair {qr_code}", 'body': f"Body {n}",
+                'from_address': "shop@example.com", 'received_at': f"2025-09-0{n}T10:00:00Z", 'qr_code': qr_code}
+
+    def test_bulk_import_routes_with_one_lookup(self):
+        entries = [self._email(1, "RAM001"), self._email(2, "GPU777"), self._email(3, "NOPE")]
+        with self.assertNumQueries(1):
+            emails.resolver.resolve([e['qr_code'] for e in entries])
+        with self.assertNumQueries(0):
+            emails.resolver.resolve(["RAM001", "GPU777"])
+        response = self.client.post("/api/emails/bulk", {'emails': entries, 'route': True},
+                                    content_type="application/json")
+        self.assertEqual([r['item_id'] for r in response.json()['results']], [self.ram.id, self.gpu.id, self.inbox.id])
+        self.assertEqual(Item.objects.get(id=self.ram.id).cached_attachment_count, 1)
+
+    def test_command_routes_backlog(self):
+        for n, code in enumerate(["RAM001", "GPU777", "NOPE", "LATER"], 1):
+            Email.objects.create(item=self.inbox, **{k: v for k, v in self._email(n, code).items() if k != 'item_id'})
+        emails.resolver.resolve(["LATER"])
+        Item.objects.create(name="Fan", qr_code="LATER")
+        call_command('route_emails', batch_size=2, stdout=StringIO())
+        self.assertEqual(
+            dict(Email.objects.values_list('qr_code', 'item__name')),
+            {"RAM001": "RAM", "GPU777": "GPU", "NOPE": "Unprocessed", "LATER": "Fan"})
+        self.assertEqual(Item.objects.get(id=self.inbox.id).cached_attachment_count, 1)
+
+
+class BlobStoreTests(TestCase):
+    """Attachments share one stored copy per content, collected once unreferenced"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        media = override_settings(MEDIA_ROOT=self.tmp)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.item = Item.objects.create(name="Laptop")
+        self.other = Item.objects.create(name="Printer")
+
+    def _stored(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.tmp)
+                      for root, _, names in os.walk(self.tmp) for name in names)
+
+    def test_identical_content_is_stored_once(self):
+        first = File.objects.create(item=self.item, file=ContentFile(b"%PDF manual", name="manual.pdf"),
+                                    file_type="application/pdf")
+        second = File.objects.create(item=self.other, file=ContentFile(b"%PDF manual", name="copy.PDF"),
+                                     file_type="application/pdf")
+        digest = hashlib.sha256(b"%PDF manual").hexdigest()
+        self.assertEqual(first.blob_id, digest)
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(self._stored(), [f"blobs/{digest[:2]}/{digest[2:4]}/{digest}.pdf"])
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+        with File.objects.get(pk=second.pk).file.open() as stored:
+            self.assertEqual(stored.read(), b"%PDF manual")
+
+    def test_upload_is_hashed_while_streamed_to_disk(self):
+        response = self.client.post(f"/api/items/{self.item.id}/files",
+                                 {'file': SimpleUploadedFile("logo.png", b"\x89PNG logo", "image/png")})
+        self.assertEqual(response.status_code, 200)
+        stored = File.objects.get(item=self.item)
+        self.assertEqual(stored.blob_id, hashlib.sha256(b"\x89PNG logo").hexdigest())
+        self.assertTrue(response.json()['file'].endswith(stored.blob_id + ".png"))
+
+    def test_garbage_collection_keeps_referenced_blobs(self):
+        kept = File.objects.create(item=self.item, file=ContentFile(b"kept", name="a.txt"), file_type="text/plain")
+        File.objects.create(item=self.item, file=ContentFile(b"gone", name="b.txt"), file_type="text/plain")
+        self.other.delete()
+        File.objects.exclude(pk=kept.pk).delete()
+        self.assertEqual(dict(Blob.objects.values_list('pk', 'ref_count')),
+                         {kept.blob_id: 1, hashlib.sha256(b"gone").hexdigest(): 0})
+
+        # Only the thumbnail of the collected blob was made: its missing preview is skipped
+        gone_thumbnail = blobs.storage().save(
+            derivative_name(hashlib.sha256(b"gone").hexdigest(), 'thumbnail'), ContentFile(b"webp"))
+        kept_preview = blobs.storage().save(derivative_name(kept.blob_id, 'preview'), ContentFile(b"webp"))
+
+        self.assertEqual(blobs.collect_garbage(), (0, 0))  # still within the grace period
+        self.assertEqual(blobs.collect_garbage(grace=0, dry_run=True), (1, 4))
+        self.assertEqual(len(self._stored()), 4)
+        self.assertEqual(blobs.collect_garbage(grace=0), (1, 4))
+        self.assertEqual(list(Blob.objects.values_list('pk', flat=True)), [kept.blob_id])
+        self.assertEqual(self._stored(), sorted([kept.file.name, kept_preview]))
+        self.assertFalse(blobs.storage().exists(gone_thumbnail))
+
+    def test_rolled_back_upload_file_is_collected(self):
+        with self.assertRaises(ValidationError):
+            with transaction.atomic():
+                File.objects.create(item=self.item, file=ContentFile(b"draft", name="draft.txt"),
+                                    file_type="text/plain")
+                raise ValidationError("rejected")
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(len(self._stored()), 1)
+        self.assertEqual(blobs.collect_garbage(), (0, 0))  # still within the grace period
+        self.assertEqual(blobs.collect_garbage(grace=0), (1, 5))
+        self.assertEqual(self._stored(), [])
+
+    def test_reused_blob_restarts_grace_period(self):
+        File.objects.create(item=self.item, file=ContentFile(b"spec", name="a.txt"), file_type="text/plain")
+        File.objects.all().delete()
+        old = timezone.now() - timedelta(days=2)
+        Blob.objects.update(created_at=old, last_referenced_at=old)
+        blob = Blob.objects.store(ContentFile(b"spec", name="b.txt"))
+        self.assertGreater(blob.last_referenced_at, old)
+        self.assertEqual(blobs.collect_garbage(grace=3600), (0, 0))
+        self.assertTrue(blobs.storage().exists(blob.name))
+
+    def test_legacy_files_are_adopted(self):
+        for name in ("attachments/a.pdf", "attachments/b.pdf"):
+            os.makedirs(os.path.join(self.tmp, "attachments"), exist_ok=True)
+            with open(os.path.join(self.tmp, name), 'wb') as f:
+                f.write(b"same datasheet")
+            File.objects.create(item=self.item, file=name, file_type="application/pdf")
+        File.objects.create(item=self.item, file="attachments/missing.pdf", file_type="application/pdf")
+
+        out = StringIO()
+        call_command('gc_blobs', '--adopt-legacy', '--recount', '--grace', '0', stdout=out)
+        self.assertIn("Moved 2 legacy files", out.getvalue())
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(self._stored(), [blob.name])
+        self.assertEqual(File.objects.filter(blob__isnull=True).count(), 1)
+
+
+@override_settings(ITEMSAPI_THUMBNAIL_WORKERS=0)
+class ThumbnailTests(TestCase):
+    """Image attachments get WebP derivatives once per blob, exposed on FileSchema"""
+
+    RENDERED = ({'thumbnail': b"thumb", 'preview': b"preview"}, None)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        media = override_settings(MEDIA_ROOT=self.tmp)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.item = Item.objects.create(name="Camera")
+
+    def _attach(self, content, file_type="image/jpeg"):
+        with self.captureOnCommitCallbacks(execute=True):
+            return File.objects.create(item=self.item, file=ContentFile(content, name="photo.jpg"),
+                                       file_type=file_type)
+
+    def test_images_are_rendered_once_per_blob(self):
+        with mock.patch.object(thumbnails, 'render_safely', return_value=self.RENDERED) as render:
+            photo = self._attach(b"jpeg bytes")
+            self._attach(b"jpeg bytes")
+            manual = self._attach(b"%PDF", file_type="application/pdf")
+        self.assertEqual(render.call_count, 1)
+
+        files = {f['id']: f for f in self.client.get(f"/api/items/{self.item.id}").json()['files']}
+        self.assertTrue(files[photo.id]['thumbnail'].endswith(f"{photo.blob_id}-thumbnail.webp"))
+        self.assertTrue(files[photo.id]['preview'].endswith(f"{photo.blob_id}-preview.webp"))
+        self.assertIsNone(files[manual.id]['thumbnail'])
+        with open(os.path.join(self.tmp, "derivatives", photo.blob_id[:2], photo.blob_id[2:4],
+                               f"{photo.blob_id}-thumbnail.webp"), 'rb') as f:
+            self.assertEqual(f.read(), b"thumb")
+
+    def test_backfill_retries_failed_images(self):
+        with mock.patch.object(thumbnails, 'render_safely', return_value=(None, "OSError: truncated")):
+            photo = self._attach(b"broken jpeg")
+        self.assertEqual(Blob.objects.get().derivatives_status, Blob.FAILED)
+        self.assertEqual(thumbnails.backfill(), (0, 0))
+
+        out = StringIO()
+        with mock.patch.object(thumbnails, 'render_safely', return_value=self.RENDERED):
+            call_command('generate_thumbnails', '--retry-failed', stdout=out)
+        self.assertIn("Rendered 1/1 images", out.getvalue())
+        self.assertEqual(Blob.objects.get().derivatives_status, Blob.READY)
+        self.assertIsNotNone(File.objects.get(pk=photo.pk).thumbnail)
+
+    @skipUnless(Image, "Pillow is not installed")
+    def test_render_produces_webp_of_the_configured_sizes(self):
+        out = BytesIO()
+        Image.new('RGB', (3000, 2000), 'red').save(out, 'JPEG')
+        rendered = imaging.render(out.getvalue())
+        with Image.open(BytesIO(rendered['thumbnail'])) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ('WEBP', imaging.THUMBNAIL_SIZE))
+        with Image.open(BytesIO(rendered['preview'])) as preview:
+            self.assertEqual(preview.size, (1280, 853))
+
+
+class AsyncReadTests(TestCase):
+    """The read endpoints are coroutines served through the async ORM"""
+
+    @classmethod
+    def setUpTestData(cls):
+        with cls.captureOnCommitCallbacks(execute=True):
+            cls.root = Item.objects.create(name="Rack")
+            cls.server = Item.objects.create(name="Server", parent=cls.root)
+        Note.objects.create(item=cls.server, content="Fans replaced")
+        CodeIdentifier.objects.create(item=cls.server, code="SRV-1", source="label")
+
+    async def test_item_path_notes_and_history(self):
+        response = await self.async_client.get(f"/api/items/{self.root.id}")
+        self.assertEqual(response.status_code, 200)
+        child = response.json()['children'][0]
+        self.assertEqual((child['name'], len(child['notes']), len(child['codes'])), ("Server", 1, 1))
+
+        again = await self.async_client.get(f"/api/items/{self.root.id}", headers={'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+        path = (await self.async_client.get(f"/api/items/{self.server.id}/path")).json()
+        self.assertEqual([item['name'] for item in path], ["Rack", "Server"])
+        notes = (await self.async_client.get(f"/api/items/{self.server.id}/notes")).json()
+        self.assertEqual([note['content'] for note in notes], ["Fans replaced"])
+        history = (await self.async_client.get(f"/api/items/{self.server.id}/history?limit=1")).json()
+        self.assertEqual(history[0]['action_type'], 'created')
+        self.assertEqual((await self.async_client.get("/api/items/999999")).status_code, 404)
+
+    async def test_listing_and_search(self):
+        page = await self.async_client.get("/api/items?limit=1&fields=name")
+        self.assertEqual(page.json(), [{'id': self.root.id, 'name': "Rack"}])
+        found = (await self.async_client.get("/api/items/search?q=server&fields=name")).json()
+        self.assertEqual([item['name'] for item in found], ["Server"])
+
+
+@override_settings(ITEMSAPI_METRICS_SAMPLE_RATE=1.0, ITEMSAPI_N_PLUS_ONE_THRESHOLD=3)
+class InstrumentationTests(TestCase):
+    """Sampled requests report their queries and timings per endpoint"""
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.root = Item.objects.create(name="Shelf")
+        for i in range(4):
+            Note.objects.create(item=Item.objects.create(name=f"Drive {i}", parent=self.root), content="wiped")
+
+    def test_server_timing_and_metrics_endpoint(self):
+        response = self.client.get(f"/api/items/{self.root.id}")
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", serialize;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertGreater(int(timing.split('desc="')[1].split()[0]), 0)
+
+        self.assertEqual(self.client.get("/api/metrics").status_code, 403)
+        self.client.force_login(User.objects.create_user("ops", password="secret", is_staff=True))
+        endpoint = self.client.get("/api/metrics").json()['endpoints']["GET /api/items/<item_id>"]
+        self.assertEqual((endpoint['samples'], endpoint['statuses'], endpoint['n_plus_one']), (1, {'200': 1}, 0))
+        self.assertEqual(endpoint['histograms']['queries']['count'], 1)
+        self.assertGreater(endpoint['histograms']['response_bytes']['sum'], 0)
+
+    def test_repeated_statements_are_flagged(self):
+        # Deleting through the collector issues per-row statements; the endpoint itself no longer does
+        collector_delete = mock.patch.object(deletion, 'delete_subtree', lambda item: item.delete())
+        with collector_delete, self.assertLogs('itemsapi.metrics', 'WARNING') as logs:
+            self.assertEqual(self.client.delete(f"/api/items/{self.root.id}").status_code, 204)
+        self.assertIn("Possible N+1 in DELETE /api/items/<item_id>", logs.output[0])
+        self.assertEqual(metrics.registry.snapshot()['endpoints']["DELETE /api/items/<item_id>"]['n_plus_one'], 1)
+        self.assertEqual(metrics.sql_shape('SELECT 1 FROM t WHERE id IN (%s, %s, %s) LIMIT 21'),
+                         'SELECT N FROM t WHERE id IN (%s...) LIMIT N')
+
+    @override_settings(ITEMSAPI_METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_recorded(self):
+        response = self.client.get(f"/api/items/{self.root.id}")
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(metrics.registry.snapshot()['endpoints'], {})
+
+
+class SubtreeAttachmentsTests(TestCase):
+    """GET /items/{id}/attachments pages every attachment of a subtree, newest first"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rack = Item.objects.create(name="Rack")
+        cls.server = Item.objects.create(name="Server", parent=cls.rack)
+        cls.disk = Item.objects.create(name="Disk", parent=cls.server)
+        cls.other = Item.objects.create(name="Other rack")
+        Note.objects.create(item=cls.rack, content="Rack note")
+        Note.objects.create(item=cls.disk, content="Disk note")
+        CodeIdentifier.objects.create(item=cls.server, code="SRV-1", source="label")
+        Email.objects.create(item=cls.disk, subject="Warranty", body="Until 2030", from_address="a@example.com",
+                             received_at=timezone.now())
+        Note.objects.create(item=cls.other, content="Elsewhere")
+        # Two attachments created at the same instant, ordered by type then id
+        same = timezone.now()
+        Note.objects.filter(item=cls.disk).update(created_at=same)
+        CodeIdentifier.objects.update(created_at=same)
+
+    def test_subtree_counts_and_order(self):
+        response = self.client.get(f"/api/items/{self.server.id}/attachments")
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['counts'], {'notes': 1, 'files': 0, 'emails': 1, 'codes': 1})
+        self.assertEqual([(entry['type'], entry['item_id']) for entry in body['results']],
+                         [('codes', self.server.id), ('notes', self.disk.id), ('emails', self.disk.id)])
+        self.assertEqual(body['results'][0]['code']['code'], "SRV-1")
+        self.assertNotIn('note', body['results'][0])
+
+        rack = self.client.get(f"/api/items/{self.rack.id}/attachments?types=notes").json()
+        self.assertEqual(rack['counts'], {'notes': 2})
+        self.assertEqual({entry['note']['content'] for entry in rack['results']}, {"Rack note", "Disk note"})
+
+    def test_cursor_walks_every_attachment_once(self):
+        expected = self.client.get(f"/api/items/{self.rack.id}/attachments").json()['results']
+        seen = []
+        cursor = None
+        while True:
+            url = f"/api/items/{self.rack.id}/attachments?limit=1" + (f"&cursor={cursor}" if cursor else "")
+            response = self.client.get(url)
+            seen += response.json()['results']
+            cursor = response.get('X-Next-Cursor')
+            if not cursor:
+                break
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(seen, expected)
+
+    def test_query_count_does_not_grow_with_the_subtree(self):
+        with self.assertNumQueries(5):  # item, page, counts, one per type on the page (codes, notes)
+            self.client.get(f"/api/items/{self.server.id}/attachments?types=notes,codes")
+
+    def test_errors_and_model_helper(self):
+        self.assertEqual(self.client.get(f"/api/items/{self.rack.id}/attachments?types=notes,photos").status_code, 422)
+        self.assertEqual(self.client.get(f"/api/items/{self.rack.id}/attachments?cursor=bogus").status_code, 422)
+        self.assertEqual(self.client.get("/api/items/999999/attachments").status_code, 404)
+        attachments = Item.objects.get(pk=self.server.pk).get_all_attachments()
+        self.assertEqual(attachments['notes'].get().content, "Disk note")
+        self.assertEqual(attachments['codes'].count(), 1)
+
+
+class RendererTests(TestCase):
+    """Responses are encoded by orjson, or as MessagePack when the client prefers it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Item.objects.create(name="Rack", description="Server rack")
+        cls.child = Item.objects.create(name="Server", parent=cls.root, qr_code="QR-S")
+        Note.objects.create(item=cls.child, content="Fans replaced")
+
+    def test_json_matches_the_django_encoder(self):
+        response = self.client.get(f"/api/items/{self.root.id}")
+        self.assertEqual(response['Content-Type'], "application/json; charset=utf-8")
+        self.assertIn('Accept', response['Vary'])
+        note = response.json()['children'][0]['notes'][0]
+        expected = json.loads(json.dumps({'at': Note.objects.get().created_at}, cls=DjangoJSONEncoder))['at']
+        self.assertEqual(note['created_at'], expected)
+        self.assertEqual(self.client.get("/api/items/999999")['Content-Type'], "application/json; charset=utf-8")
+
+    def test_negotiation(self):
+        def negotiate(accept):
+            return renderers.media_type(RequestFactory().get("/", HTTP_ACCEPT=accept))
+
+        with mock.patch.object(renderers, 'msgpack', object()):
+            self.assertEqual(negotiate("application/msgpack"), renderers.MSGPACK)
+            self.assertEqual(negotiate("application/x-msgpack, application/json;q=0.5"), renderers.MSGPACK)
+            self.assertEqual(negotiate("application/json, application/msgpack"), renderers.JSON)
+            self.assertEqual(negotiate("application/msgpack;q=0.2, */*;q=0.8"), renderers.JSON)
+            self.assertEqual(negotiate("*/*"), renderers.JSON)
+        with mock.patch.object(renderers, 'msgpack', None):
+            self.assertEqual(negotiate("application/msgpack"), renderers.JSON)
+
+    @skipUnless(renderers.msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        response = self.client.get(f"/api/items/{self.root.id}", HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(response['Content-Type'], "application/msgpack")
+        data = renderers.msgpack.unpackb(response.content)
+        self.assertEqual(data, self.client.get(f"/api/items/{self.root.id}").json())
+
+    @skipUnless(renderers.msgpack, "msgpack is not installed")
+    def test_skeleton_validators_depend_on_encoding(self):
+        as_json = self.client.get("/api/items/skeleton")
+        as_msgpack = self.client.get("/api/items/skeleton", HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(as_msgpack['Content-Type'], "application/msgpack")
+        self.assertEqual(renderers.msgpack.unpackb(as_msgpack.content), as_json.json())
+        self.assertNotEqual(as_msgpack['ETag'], as_json['ETag'])
+        again = self.client.get("/api/items/skeleton", HTTP_ACCEPT="application/msgpack",
+                                headers={'If-None-Match': as_json['ETag']})
+        self.assertEqual(again.status_code, 200)
+
+    def test_skeleton(self):
+        response = self.client.get("/api/items/skeleton")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{
+            'id': self.root.id, 'name': "Rack", 'qr_code': None, 'attachment_count': 0, 'children': [
+                {'id': self.child.id, 'name': "Server", 'qr_code': "QR-S", 'attachment_count': 1, 'children': []},
+            ],
+        }])
+        self.assertIn("Accept", response['Vary'])
+        again = self.client.get("/api/items/skeleton", headers={'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertIn("Accept", again['Vary'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.create(name="Shelf")
+        self.assertEqual(len(self.client.get("/api/items/skeleton").json()), 2)
+
+
+class ListingCatalogTests(TestCase):
+    """listing_json is validated JSON whose hot keys are generated, indexed columns"""
+
+    @classmethod
+    def setUpTestData(cls):
+        listings = [
+            ("Fan", {'price': 12.5, 'status': 'active', 'marketplace': 'ebay'}),
+            ("GPU", {'price': 320, 'status': 'active', 'marketplace': 'leboncoin'}),
+            ("CPU", {'price': 95, 'status': 'sold', 'marketplace': 'ebay'}),
+            ("Cable", {'title': "Cable", 'status': 'draft'}),
+            ("Screw", None),
+        ]
+        cls.items = {name: Item.objects.create(name=name, listing_json=listing) for name, listing in listings}
+
+    def _names(self, url):
+        return [listing['name'] for listing in self.client.get(url).json()]
+
+    def test_update_validates_and_fills_generated_columns(self):
+        screw = self.items["Screw"]
+        response = self.client.put(f"/api/items/{screw.id}/listing", {
+            'listing_json': {'title': "M3 screws", 'price': 2, 'status': 'active', 'marketplace': 'ebay', 'lot': 50},
+        }, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['listing_json'],
+                         {'title': "M3 screws", 'price': 2.0, 'status': 'active', 'marketplace': 'ebay', 'lot': 50})
+        screw = Item.objects.get(pk=screw.pk)
+        self.assertEqual((screw.listing_price, screw.listing_status, screw.listing_marketplace),
+                         (Decimal('2.00'), 'active', 'ebay'))
+
+        # Workers may still send the listing as a JSON string
+        response = self.client.put(f"/api/items/{screw.id}/listing", {'listing_json': '{"price": 3}'},
+                                   content_type="application/json")
+        self.assertEqual(response.json()['listing_json'], {'price': 3.0})
+        for invalid in ({'price': -1}, {'status': 'lost'}, {'currency': 'euro'}, "{not json", "[1, 2]"):
+            response = self.client.put(f"/api/items/{screw.id}/listing", {'listing_json': invalid},
+                                       content_type="application/json")
+            self.assertEqual(response.status_code, 422, invalid)
+
+    def test_filter_and_sort_in_sql(self):
+        self.assertEqual(self._names("/api/listings"), ["Cable", "CPU", "GPU", "Fan"])
+        self.assertEqual(self._names("/api/listings?status=active&sort=price"), ["Fan", "GPU"])
+        self.assertEqual(self._names("/api/listings?marketplace=ebay&sort=-price"), ["CPU", "Fan"])
+        self.assertEqual(self._names("/api/listings?min_price=50&max_price=100"), ["CPU"])
+        self.assertEqual(self.client.get("/api/listings?sort=name").status_code, 422)
+
+        seen = []
+        url = "/api/listings?sort=-price&limit=1"
+        while url:
+            response = self.client.get(url)
+            seen += [listing['name'] for listing in response.json()]
+            cursor = response.get('X-Next-Cursor')
+            url = f"/api/listings?sort=-price&limit=1&cursor={cursor}" if cursor else None
+        self.assertEqual(seen, ["GPU", "CPU", "Fan"])
+
+        listing = self.client.get("/api/listings?status=sold").json()[0]
+        self.assertEqual((listing['price'], listing['status'], listing['marketplace']), (95.0, 'sold', 'ebay'))
+        plan = Item.objects.filter(listing_status='active').order_by('listing_price', 'id').explain()
+        self.assertIn('item_listing_status_idx', plan)
+
+    def test_migration_keeps_unparseable_listings(self):
+        migration = import_module('itemsapi.migrations.0013_item_listing_json_structured')
+        self.assertEqual(migration.parse_listing('{"price": "12.50", "status": "active"}'),
+                         {'price': 12.5, 'status': 'active'})
+        self.assertEqual(migration.parse_listing('{"price": "call me"}'), {'raw_price': "call me"})
+        self.assertEqual(migration.parse_listing('free text'), {'raw': "free text"})
+
+
+class TreeGeometryTests(TestCase):
+    """Ancestor paths and containment come from the in-process geometry cache"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shop = Item.objects.create(name="Shop")
+        cls.laptop = Item.objects.create(name="Laptop", parent=cls.shop)
+        cls.board = Item.objects.create(name="Board", parent=cls.laptop)
+        cls.cpu = Item.objects.create(name="CPU", parent=cls.board)
+        cls.shelf = Item.objects.create(name="Shelf")
+
+    def setUp(self):
+        geometry.clear()
+        self.addCleanup(geometry.clear)
+
+    def _fresh(self, item):
+        return Item.objects.get(pk=item.pk)
+
+    def test_answers_without_queries_once_loaded(self):
+        cpu, laptop = self._fresh(self.cpu), self._fresh(self.laptop)
+        with self.assertNumQueries(1):
+            self.assertEqual([node.pk for node in geometry.ancestors(cpu, include_self=True)],
+                             [self.shop.id, self.laptop.id, self.board.id, self.cpu.id])
+        with self.assertNumQueries(0):
+            self.assertEqual(geometry.path(cpu), "Shop/Laptop/Board/CPU")
+            self.assertTrue(geometry.is_ancestor(laptop, cpu))
+            self.assertFalse(geometry.is_ancestor(cpu, laptop))
+            self.assertFalse(geometry.is_ancestor(cpu, cpu))
+            self.assertTrue(geometry.is_ancestor(cpu, cpu, include_self=True))
+            with self.assertRaises(ValidationError):
+                laptop.validate_move(cpu)
+
+        node = geometry.ancestors(cpu)[-1]
+        self.assertEqual((node.pk, node.parent_id, node.level, node.name), (self.board.id, self.laptop.id, 2, "Board"))
+        response = self.client.get(f"/api/items/{self.cpu.id}/path")
+        self.assertEqual([item['name'] for item in response.json()], ["Shop", "Laptop", "Board", "CPU"])
+
+    def test_writes_are_seen_by_the_writer_and_published_on_commit(self):
+        laptop = self._fresh(self.laptop)
+        geometry.get(laptop.tree_id)
+        version = cache.geometry_version(laptop.tree_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            fan = Item.objects.create(name="Fan", parent=laptop)
+        self.assertNotEqual(cache.geometry_version(laptop.tree_id), version)
+        self.assertEqual(geometry.path(fan), "Shop/Laptop/Fan")
+
+        # A move to another tree changes both; an instance loaded before the move is still found
+        stale = self._fresh(self.board)
+        shelf_tree = self._fresh(self.shelf).tree_id
+        shelf_version = cache.geometry_version(shelf_tree)
+        self._fresh(self.board).move_under(self._fresh(self.shelf))
+        self.assertEqual(geometry.path(self._fresh(self.cpu)), "Shelf/Board/CPU")
+        self.assertTrue(geometry.is_ancestor(self.shelf, stale))
+        self.assertFalse(geometry.is_ancestor(self.laptop, self._fresh(self.cpu)))
+        self.assertEqual(geometry.path(self._fresh(self.laptop)), "Shop/Laptop")
+
+        # New roots can renumber other trees: every tree's version changes
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.create(name="Attic")
+        self.assertNotEqual(cache.geometry_version(shelf_tree), shelf_version)
+
+    def test_bulk_writes_invalidate_geometry_on_commit(self):
+        from . import bulk
+        shop_tree, shelf_tree = self._fresh(self.shop).tree_id, self._fresh(self.shelf).tree_id
+        self.assertEqual(geometry.path(self._fresh(self.cpu)), "Shop/Laptop/Board/CPU")
+        geometry.get(shelf_tree)
+        versions = [cache.geometry_version(shop_tree), cache.geometry_version(shelf_tree)]
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk.move_items([(self.board.id, self.shelf.id)])
+            # Nothing is published before the commit, but the writer sees its own move
+            self.assertEqual([cache.geometry_version(shop_tree), cache.geometry_version(shelf_tree)], versions)
+            self.assertEqual(geometry.path(self._fresh(self.cpu)), "Shelf/Board/CPU")
+        self.assertNotEqual(cache.geometry_version(shop_tree), versions[0])
+        self.assertNotEqual(cache.geometry_version(shelf_tree), versions[1])
+        self.assertEqual(geometry.path(self._fresh(self.cpu)), "Shelf/Board/CPU")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/items/bulk", {
+                'parent_id': self.laptop.id, 'items': [{'name': "Fan", 'children': [{'name': "Blade"}]}],
+            }, content_type="application/json")
+        blade = Item.objects.get(pk=response.json()['ids'][1])
+        self.assertEqual(geometry.path(blade), "Shop/Laptop/Fan/Blade")
+
+    def test_move_under_a_descendant_is_rejected(self):
+        response = self.client.put(f"/api/items/{self.laptop.id}/move", {'new_parent_id': self.cpu.id},
+                                   content_type="application/json")
+        self.assertEqual(response.status_code, 422)
+
+    @override_settings(ITEMSAPI_GEOMETRY_TREES=1)
+    def test_keeps_a_bounded_number_of_trees(self):
+        shop_tree, shelf_tree = self._fresh(self.shop).tree_id, self._fresh(self.shelf).tree_id
+        geometry.get(shop_tree)
+        with self.assertNumQueries(0):
+            geometry.get(shop_tree)
+        geometry.get(shelf_tree)
+        with self.assertNumQueries(1):
+            geometry.get(shop_tree)
+
+
+class HistoryTests(TestCase):
+    """Old runs of moves are compacted and past layouts are rebuilt from the history"""
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bench = Item.objects.create(name="Bench")
+            self.shelf = Item.objects.create(name="Shelf")
+            self.fan = Item.objects.create(name="Fan", parent=self.bench)
+            for parent in (self.shelf, self.bench, self.shelf):
+                Item.objects.get(id=self.fan.id).move_under(Item.objects.get(id=parent.id))
+        # Spread the rows a minute apart, starting 200 days ago
+        self.start = timezone.now() - timedelta(days=200)
+        for minute, pk in enumerate(ComponentHistory.objects.order_by('id').values_list('id', flat=True)):
+            ComponentHistory.objects.filter(pk=pk).update(changed_at=self.start + timedelta(minutes=minute))
+
+    def _moves(self):
+        return list(ComponentHistory.objects.filter(item=self.fan, action_type=ComponentHistory.MOVED)
+                    .order_by('changed_at'))
+
+    def test_compact_merges_old_runs_of_moves(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.get(id=self.fan.id).move_under(Item.objects.get(id=self.bench.id))
+        out = StringIO()
+        call_command('compact_history', '--dry-run', stdout=out)
+        self.assertIn("Would merge 1 runs of moves, removing 2 history rows", out.getvalue())
+        self.assertEqual(len(self._moves()), 4)
+
+        call_command('compact_history', stdout=StringIO())
+        old, recent = self._moves()
+        self.assertEqual((old.old_parent_id, old.new_parent_id, old.moves), (self.bench.id, self.shelf.id, 3))
+        self.assertEqual(old.first_changed_at, self.start + timedelta(minutes=3))
+        self.assertEqual((recent.moves, recent.first_changed_at), (1, None))
+        self.assertEqual(ComponentHistory.objects.filter(item=self.fan, action_type=ComponentHistory.CREATED).count(), 1)
+
+        history = self.client.get(f"/api/items/{self.fan.id}/history").json()
+        self.assertEqual([entry['moves'] for entry in history], [1, 3, 1])
+
+    def test_layout_as_of(self):
+        at = (self.start + timedelta(minutes=3, seconds=30)).isoformat()
+        response = self.client.get("/api/items/as-of", {'at': at})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual([(root['name'], [child['name'] for child in root['children']]) for root in response.json()],
+                         [("Bench", []), ("Shelf", ["Fan"])])
+
+        at = (self.start + timedelta(minutes=4, seconds=30)).isoformat()
+        bench = self.client.get(f"/api/items/{self.bench.id}/as-of", {'at': at}).json()
+        self.assertEqual(bench['children'], [{'id': self.fan.id, 'name': "Fan", 'parent_id': self.bench.id,
+                                              'children': []}])
+
+        # A time within a compacted run places the item where it was before the run
+        history.compact()
+        shelf = history.layout_as_of(self.start + timedelta(minutes=3, seconds=30), self.shelf.id)
+        self.assertEqual(shelf['children'], [])
+
+        before = (self.start - timedelta(days=1)).isoformat()
+        self.assertEqual(self.client.get(f"/api/items/{self.bench.id}/as-of", {'at': before}).status_code, 404)
+
+
+class HistoryRecordingTests(TestCase):
+    """History rows are written in one INSERT per transaction and outlive deleted items"""
+
+    def _history_inserts(self, queries):
+        return [q for q in queries if q['sql'].startswith('INSERT INTO "itemsapi_componenthistory"')]
+
+    def test_delete_writes_one_insert_at_commit_and_keeps_the_rows(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            rack = Item.objects.create(name="Rack")
+            server = Item.objects.create(name="Server", parent=rack)
+            Item.objects.create(name="Disk", parent=server)
+        created_at = timezone.now()
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                Item.objects.get(id=server.id).delete()
+                self.assertFalse(ComponentHistory.objects.filter(action_type=ComponentHistory.DELETED).exists())
+        self.assertEqual(len(self._history_inserts(queries.captured_queries)), 1)
+        deleted = ComponentHistory.objects.filter(action_type=ComponentHistory.DELETED)
+        self.assertEqual(sorted(deleted.values_list('item_name', flat=True)), ["Disk", "Server"])
+        self.assertEqual(ComponentHistory.objects.filter(action_type=ComponentHistory.CREATED).count(), 3)
+
+        self.assertEqual(history.layout_as_of(timezone.now(), rack.id)['children'], [])
+        server_then = history.layout_as_of(created_at, rack.id)['children'][0]
+        self.assertEqual((server_then['name'], [disk['name'] for disk in server_then['children']]),
+                         ("Server", ["Disk"]))
+
+    def test_rows_of_a_rolled_back_savepoint_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            shelf = Item.objects.create(name="Shelf")
+            try:
+                with transaction.atomic():
+                    Item.objects.create(name="Box", parent=shelf)
+                    raise ValueError
+            except ValueError:
+                pass
+            Item.objects.create(name="Fan", parent=shelf)
+        self.assertEqual(sorted(ComponentHistory.objects.values_list('item__name', flat=True)), ["Fan", "Shelf"])
+
+
+class SubtreeDeletionTests(TestCase):
+    """Subtrees are deleted with set-based statements, or trashed and restored with their ids"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        media = override_settings(MEDIA_ROOT=self.tmp, ITEMSAPI_THUMBNAIL_WORKERS=0)
+        media.enable()
+        self.addCleanup(media.disable)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shop = Item.objects.create(name="Shop")
+            self.bench = Item.objects.create(name="Bench", parent=self.shop)
+            self.drill = Item.objects.create(name="Drill", parent=self.bench, qr_code="DRL-1")
+            self.shelf = Item.objects.create(name="Shelf", parent=self.shop)
+            Item.objects.create(name="Screws", parent=self.shelf)
+        self.note = Note.objects.create(item=self.drill, content="Chuck replaced")
+        CodeIdentifier.objects.create(item=self.drill, code="DRL-1", source="label")
+        Email.objects.create(item=self.drill, subject="Invoice", body="Paid", from_address="shop@vendor.com",
+                             received_at=timezone.now())
+        self.manual = File.objects.create(item=self.drill, file=ContentFile(b"%PDF manual", name="manual.pdf"),
+                                          file_type="application/pdf")
+        blobs.storage().save("attachments/receipt.txt", ContentFile(b"receipt"))
+        File.objects.create(item=self.bench, file="attachments/receipt.txt", file_type="text/plain")
+
+    def _snapshot(self):
+        # tree_id is left out: rebuild() renumbers root trees in name order
+        return sorted(Item.objects.values_list('full_path', 'path_ids', 'lft', 'rght', 'level'))
+
+    def _drain_removals(self):
+        deletion.remover().submit(int).result()
+
+    def test_delete_is_set_based_and_releases_files(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f"/api/items/{self.bench.id}").status_code, 204)
+        self._drain_removals()
+        item_deletes = [q for q in queries.captured_queries if q['sql'].startswith('DELETE FROM "itemsapi_item"')]
+        self.assertEqual(len(item_deletes), 1)
+
+        self.assertEqual(sorted(Item.objects.values_list('name', flat=True)), ["Screws", "Shelf", "Shop"])
+        for model in (Note, CodeIdentifier, Email, File):
+            self.assertFalse(model.objects.exists())
+        self.assertEqual(Blob.objects.get(pk=self.manual.blob_id).ref_count, 0)
+        self.assertFalse(blobs.storage().exists("attachments/receipt.txt"))
+        self.assertEqual(sorted(ComponentHistory.objects.filter(action_type=ComponentHistory.DELETED)
+                                .values_list('item_name', flat=True)), ["Bench", "Drill"])
+        self.assertEqual(self.client.get("/api/items/search", {'q': "drill"}).json(), [])
+        before = self._snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._snapshot())
+
+    def test_trash_restore_and_purge(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(f"/api/items/{self.shop.id}")
+            self.assertEqual(self.client.delete(f"/api/items/{self.bench.id}?trash=true").status_code, 204)
+        self.assertEqual(self.client.get(f"/api/items/{self.drill.id}").status_code, 404)
+        self.assertEqual([child['name'] for child in self.client.get(f"/api/items/{self.shop.id}").json()['children']],
+                         ["Shelf"])
+        trash = self.client.get("/api/trash").json()
+        self.assertEqual([(t['item_id'], t['full_path'], t['item_count']) for t in trash],
+                         [(self.bench.id, "Shop/Bench", 2)])
+        self.assertEqual(Blob.objects.get(pk=self.manual.blob_id).ref_count, 1)
+        self.assertTrue(blobs.storage().exists("attachments/receipt.txt"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"/api/trash/{self.bench.id}/restore")
+        self.assertEqual(response.status_code, 200, response.content)
+        drill = response.json()['children'][0]
+        self.assertEqual((drill['id'], drill['full_path'], len(drill['notes']), len(drill['emails'])),
+                         (self.drill.id, "Shop/Bench/Drill", 1, 1))
+        self.assertEqual(Note.objects.get().created_at, self.note.created_at)
+        self.assertEqual(Item.objects.get(id=self.drill.id).created_at, self.drill.created_at)
+        self.assertEqual(ComponentHistory.objects.filter(action_type=ComponentHistory.RESTORED).count(), 2)
+        self.assertEqual(self.client.get("/api/trash").json(), [])
+        before = self._snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._snapshot())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/items/{self.bench.id}?trash=true")
+            self.assertEqual(self.client.delete(f"/api/trash/{self.bench.id}").status_code, 204)
+        self._drain_removals()
+        self.assertEqual(Blob.objects.get(pk=self.manual.blob_id).ref_count, 0)
+        self.assertFalse(blobs.storage().exists("attachments/receipt.txt"))
+        self.assertEqual(self.client.post(f"/api/trash/{self.bench.id}/restore").status_code, 404)
+
+    def test_restore_without_parent_makes_a_new_tree(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.trash_subtree(self.bench)
+            deletion.delete_subtree(self.shop)
+            bench = deletion.restore(TrashedSubtree.objects.get(item_id=self.bench.id))
+        self.assertIsNone(bench.parent_id)
+        self.assertEqual(Item.objects.get(id=self.drill.id).full_path, "Bench/Drill")
+        before = self._snapshot()
+        Item.objects.rebuild()
+        self.assertEqual(before, self._snapshot())
+
+    def test_purge_trash_command(self):
+        deletion.trash_subtree(self.bench)
+        deletion.trash_subtree(self.shelf)
+        TrashedSubtree.objects.filter(item_id=self.bench.id).update(deleted_at=timezone.now() - timedelta(days=31))
+        out = StringIO()
+        call_command('purge_trash', stdout=out)
+        self.assertIn("Purged 1 trashed subtrees", out.getvalue())
+        self.assertEqual(list(TrashedSubtree.objects.values_list('item_id', flat=True)), [self.shelf.id])
@@ -0,0 +1,136 @@
+"""
+Thumbnail and preview generation for image attachments.
+
+Derivatives belong to blobs (see itemsapi.blobs), so an image attached a
+thousand times is rendered once. When a File with an ``image/*`` type is
+created, its blob is queued after the transaction commits: the image is
+decoded and resized in a process pool (itemsapi.imaging), and the WebP
+results are written to ``derivatives/`` from the pool's callback thread.
+``Blob.derivatives_status`` records the outcome; FileSchema exposes the
+URLs once it is ``ready``.
+
+``manage.py generate_thumbnails`` renders the derivatives of blobs stored
+before the pipeline existed, or whose job was lost with its process.
+"""
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection
+
+from .imaging import render, render_safely
+from .models import Blob, File, derivative_name
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 20
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def workers():
+    """Size of the rendering pool; 0 renders inline in the calling thread"""
+    return getattr(settings, 'ITEMSAPI_THUMBNAIL_WORKERS', 2)
+
+
+def is_image(file_type):
+    return (file_type or '').startswith('image/')
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(workers())
+        return _executor
+
+
+def _source(blob_name):
+    """The stored image as a path the workers can open, or its bytes for remote storages"""
+    storage = File._meta.get_field('file').storage
+    try:
+        return storage.path(blob_name)
+    except NotImplementedError:
+        with storage.open(blob_name) as f:
+            return f.read()
+
+
+def save(sha256, rendered, error=None):
+    """Stores the derivatives rendered for blob ``sha256`` and records the outcome"""
+    if rendered is None:
+        logger.warning("Could not render derivatives of blob %s: %s", sha256, error)
+        Blob.objects.filter(pk=sha256).update(derivatives_status=Blob.FAILED)
+        return False
+    storage = File._meta.get_field('file').storage
+    for kind in Blob.DERIVATIVES:
+        name = derivative_name(sha256, kind)
+        # Rendering is deterministic, so a copy left by an earlier run is as good
+        if not storage.exists(name):
+            storage.save(name, ContentFile(rendered[kind]))
+    Blob.objects.filter(pk=sha256).update(derivatives_status=Blob.READY)
+    return True
+
+
+def _saved(sha256, future):
+    try:
+        try:
+            rendered, error = future.result(), None
+        except Exception as exc:
+            rendered, error = None, f"{type(exc).__name__}: {exc}"
+        save(sha256, rendered, error)
+    except Exception:
+        logger.exception("Could not store derivatives of blob %s", sha256)
+    finally:
+        # Runs in the pool's result thread, which Django never cleans up after
+        connection.close()
+
+
+def schedule(sha256):
+    """Queues rendering of blob ``sha256``'s derivatives, or renders them now when ``workers()`` is 0"""
+    blob = Blob.objects.filter(pk=sha256).values('name', 'derivatives_status').first()
+    if blob is None or blob['derivatives_status'] != Blob.PENDING:
+        return
+    source = _source(blob['name'])
+    if workers() == 0:
+        save(sha256, *render_safely(source))
+        return
+    executor().submit(render, source).add_done_callback(partial(_saved, sha256))
+
+
+def pending(retry_failed=False):
+    """Blobs of image files whose derivatives are still missing, in sha256 order"""
+    statuses = [Blob.PENDING, Blob.FAILED] if retry_failed else [Blob.PENDING]
+    images = File.objects.filter(file_type__startswith='image/').values('blob')
+    return Blob.objects.filter(derivatives_status__in=statuses, pk__in=images).order_by('pk')
+
+
+def backfill(retry_failed=False, batch_size=BATCH_SIZE, progress=None):
+    """
+    Renders the derivatives of every ``pending`` blob, ``batch_size`` at a
+    time across the pool, and returns (ready, failed). Finished blobs leave
+    the pending set, so an interrupted backfill resumes where it stopped.
+    ``progress`` is called with (done, total) after each batch.
+    """
+    queryset = pending(retry_failed)
+    total = queryset.count()
+    ready = failed = 0
+    last = ''
+    pool = executor() if workers() else None
+    while True:
+        batch = list(queryset.filter(pk__gt=last).values_list('sha256', 'name')[:batch_size])
+        if not batch:
+            return ready, failed
+        last = batch[-1][0]
+        sources = [_source(name) for _, name in batch]
+        results = pool.map(render_safely, sources) if pool else map(render_safely, sources)
+        for (sha256, _), (rendered, error) in zip(batch, results):
+            if save(sha256, rendered, error):
+                ready += 1
+            else:
+                failed += 1
+        if progress:
+            progress(ready + failed, total)
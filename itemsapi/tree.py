@@ -0,0 +1,238 @@
+"""
+Single-pass assembly of nested ItemOut payloads.
+
+Whole subtrees are fetched with one range query over the MPTT
+``tree_id``/``lft``/``rght`` columns and every attachment type with one bulk
+query, then linked together in memory. The number of queries stays the same
+whatever the size of the tree.
+
+A ``Selection`` limits the scalar fields and relations that are built; a
+relation that is not selected is neither queried nor serialized.
+
+The ``a``-prefixed variants do the same through the async ORM for the
+async views, running the attachment queries concurrently.
+"""
+import asyncio
+from typing import FrozenSet, NamedTuple, Tuple
+
+from django.db.models import Q, QuerySet
+
+from .models import Item, Note, File, Email, CodeIdentifier, ComponentHistory, Blob, derivative_url
+
+# Scalar fields serialized by ItemOut
+OUTPUT_FIELDS = (
+    'id', 'name', 'description', 'qr_code', 'listing_json', 'listing_worker',
+    'parent_id', 'created_at', 'level', 'full_path', 'attachment_count',
+)
+
+# Columns always loaded to link nodes together
+LINK_FIELDS = ('id', 'parent_id', 'tree_id', 'lft', 'rght')
+
+# related_name -> (model, fields serialized by the matching schema)
+ATTACHMENT_FIELDS = {
+    'history': (ComponentHistory, ('id', 'old_parent_id', 'new_parent_id', 'action_type', 'changed_at',
+                                    'moves', 'first_changed_at')),
+    'notes': (Note, ('id', 'created_at', 'content', 'author')),
+    'codes': (CodeIdentifier, ('id', 'created_at', 'code', 'source')),
+    'files': (File, ('id', 'created_at', 'file', 'file_type', 'blob_id', 'blob__derivatives_status')),
+    'emails': (Email, ('id', 'created_at', 'subject', 'body', 'from_address', 'received_at', 'qr_code')),
+}
+
+RELATIONS = ('children',) + tuple(ATTACHMENT_FIELDS)
+
+
+class Selection(NamedTuple):
+    fields: Tuple[str, ...]
+    expand: FrozenSet[str]
+
+
+FULL = Selection(OUTPUT_FIELDS, frozenset(RELATIONS))
+SKELETON = Selection(('id', 'name', 'qr_code', 'attachment_count'), frozenset({'children'}))
+
+
+def parse_selection(fields=None, expand=None):
+    """
+    Builds a Selection from comma-separated ``fields``/``expand`` query values.
+    Without either, everything is selected; ``fields`` alone selects no
+    relations and ``expand`` alone keeps every scalar field. Raises ValueError
+    on unknown names.
+    """
+    if fields is None and expand is None:
+        return FULL
+    names = [name.strip() for name in (fields or '').split(',') if name.strip()]
+    relations = {name.strip() for name in (expand or '').split(',') if name.strip()}
+    unknown = [name for name in names if name not in OUTPUT_FIELDS]
+    unknown += sorted(relations - set(RELATIONS))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    selected = set(names) | {'id'} if fields is not None else set(OUTPUT_FIELDS)
+    return Selection(tuple(name for name in OUTPUT_FIELDS if name in selected), frozenset(relations))
+
+
+def subtree_filter(items):
+    """Returns a Q matching the subtrees rooted at ``items``, nested ranges merged"""
+    q = Q()
+    whole_trees = []
+    last = None
+    for item in sorted(items, key=lambda i: (i.tree_id, i.lft)):
+        if last and last.tree_id == item.tree_id and item.rght <= last.rght:
+            continue  # already covered by an enclosing subtree
+        last = item
+        if item.lft == 1:
+            whole_trees.append(item.tree_id)
+        else:
+            q |= Q(tree_id=item.tree_id, lft__gte=item.lft, rght__lte=item.rght)
+    if whole_trees:
+        q |= Q(tree_id__in=whole_trees)
+    return q
+
+
+def _serialize_file(row):
+    name = row['file']
+    row['file'] = File._meta.get_field('file').storage.url(name) if name else None
+    sha256, status = row.pop('blob_id'), row.pop('blob__derivatives_status')
+    for kind in Blob.DERIVATIVES:
+        row[kind] = derivative_url(sha256, status, kind)
+    return row
+
+
+def _attachment_rows(related_name, item_ids):
+    model, fields = ATTACHMENT_FIELDS[related_name]
+    ordering = model._meta.ordering or ['pk']
+    return model.objects.filter(item__in=item_ids).order_by(*ordering, 'pk').values('item_id', *fields)
+
+
+def _fill(nodes, related_name, rows):
+    serialize = _serialize_file if related_name == 'files' else None
+    for row in rows:
+        node = nodes.get(row.pop('item_id'))
+        if node is not None:
+            node[related_name].append(serialize(row) if serialize else row)
+
+
+def attach(nodes, attachments, item_ids):
+    """Fills the ``attachments`` lists of ``nodes`` with one query per attachment type"""
+    for related_name in attachments:
+        _fill(nodes, related_name, _attachment_rows(related_name, item_ids))
+
+
+async def aattach(nodes, attachments, item_ids):
+    """``attach`` with the attachment queries run concurrently"""
+    async def fetch(related_name):
+        return [row async for row in _attachment_rows(related_name, item_ids)]
+
+    for related_name, rows in zip(attachments, await asyncio.gather(*map(fetch, attachments))):
+        _fill(nodes, related_name, rows)
+
+
+def _plan(queryset, selection):
+    """Returns the ordered row queryset of ``assemble`` and the attachment types to load"""
+    attachments = [name for name in ATTACHMENT_FIELDS if name in selection.expand]
+    if 'attachment_count' in selection.fields:
+        queryset = queryset.with_attachment_count()
+    columns = list(LINK_FIELDS) + [name for name in selection.fields if name not in LINK_FIELDS]
+    return queryset.order_by('tree_id', 'lft').values(*columns), attachments
+
+
+def _link(rows, selection, attachments):
+    link_children = 'children' in selection.expand
+    nodes = {}
+    for row in rows:
+        if link_children:
+            row['children'] = []
+            parent = nodes.get(row['parent_id'])
+            if parent is not None:
+                parent['children'].append(row)
+        for related_name in attachments:
+            row[related_name] = []
+        nodes[row['id']] = row
+    return nodes
+
+
+def _finish(nodes, selection):
+    if 'parent_id' not in selection.fields:
+        for node in nodes.values():
+            del node['parent_id']
+    return nodes
+
+
+def assemble(queryset, selection=FULL):
+    """Builds linked node dicts for every item of ``queryset``, keyed by id in tree order"""
+    rows, attachments = _plan(queryset, selection)
+    nodes = _link(rows, selection, attachments)
+    if not nodes:
+        return nodes
+    attach(nodes, attachments, queryset.values('id'))
+    return _finish(nodes, selection)
+
+
+async def aassemble(queryset, selection=FULL):
+    rows, attachments = _plan(queryset, selection)
+    nodes = _link([row async for row in rows], selection, attachments)
+    if not nodes:
+        return nodes
+    await aattach(nodes, attachments, queryset.values('id'))
+    return _finish(nodes, selection)
+
+
+def _forest_queryset(selection):
+    return Item.objects.all() if 'children' in selection.expand else Item.objects.root_nodes()
+
+
+def _subtrees_queryset(items, selection):
+    if 'children' in selection.expand:
+        return Item.objects.filter(subtree_filter(items))
+    return Item.objects.filter(pk__in=[item.pk for item in items])
+
+
+def build_forest(selection=FULL):
+    """Returns the complete inventory as a list of nested root nodes"""
+    return [node for node in assemble(_forest_queryset(selection), selection).values() if node['lft'] == 1]
+
+
+async def abuild_forest(selection=FULL):
+    nodes = await aassemble(_forest_queryset(selection), selection)
+    return [node for node in nodes.values() if node['lft'] == 1]
+
+
+def trim(roots, selection):
+    """Drops the link columns ``selection`` did not ask for, from nodes rendered without a response schema"""
+    extra = [name for name in LINK_FIELDS if name not in selection.fields]
+    pending = list(roots)
+    while pending:
+        node = pending.pop()
+        for name in extra:
+            node.pop(name, None)
+        pending.extend(node.get('children', ()))
+    return roots
+
+
+async def abuild_skeleton():
+    """The whole inventory as SKELETON nodes, ready to render"""
+    return trim(await abuild_forest(SKELETON), SKELETON)
+
+
+def build_subtrees(items, selection=FULL):
+    """Returns one nested node per item of ``items``, in the same order"""
+    items = list(items)
+    if not items:
+        return []
+    nodes = assemble(_subtrees_queryset(items, selection), selection)
+    return [nodes[item.pk] for item in items]
+
+
+async def abuild_subtrees(items, selection=FULL):
+    items = [item async for item in items] if isinstance(items, QuerySet) else list(items)
+    if not items:
+        return []
+    nodes = await aassemble(_subtrees_queryset(items, selection), selection)
+    return [nodes[item.pk] for item in items]
+
+
+def build_subtree(item, selection=FULL):
+    """Returns the nested node for a single item"""
+    return build_subtrees([item], selection)[0]
+
+
+async def abuild_subtree(item, selection=FULL):
+    return (await abuild_subtrees([item], selection))[0]
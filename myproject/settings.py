@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'itemsapi.middleware.InstrumentationMiddleware',
 #    'itemsapi.middleware.RequestLoggingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -73,6 +74,12 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'if-none-match',
+]
+CORS_EXPOSE_HEADERS = [
+    'etag',
+    'x-next-cursor',
+    'server-timing',
 ]
 
 ROOT_URLCONF = 'myproject.urls'
@@ -107,6 +114,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Use the redis service from docker-compose with
+# {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://redis:6379/0'}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -150,3 +169,41 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+
+# Stream every upload to disk (hashing it for the blob store) instead of
+# keeping small ones in memory
+FILE_UPLOAD_HANDLERS = ['itemsapi.blobs.HashingUploadHandler']
+
+# Serve Item.attachment_count from the signal-maintained counter column
+# instead of COUNT subqueries (resync with Item.objects.recount_attachments())
+ITEMSAPI_CACHED_ATTACHMENT_COUNTS = False
+
+# Seconds a worker holds a claimed listing job before it is requeued
+ITEMSAPI_LISTING_LEASE_SECONDS = 600
+
+# Cache alias and lifetime (seconds) of cached item, path and inventory responses
+ITEMSAPI_CACHE = 'default'
+ITEMSAPI_CACHE_TIMEOUT = 300
+
+# Unreferenced blobs younger than this are kept by manage.py gc_blobs
+ITEMSAPI_BLOB_GRACE_SECONDS = 3600
+
+# Processes rendering image thumbnails and previews (0 renders inline)
+ITEMSAPI_THUMBNAIL_WORKERS = 2
+
+# Fraction of requests whose queries and timings are recorded (Server-Timing
+# header, GET /api/metrics for staff), and how many repeats of one SQL
+# statement in a request are reported as an N+1 pattern
+ITEMSAPI_METRICS_SAMPLE_RATE = 0.01
+ITEMSAPI_N_PLUS_ONE_THRESHOLD = 10
+
+# Trees whose geometry (parents, nested-set bounds, names) each process keeps in memory
+ITEMSAPI_GEOMETRY_TREES = 256
+
+# Days of full move history kept; older runs of moves are merged by
+# `manage.py compact_history`, meant to run daily
+ITEMSAPI_HISTORY_RETENTION_DAYS = 90
+
+# Days a subtree deleted with DELETE /api/items/{id}?trash=true can be
+# restored; `manage.py purge_trash`, meant to run daily, drops older ones
+ITEMSAPI_TRASH_RETENTION_DAYS = 30
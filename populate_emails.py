@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import sys
-import imaplib
-import email
-from email.policy import default
-from datetime import datetime
-import requests
-import json
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from itemsapi import ingest
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,113 +21,64 @@ EMAIL_HOST = os.getenv('EMAIL_HOST', 'mail.geekadomicile.com')
 EMAIL_USER = os.getenv('EMAIL_USER', 'a.bordessoules@geekadomicile.com')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD', 'JHygR4P8$1')
 EMAIL_FOLDER = os.getenv('EMAIL_FOLDER', 'Sent')
+EMAIL_PORT = int(os.getenv('EMAIL_PORT', 0)) or None
+EMAIL_SSL = os.getenv('EMAIL_SSL', '1') != '0'
+
+# Highest UID imported per folder, so reruns only fetch new mail
+STATE_FILE = os.getenv('EMAIL_STATE_FILE', '.populate_emails_state.json')
 
 # API endpoint
 API_URL = 'http://localhost:8000/api'
 
-def connect_to_email_server():
-    """Connect to the email server and login"""
-    mail = imaplib.IMAP4_SSL(EMAIL_HOST)
-    mail.login(EMAIL_USER, EMAIL_PASSWORD)
-    return mail
-
-def fetch_emails(mail):
-    """Fetch emails from the specified folder"""
-    mail.select(EMAIL_FOLDER)
-    status, messages = mail.search(None, 'ALL')
-    return messages[0].split()
-
-def parse_email(raw_email):
-    """Parse a raw email into its components"""
-    msg = email.message_from_bytes(raw_email, policy=default)
-    return {
-        'subject': msg['subject'] or 'No Subject',
-        'from_address': msg['from'] or 'unknown@domain.com',
-        'date': msg['date'],
-        'body': '',
-        'attachments': []
-    }
-
-def get_email_body(msg):
-    """Extract the body from the email message"""
-    body = ''
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == 'text/plain':
-                body = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
-                break
-            elif part.get_content_type() == 'text/html':
-                # For now, we'll just get the plain text version
-                # In a real application, you might want to parse the HTML
-                continue
-    else:
-        body = msg.get_payload(decode=True).decode(msg.get_content_charset() or 'utf-8')
-    return body if body else 'No body found'
-
-def save_attachment(attachment_data, item_id):
-    """Save an attachment directly from memory without writing to disk"""
-    url = f"{API_URL}/items/{item_id}/files"
-    files = {'file': (attachment_data['filename'], attachment_data['content'], attachment_data['content_type'])}
-    
-    # Add retry logic
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, files=files)
-            if response.status_code in [200, 201]:
-                print(f"Successfully uploaded attachment: {attachment_data['filename']}")
-                return True
-            else:
-                print(f"Attempt {attempt+1}/{max_retries}: Error uploading attachment - {response.status_code}")
-        except Exception as e:
-            print(f"Attempt {attempt+1}/{max_retries}: Connection error - {str(e)}")
-        
-        time.sleep(2)  # Wait before retrying
-    
-    print(f"Failed to upload attachment after {max_retries} attempts: {attachment_data['filename']}")
-    return False
-
-def get_email_attachments(msg):
-    """Extract attachments from the email message using walk()"""
-    attachments = []
-
-    for part in msg.walk():
-        # Skip the container parts
-        if part.get_content_maintype() == 'multipart':
-            continue
-
-        # Extract attachments
-        if part.get_content_maintype() in ['image', 'application']:
-            filename = part.get_filename()
-            if filename:
-                attachments.append({
-                    'filename': filename,
-                    'content_type': part.get_content_type(),
-                    'content': part.get_payload(decode=True)
-                })
-
-    return attachments
-
-def fetch_raw_email(mail, email_id):
-    """Fetch the raw email content"""
-    status, data = mail.fetch(email_id, '(RFC822)')
-    return data[0][1]
-
-def create_email_endpoint(item_id, email_data):
-    """Call the create email endpoint with email data"""
-    url = f"{API_URL}/items/{item_id}/emails"
-    try:
-        response = requests.post(
-            url,
-            headers={'Content-Type': 'application/json'},
-            data=json.dumps(email_data)
-        )
-        if response.status_code not in [200, 201]:
-            print(f"Error creating email: {response.status_code} - {response.text}")
-        return response
-    except requests.exceptions.ConnectionError:
-        print("Error: Could not connect to the API server. Make sure the Django server is running.")
-        sys.exit(1)
+class ApiSink:
+    """Posts parsed batches to /emails/bulk over one pooled session, uploading attachments ``concurrency`` at a time"""
+
+    def __init__(self, item_id, concurrency=8):
+        self.item_id = item_id
+        self.session = requests.Session()
+        # Only idempotent methods are retried by default: a retried upload would attach the file twice
+        retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # /emails/bulk reports messages it already stored as duplicates, so its POSTs can be retried too
+        bulk_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                             allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'})
+        self.session.mount(f"{API_URL}/emails/bulk", HTTPAdapter(pool_connections=1, max_retries=bulk_retries))
+        self.executor = ThreadPoolExecutor(concurrency)
+
+    def _upload(self, item_id, attachment):
+        files = {'file': (attachment['filename'], attachment['content'], attachment['content_type'])}
+        self.session.post(f"{API_URL}/items/{item_id}/files", files=files, timeout=60).raise_for_status()
+
+    def write(self, emails):
+        payload = {'emails': [{
+            'item_id': self.item_id,
+            'subject': email_data['subject'],
+            'body': email_data['body'],
+            'from_address': email_data['from_address'],
+            'received_at': email_data['received_at'].isoformat(),
+            'qr_code': email_data['qr_code'],
+            'message_id': email_data['message_id'],
+        } for email_data in emails], 'route': True}
+        response = self.session.post(f"{API_URL}/emails/bulk", json=payload, timeout=120)
+        response.raise_for_status()
+        results = response.json()['results']
+        errors = [result for result in results if result['status'] == 'error']
+        if errors:
+            # Raising leaves the high-water mark before this batch so a rerun retries it
+            raise RuntimeError(f"Could not store {len(errors)} emails: {errors[0]['detail']}")
+        # Attachments of duplicates were uploaded with the first copy
+        uploads = [(result['item_id'], attachment) for email_data, result in zip(emails, results)
+                   if result['status'] == 'created' for attachment in email_data['attachments']]
+        for future in [self.executor.submit(self._upload, item_id, attachment) for item_id, attachment in uploads]:
+            future.result()
+        print(f"Stored emails up to UID {emails[-1]['uid']}: "
+              f"{sum(result['status'] == 'created' for result in results)} new")
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
 
 def check_api_server():
     """Check if the API server is running, start it if not"""
@@ -183,21 +136,14 @@ def get_or_create_unprocessed_item():
         print("Error: Could not connect to the API server. Make sure the Django server is running.")
         sys.exit(1)
 
-def extract_qr_from_subject(subject):
-    """Extract QR code from email subject"""
-    import re
-    match = re.search(r'(?:Re:\s*)?(\w+)$', subject)
-    return match.group(1) if match else None
-
-def save_temp_attachment(attachment, email_id):
-    """Save attachment to temporary storage"""
-    os.makedirs(f"temp_attachments/{email_id}", exist_ok=True)
-    file_path = f"temp_attachments/{email_id}/{attachment['filename']}"
-    with open(file_path, 'wb') as f:
-        f.write(attachment['content'])
-    return file_path
-
 def main():
+    parser = argparse.ArgumentParser(description="Import new mail from the IMAP folder into the inventory")
+    parser.add_argument('--limit', type=int, default=None, help="stop after this many messages")
+    parser.add_argument('--batch-size', type=int, default=ingest.FETCH_BATCH, help="messages per UID FETCH")
+    parser.add_argument('--workers', type=int, default=None, help="MIME parsing processes (0 parses inline)")
+    parser.add_argument('--concurrency', type=int, default=8, help="parallel API requests")
+    args = parser.parse_args()
+
     # Check if API server is running
     check_api_server()
 
@@ -205,72 +151,15 @@ def main():
     unprocessed_id = get_or_create_unprocessed_item()
     print(f"Using unprocessed item ID: {unprocessed_id}")
 
-    # Connect to email server
-    mail = connect_to_email_server()
-
-    # Fetch emails
-    email_ids = fetch_emails(mail)
-
-    # Limit to first 250 emails for testing
-    email_ids = email_ids[:25]
-
-    # Process each email
-    total_emails = len(email_ids)
-    for i, email_id in enumerate(email_ids):
-        raw_email = fetch_raw_email(mail, email_id)
-        msg = email.message_from_bytes(raw_email, policy=default)
-
-        # Parse email
-        email_data = parse_email(raw_email)
-        email_data['body'] = get_email_body(msg)
-        email_data['attachments'] = get_email_attachments(msg)
-
-        # Convert date to datetime
-        try:
-            email_data['received_at'] = datetime.strptime(email_data['date'], '%a, %d %b %Y %H:%M:%S %z')
-        except ValueError:
-            # Try a different format if needed
-            email_data['received_at'] = datetime.now()
-
-        # Extract QR code from subject
-        qr_code = extract_qr_from_subject(email_data['subject'])
-        print(f"Extracted QR code: {qr_code or 'None'}")
-
-        # Prepare data for API call
-        api_data = {
-            'item_id': unprocessed_id,
-            'subject': email_data['subject'],
-            'body': email_data['body'],
-            'from_address': email_data['from_address'],
-            'received_at': email_data['received_at'].isoformat(),
-            'qr_code': qr_code
-        }
-
-        # Call the API
-        response = create_email_endpoint(unprocessed_id, api_data)
-        if response.status_code not in [200, 201]:
-            print(f"Error creating email: {response.status_code} - {response.text}")
-            continue
-            
-        email_id = response.json().get('id')
-        print(f"Created email with ID: {email_id}")
-
-        # Handle attachments if any
-        if email_data['attachments']:
-            saved_count = 0
-            for attachment in email_data['attachments']:
-                # Save to temp location
-                file_path = save_temp_attachment(attachment, email_id)
-                print(f"  Saved attachment: {file_path}")
-                saved_count += 1
-            print(f"  Saved {saved_count} attachments to temporary storage")
-
-        # Print progress
-        if i % 10 == 0 or i == total_emails - 1:
-            print(f"Processed {i+1}/{total_emails} emails")
-
-    # Logout from email server
-    mail.logout()
+    mail = ingest.connect(EMAIL_HOST, EMAIL_USER, EMAIL_PASSWORD, EMAIL_PORT, EMAIL_SSL)
+    mark = ingest.HighWaterMark(STATE_FILE, f"{EMAIL_USER}@{EMAIL_HOST}/{EMAIL_FOLDER}")
+    sink = ApiSink(unprocessed_id, args.concurrency)
+    try:
+        written = ingest.ingest(mail, EMAIL_FOLDER, sink, mark, args.batch_size, args.workers, args.limit)
+        print(f"Imported {written} emails, last UID {mark.uid}")
+    finally:
+        sink.close()
+        mail.logout()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()